@@ -0,0 +1,220 @@
+# async_main.py
+"""Asyncio entry point for the bot.
+
+Handlers run concurrently on one event loop. Blocking work (database.py calls and history
+formatting) runs on a bounded thread pool, and updates from the same user are handled one at a
+time, in the order they arrived. File imports run on main.import_executor, in the background.
+"""
+import asyncio
+import contextlib
+import contextvars
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+from telebot.types import InlineKeyboardMarkup
+
+import config
+import metrics
+from database import init_db
+from charts import chart_cache, submit_render
+from digest import DigestJob
+from forecast import SYNC_INTERVAL, ForecastJob
+from main import (ADMIN_IDS, CHART_PREFIX, DIGEST_SEND_HOUR, HELP_TEXT, HISTORY_PAGE_PREFIX, IMPORT_MAX_BYTES,
+                  IMPORT_TEXT, INVALID_INPUT_TEXT, MESSAGE_LIMIT, STATS_PREFIX, WELCOME_TEXT, a1c_message, buttons,
+                  digest_command_text, digest_message, forecasters, glucose_message, history_keyboard,
+                  history_options, history_page, import_document, import_executor, import_progress, keyboard,
+                  parse_history_page, predict_message, prepare_chart, stats_keyboard, stats_message)
+from outbox import GLOBAL_RATE
+
+logger = logging.getLogger(__name__)
+
+# Threads available for blocking work; requests beyond this wait in the executor queue
+DB_WORKERS = getattr(config, 'DB_WORKERS', 4)
+
+bot = AsyncTeleBot(config.TOKEN)
+executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+metrics.registry.gauge('queue_depth', metrics.executor_queue_depth(executor), 'Items waiting in a queue',
+                       queue='async_executor')
+
+# user_id -> [lock, number of handlers holding or waiting for it]
+_user_locks = {}
+# Running imports; the event loop only keeps weak references to tasks
+_imports = set()
+
+
+@contextlib.asynccontextmanager
+async def user_lock(user_id):
+    """Serialize handlers of one user; asyncio.Lock wakes waiters in FIFO order."""
+    entry = _user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _user_locks[user_id]
+
+
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # Run in a copy of the caller's context, so the queries count their rows towards its request
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+@bot.callback_query_handler(func=lambda call: call.data in buttons)
+@metrics.timed_handler
+async def process_callback_main(call):
+    if call.data == "entry_glucose_level":
+        await bot.send_message(call.message.chat.id, "Please enter your glucose level")
+    elif call.data == "request_history":
+        await bot.send_message(call.message.chat.id, "Please choose a history option",
+                               reply_markup=InlineKeyboardMarkup(history_keyboard))
+
+
+@bot.callback_query_handler(func=lambda call: call.data in history_options)
+@metrics.timed_handler
+async def process_callback_history(call):
+    user_id, chat_id = call.from_user.id, call.message.chat.id
+    logger.info(f'Chat ID: {chat_id}: User {user_id} requested a history data for period: {call.data}')
+    async with user_lock(user_id):
+        message, markup = await run_blocking(history_page, user_id, call.data)
+        await bot.send_message(chat_id, message, reply_markup=markup)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith(HISTORY_PAGE_PREFIX))
+@metrics.timed_handler
+async def process_callback_history_page(call):
+    user_id, chat_id = call.from_user.id, call.message.chat.id
+    time_period, before, after = parse_history_page(call.data)
+    async with user_lock(user_id):
+        message, markup = await run_blocking(history_page, user_id, time_period, before=before, after=after)
+        await bot.edit_message_text(message, chat_id, call.message.message_id, reply_markup=markup)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith(CHART_PREFIX))
+@metrics.timed_handler
+async def process_callback_chart(call):
+    user_id, chat_id = call.from_user.id, call.message.chat.id
+    async with user_lock(user_id):
+        key, file_id, payload = await run_blocking(prepare_chart, user_id, call.data[len(CHART_PREFIX):])
+        if isinstance(payload, str):
+            await bot.send_message(chat_id, payload)
+        elif file_id is not None:
+            await bot.send_photo(chat_id, file_id)
+        else:
+            # Rendering runs on the chart process pool; awaiting it keeps the event loop free
+            photo = await asyncio.wrap_future(submit_render(*payload))
+            sent = await bot.send_photo(chat_id, photo)
+            chart_cache.put(key, sent.photo[-1].file_id)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith(STATS_PREFIX))
+@metrics.timed_handler
+async def process_callback_stats(call):
+    user_id, chat_id = call.from_user.id, call.message.chat.id
+    async with user_lock(user_id):
+        await bot.send_message(chat_id, await run_blocking(stats_message, user_id, call.data[len(STATS_PREFIX):]))
+
+
+async def edit_import_status(chat_id, message_id, text):
+    try:
+        await bot.edit_message_text(text, chat_id, message_id)
+    except ApiTelegramException as e:
+        logger.debug(f'Skipped an import progress update: {e}')
+
+
+async def run_import(user_id, chat_id, message_id, file_id):
+    """Import a document on main.import_executor, editing the status message as the import goes.
+
+    Imports run there one at a time, so a long one does not take a thread from the executor the
+    handlers share. Progress is reported from the import thread back to the event loop.
+    """
+    loop = asyncio.get_running_loop()
+
+    def edit(text):
+        asyncio.run_coroutine_threadsafe(edit_import_status(chat_id, message_id, text), loop)
+
+    context = contextvars.copy_context()
+    text = await loop.run_in_executor(import_executor, functools.partial(
+        context.run, import_document, user_id, file_id, import_progress(edit)))
+    await bot.edit_message_text(text, chat_id, message_id)
+
+
+@bot.message_handler(content_types=['document'])
+@metrics.timed_handler
+async def handle_document(message):
+    document, chat_id = message.document, message.chat.id
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await bot.send_message(chat_id, f"The file is too large to import, the limit is {IMPORT_MAX_BYTES >> 20} MB")
+        return
+    status = await bot.send_message(chat_id, f"Importing {document.file_name or 'the file'}…")
+    # Not awaited: the user's other updates are handled while the file imports
+    task = asyncio.create_task(run_import(message.from_user.id, chat_id, status.message_id, document.file_id))
+    _imports.add(task)
+    task.add_done_callback(_imports.discard)
+
+
+@bot.message_handler(content_types=['text'])
+@metrics.timed_handler
+async def handle_message(message):
+    user_input = message.text
+    user_id = message.from_user.id
+    chat_id = message.chat.id
+
+    async with user_lock(user_id):
+        if user_input.isnumeric():
+            await bot.send_message(chat_id, await run_blocking(glucose_message, user_id, user_input, message.date))
+        elif user_input == "/start":
+            await bot.send_message(chat_id, WELCOME_TEXT)
+        elif user_input == "/help":
+            await bot.send_message(chat_id, HELP_TEXT, reply_markup=InlineKeyboardMarkup(keyboard))
+        elif user_input == "/a1c":
+            await bot.send_message(chat_id, await run_blocking(a1c_message, user_id))
+        elif user_input == "/stats":
+            await bot.send_message(chat_id, "Please choose a stats period",
+                                   reply_markup=InlineKeyboardMarkup(stats_keyboard))
+        elif user_input == "/digest":
+            await bot.send_message(chat_id, await run_blocking(digest_command_text, user_id, chat_id))
+        elif user_input == "/digest off":
+            await bot.send_message(chat_id, await run_blocking(digest_command_text, user_id, chat_id, enable=False))
+        elif user_input == "/import":
+            await bot.send_message(chat_id, IMPORT_TEXT)
+        elif user_input == "/predict":
+            # Read from the running forecast state, cheap enough for the event loop
+            await bot.send_message(chat_id, predict_message(user_id))
+        elif user_input == "/perf" and user_id in ADMIN_IDS:
+            await bot.send_message(chat_id, metrics.summary(MESSAGE_LIMIT))
+        else:
+            await bot.send_message(chat_id, INVALID_INPUT_TEXT, reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+def threadsafe_send(loop):
+    """A send(chat_id, text) for jobs on other threads: the message goes out on ``loop`` and the
+    returned concurrent Future completes with it."""
+    return lambda chat_id, text: asyncio.run_coroutine_threadsafe(bot.send_message(chat_id, text), loop)
+
+
+async def main():
+    await run_blocking(init_db)
+    metrics.instrument_telegram()
+    if getattr(config, 'DIGEST', True):
+        # There is no outbox in this runtime, so the digest paces its own sends
+        DigestJob(threadsafe_send(asyncio.get_running_loop()), digest_message, hour=DIGEST_SEND_HOUR,
+                  rate=getattr(config, 'OUTBOX_GLOBAL_RATE', GLOBAL_RATE)).start()
+    if forecasters:
+        ForecastJob(forecasters.values(), interval=getattr(config, 'NIGHTSCOUT_SYNC_INTERVAL', SYNC_INTERVAL)).start()
+    if getattr(config, 'METRICS_PORT', None):
+        metrics.start_http_server(config.METRICS_PORT, getattr(config, 'METRICS_HOST', '0.0.0.0'))
+    try:
+        await bot.polling(non_stop=True)
+    finally:
+        executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
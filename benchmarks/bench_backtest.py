@@ -0,0 +1,34 @@
+"""Walk-forward backtest of the ML forecast: serial vs folds on a process pool.
+
+Usage: python benchmarks/bench_backtest.py [days] [retrain_every] [horizons]
+"""
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.nightscout_data import make_entries, make_treatments  # noqa: E402
+from drafts.isf import NightscoutAnalyzer  # noqa: E402
+
+
+def main(days=30, retrain_every=288, horizons=3):
+    logging.disable(logging.INFO)
+    analyzer = NightscoutAnalyzer('http://localhost')
+    analyzer.entries = make_entries(days * 288)
+    analyzer.treatments = make_treatments(days)
+
+    print(f"{len(analyzer.entries)} entries, 20% test, retrain every {retrain_every} steps, {horizons}h horizons")
+    for workers in sorted({1, os.cpu_count() or 1}):
+        start = time.perf_counter()
+        summary = analyzer.backtest('combined_glucose_forecast', test_size=0.2, horizons=horizons,
+                                    retrain_every=retrain_every, workers=workers)
+        elapsed = time.perf_counter() - start
+        print(f"workers={workers:<4}{elapsed:>8.1f} s")
+    for horizon, scores in summary.items():
+        print(f"  {horizon}h: n={scores['n']} MAE={scores['mae']:.1f} RMSE={scores['rmse']:.1f} mg/dl")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:4]))
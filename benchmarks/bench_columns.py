@@ -0,0 +1,87 @@
+"""Memory and load time of a year of Nightscout data: lists of JSON documents vs analyzer columns.
+
+Each layout is loaded in a fresh process from the same API-shaped JSON bodies:
+
+- documents: the analyzer before the columns, json.loads of each body, entries sorted by date and
+  the entry time index (strptime of every dateString) built on top;
+- columns: NightscoutAnalyzer decoding the bodies straight into EntryColumns/TreatmentColumns rows.
+
+Peak RSS is ru_maxrss of the loading process; retained RSS is what is still resident once the
+bodies are dropped, both above the process's RSS before loading.
+
+Usage: python benchmarks/bench_columns.py [days]
+"""
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.nightscout_data import make_entries, make_treatments  # noqa: E402
+
+
+def rss_kib():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def load_documents(entries_body, treatments_body):
+    from drafts.isf import NightscoutAnalyzer
+    parse = NightscoutAnalyzer('http://localhost')._parse_date
+    entries = sorted(json.loads(entries_body), key=lambda x: x.get('date', ''))
+    treatments = json.loads(treatments_body)
+    times = [parse(e['dateString']) for e in entries]
+    return entries, treatments, times, [e['sgv'] for e in entries]
+
+
+def load_columns(entries_body, treatments_body):
+    from drafts.isf import EntryColumns, NightscoutAnalyzer, TreatmentColumns
+    analyzer = NightscoutAnalyzer('http://localhost')
+    analyzer.entries = EntryColumns.from_rows(json.loads(entries_body, object_hook=EntryColumns.row))
+    analyzer.treatments = TreatmentColumns.from_rows(json.loads(treatments_body, object_hook=TreatmentColumns.row))
+    return analyzer
+
+
+def measure(layout, entries_path, treatments_path):
+    """Load one layout in this process and print its figures as JSON."""
+    import drafts.isf  # noqa: F401  (imports are not part of the load)
+    gc.collect()
+    base = rss_kib()
+    start = time.perf_counter()
+    with open(entries_path) as f, open(treatments_path) as g:
+        entries_body, treatments_body = f.read(), g.read()
+    data = (load_documents if layout == 'documents' else load_columns)(entries_body, treatments_body)
+    elapsed = time.perf_counter() - start
+    del entries_body, treatments_body
+    gc.collect()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'load_s': elapsed, 'peak_mib': (peak - base) / 1024, 'retained_mib': (rss_kib() - base) / 1024}))
+    return data
+
+
+def main(days=365):
+    with tempfile.TemporaryDirectory() as tmp:
+        entries_path, treatments_path = os.path.join(tmp, 'entries.json'), os.path.join(tmp, 'treatments.json')
+        with open(entries_path, 'w') as f:
+            json.dump(make_entries(days * 288)[::-1], f)  # the API returns newest first
+        with open(treatments_path, 'w') as f:
+            json.dump(make_treatments(days)[::-1], f)
+        print(f"{days} days: {days * 288} entries, {os.path.getsize(entries_path) / 2 ** 20:.1f} MiB of JSON")
+        print(f"{'layout':<12}{'load, s':>10}{'peak MiB':>10}{'kept MiB':>10}")
+        for layout in ('documents', 'columns'):
+            out = subprocess.run([sys.executable, __file__, '--measure', layout, entries_path, treatments_path],
+                                 check=True, capture_output=True, text=True).stdout
+            result = json.loads(out.splitlines()[-1])
+            print(f"{layout:<12}{result['load_s']:>10.2f}{result['peak_mib']:>10.1f}{result['retained_mib']:>10.1f}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--measure']:
+        measure(*sys.argv[2:5])
+    else:
+        main(*(int(arg) for arg in sys.argv[1:2]))
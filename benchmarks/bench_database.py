@@ -0,0 +1,77 @@
+"""Inserts and history reads per second: per-call connections vs the pooled connection layer.
+
+Usage: python benchmarks/bench_database.py [n_inserts] [n_reads]
+"""
+import datetime
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+def legacy_insert(db_file, user_id, mg_dl, mmol_l, timestamp):
+    # What database.insert_data did before: schema probe on one connection, insert on a second one
+    conn = sqlite3.connect(db_file)
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", ('user_inputs',))
+    if not c.fetchone():
+        c.execute('CREATE TABLE user_inputs (timestamp TIMESTAMP, user_id INTEGER, mg_dl REAL, mmol_l REAL)')
+    conn.close()
+    conn = sqlite3.connect(db_file)
+    conn.execute("INSERT INTO user_inputs (timestamp, user_id, mg_dl, mmol_l) VALUES (?, ?, ?, ?)",
+                 (timestamp, user_id, mg_dl, mmol_l))
+    conn.commit()
+    conn.close()
+
+
+def legacy_history(db_file, user_id, date_from, date_to):
+    conn = sqlite3.connect(db_file)
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", ('user_inputs',))
+    c.fetchone()
+    conn.close()
+    conn = sqlite3.connect(db_file)
+    c = conn.execute(f'SELECT * FROM user_inputs WHERE user_id={user_id} AND timestamp BETWEEN ? AND ? '
+                     f'ORDER BY timestamp DESC', (date_from, date_to))
+    rows = c.fetchall()
+    conn.close()
+    return rows
+
+
+def rate(n, fn):
+    start = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    return n / (time.perf_counter() - start)
+
+
+def main(n_inserts=2000, n_reads=500):
+    now = datetime.datetime.now()
+    date_from, date_to = str(now - datetime.timedelta(days=1)), str(now)
+
+    def ts(i):
+        return str(now - datetime.timedelta(minutes=5 * i))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_db = os.path.join(tmp, 'legacy.db')
+        before_insert = rate(n_inserts, lambda i: legacy_insert(legacy_db, i % 10, 100 + i % 50, 5.5, ts(i)))
+        before_read = rate(n_reads, lambda i: legacy_history(legacy_db, i % 10, date_from, date_to))
+
+        database.DB_FILE = os.path.join(tmp, 'pooled.db')
+        database.init_db()
+        after_insert = rate(n_inserts, lambda i: database.insert_data(i % 10, 100 + i % 50, 5.5, ts(i)))
+        after_read = rate(n_reads, lambda i: database.select_history_data(i % 10, date_from, date_to))
+        database.close_connections()
+
+    print(f"{'':<16}{'before':>12}{'after':>12}{'speedup':>10}")
+    print(f"{'inserts/s':<16}{before_insert:>12.0f}{after_insert:>12.0f}{after_insert / before_insert:>9.1f}x")
+    print(f"{'history reads/s':<16}{before_read:>12.0f}{after_read:>12.0f}{after_read / before_read:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
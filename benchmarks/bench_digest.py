@@ -0,0 +1,90 @@
+"""Daily digest figures for many subscribers: one grouped query versus a round of queries per user.
+
+Every synthetic user is subscribed and has ``readings`` readings on yesterday's UTC day plus 30
+earlier days of daily_stats buckets for the A1C estimate. For each size the table shows the time to
+compute the figures in three ways:
+- digest.digest_figures, the single grouped query;
+- the per-user way, select_history_data plus select_window_stats for every subscriber;
+- a whole digest.run_digest with a send that does nothing, i.e. everything but the network.
+The grouped query reads each subscriber's readings of the day and their A1C_DAYS daily buckets, so
+its time per row read (us/row, readings plus buckets) should stay flat as users grow, while the
+per-user loop pays for two queries per user.
+
+Usage: python benchmarks/bench_digest.py [max_users]
+"""
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+import digest  # noqa: E402
+from migrations import SECONDS_PER_DAY  # noqa: E402
+
+HISTORY_DAYS = 30
+
+
+def fill(users, readings, day):
+    rng = random.Random(users * 1000 + readings)
+    step = SECONDS_PER_DAY // readings
+    start = day * SECONDS_PER_DAY
+    database.insert_readings((start + i * step + rng.randrange(step), user_id, level, round(level / 18.0182, 2))
+                             for user_id in range(1, users + 1) for i in range(readings)
+                             for level in (float(rng.randint(50, 300)),))
+    conn = database.get_connection()
+    with conn:
+        conn.executemany('INSERT INTO daily_stats (user_id, day, n, sum_mg_dl, sumsq_mg_dl) VALUES (?, ?, ?, ?, ?)',
+                         ((user_id, day - d, readings, 150.0 * readings, 150.0 ** 2 * readings)
+                          for user_id in range(1, users + 1) for d in range(1, HISTORY_DAYS + 1)))
+        conn.executemany('INSERT INTO digest_subscriptions (user_id, chat_id) VALUES (?, ?)',
+                         ((user_id, user_id) for user_id in range(1, users + 1)))
+
+
+def per_user(users, day):
+    start = day * SECONDS_PER_DAY
+    for user_id in range(1, users + 1):
+        rows = database.select_history_data(user_id, start, start + SECONDS_PER_DAY - 1)
+        if rows:
+            sum(row[2] for row in rows) / len(rows)
+        database.select_window_stats(user_id, digest.A1C_DAYS)
+
+
+def format_message(day, figures):
+    return f'{figures.count} {figures.mean:.0f} {figures.below} {figures.above} {figures.a1c_mean:.0f}'
+
+
+def main(max_users=100000):
+    logging.disable(logging.INFO)
+    day = int(time.time()) // SECONDS_PER_DAY - 1
+    sizes = [(users, 8) for users in (1000, 10000, 100000) if users <= max_users]
+    sizes.append((min(10000, max_users), 96))
+    print(f"{'users':>8}{'per user':>10}{'readings':>10}{'buckets':>10}{'grouped, s':>12}{'us/row':>8}"
+          f"{'per-user, s':>13}{'run, s':>9}")
+    for users, readings in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            database.DB_FILE = os.path.join(tmp, 'digest.db')
+            database.init_db()
+            fill(users, readings, day)
+            start = time.perf_counter()
+            figures = digest.digest_figures(day)
+            grouped = time.perf_counter() - start
+            assert len(figures) == users
+            start = time.perf_counter()
+            per_user(users, day)
+            looped = time.perf_counter() - start
+            start = time.perf_counter()
+            result = digest.run_digest(day, lambda chat_id, text: None, format_message, batch_size=1000)
+            run = time.perf_counter() - start
+            assert result == (users, 0, True)
+            rows, buckets = users * readings, users * (HISTORY_DAYS + 1)
+            print(f"{users:>8}{readings:>10}{rows:>10}{buckets:>10}{grouped:>12.2f}"
+                  f"{grouped / (rows + buckets) * 1e6:>8.2f}{looped:>13.2f}{run:>9.2f}")
+            database.close_connections()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,44 @@
+"""Multi-horizon ML forecast: a fresh model per horizon (as before) vs one cached model.
+
+Usage: python benchmarks/bench_forecast.py [days] [hours_ahead]
+"""
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.nightscout_data import make_entries, make_treatments  # noqa: E402
+from drafts.isf import ModelRegistry, NightscoutAnalyzer  # noqa: E402
+
+
+def main(days=30, hours_ahead=5):
+    logging.disable(logging.INFO)
+    analyzer = NightscoutAnalyzer('http://localhost')
+    analyzer.entries = make_entries(days * 288)
+    analyzer.treatments = make_treatments(days)
+
+    start = time.perf_counter()
+    for hours in range(1, hours_ahead + 1):
+        analyzer.models = ModelRegistry()
+        analyzer.combined_glucose_prediction(hours_ahead=hours)
+    per_horizon = time.perf_counter() - start
+
+    analyzer.models = ModelRegistry()
+    start = time.perf_counter()
+    analyzer.combined_glucose_forecast(hours_ahead=hours_ahead)
+    first = time.perf_counter() - start
+    start = time.perf_counter()
+    analyzer.combined_glucose_forecast(hours_ahead=hours_ahead)
+    repeat = time.perf_counter() - start
+
+    print(f"{len(analyzer.entries)} entries, {hours_ahead} hour forecast")
+    print(f"{'model per horizon, s':<30}{per_horizon:>10.2f}   ({hours_ahead} fits)")
+    print(f"{'forecast, first call, s':<30}{first:>10.2f}")
+    print(f"{'forecast, same data, s':<30}{repeat:>10.3f}")
+    print(f"registry: {analyzer.models.stats()}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
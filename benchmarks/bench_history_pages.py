@@ -0,0 +1,49 @@
+"""Cost of rendering one history page at different depths of a long history.
+
+Pages are keyset-paginated on (user_id, ts), so the last page of a user with a million readings
+should cost the same as the first one, and tracemalloc's peak should not grow with the history.
+
+Usage: python benchmarks/bench_history_pages.py [rows]
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+STEP = 300  # one reading every 5 minutes
+
+
+def main(rows=1000000, repeat=50):
+    import main as bot_main
+    logging.disable(logging.INFO)
+    bot_main.reply_cache.enabled = False  # time the page queries, not cache hits
+    now = int(time.time())
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_FILE = os.path.join(tmp, 'pages.db')
+        database.init_db()
+        conn = database.get_connection()
+        with conn:
+            conn.executemany('INSERT INTO user_inputs (ts, user_id, mg_dl, mmol_l) VALUES (?, ?, ?, ?)',
+                             ((now - STEP * i, 1, 100.0 + i % 80, 5.5) for i in range(rows)))
+        print(f"{'depth':>10}{'page, ms':>10}{'peak KiB':>10}")
+        for depth in (0, rows // 100, rows // 2, rows - 200):
+            before = now - STEP * depth + 1 if depth else None
+            tracemalloc.start()
+            start = time.perf_counter()
+            for _ in range(repeat):
+                bot_main.history_page(1, 'all', before=before)
+            elapsed = (time.perf_counter() - start) / repeat
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{depth:>10}{elapsed * 1000:>10.2f}{peak / 1024:>10.0f}")
+        database.close_connections()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,48 @@
+"""Cost of a one-user, one-day select_history_data as the table grows.
+
+With user_inputs clustered on (user_id, ts) the query is an index range scan, so its latency
+should stay flat while the total row count grows by orders of magnitude.
+
+Usage: python benchmarks/bench_history_scaling.py [max_rows]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+USERS = 100
+STEP = 300  # one reading every 5 minutes
+
+
+def fill(conn, start, stop, now):
+    rows = ((now - (i // USERS) * STEP, i % USERS, 100.0 + i % 80, 5.5) for i in range(start, stop))
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO user_inputs (ts, user_id, mg_dl, mmol_l) VALUES (?, ?, ?, ?)', rows)
+
+
+def main(max_rows=1000000, repeat=200):
+    now = int(time.time())
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_FILE = os.path.join(tmp, 'scaling.db')
+        database.init_db()
+        conn = database.get_connection()
+        print(f"{'rows':>10}{'day query, us':>16}{'rows returned':>15}")
+        size, filled = 10000, 0
+        while size <= max_rows:
+            fill(conn, filled, size, now)
+            filled = size
+            start = time.perf_counter()
+            for i in range(repeat):
+                rows = database.select_history_data(i % USERS, now - 86400, now)
+            elapsed = (time.perf_counter() - start) / repeat
+            print(f"{size:>10}{elapsed * 1e6:>16.0f}{len(rows):>15}")
+            size *= 10
+        database.close_connections()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
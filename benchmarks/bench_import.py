@@ -0,0 +1,93 @@
+"""Bulk import of a CGM export: throughput and memory for a Nightscout JSON and a Dexcom-style CSV file.
+
+Each file holds ``n_rows`` 5-minute readings (benchmarks/synthetic.py) and is imported into a fresh
+database by importer.import_readings, reading the file in chunks, in its own process. Peak RSS is
+the high-water mark of that process (VmHWM; ru_maxrss would include the parent's at fork) above its
+RSS before the import. Importing the same file a second time
+measures the deduplication path, where every row is already stored.
+
+Usage: python benchmarks/bench_import.py [n_rows]
+"""
+import gc
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import make_readings  # noqa: E402
+
+
+def rss_kib():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def peak_rss_kib():
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+
+
+def write_files(n, tmp):
+    """Write the readings as a Nightscout entries array and as a Clarity-like CSV; returns both paths."""
+    days = -(-n // 288)
+    rows = list(make_readings(1, days, int(time.time())))[:n]
+    json_path, csv_path = os.path.join(tmp, 'entries.json'), os.path.join(tmp, 'clarity.csv')
+    with open(json_path, 'w') as f:
+        f.write('[')
+        for i, (ts, _, mg_dl, _) in enumerate(rows):
+            f.write(('' if i == 0 else ',') + json.dumps(
+                {'_id': f'{ts:024x}', 'sgv': int(mg_dl), 'date': ts * 1000, 'type': 'sgv', 'direction': 'Flat',
+                 'dateString': datetime.utcfromtimestamp(ts).isoformat() + 'Z', 'device': 'bench'}))
+        f.write(']')
+    with open(csv_path, 'w') as f:
+        f.write('Index,Timestamp (YYYY-MM-DDThh:mm:ss),Event Type,Device Info,Glucose Value (mg/dL)\n')
+        for i, (ts, _, mg_dl, _) in enumerate(reversed(rows)):
+            f.write(f'{i + 1},{datetime.fromtimestamp(ts).isoformat()},EGV,G6,{int(mg_dl)}\n')
+    return json_path, csv_path
+
+
+def measure(path, db_file):
+    """Import a file twice into a fresh database in this process and print the figures as JSON."""
+    import database
+    import importer
+    database.DB_FILE = db_file
+    database.init_db()
+    gc.collect()
+    base = rss_kib()
+    start = time.perf_counter()
+    first = importer.import_readings(1, importer.iter_file(path))
+    elapsed = time.perf_counter() - start
+    peak = peak_rss_kib()
+    start = time.perf_counter()
+    again = importer.import_readings(1, importer.iter_file(path))
+    repeat = time.perf_counter() - start
+    print(json.dumps({'read': first.read, 'inserted': first.inserted, 'seconds': elapsed,
+                      'peak_mib': (peak - base) / 1024, 'again_inserted': again.inserted, 'again_seconds': repeat}))
+
+
+def main(n=1000000):
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = write_files(n, tmp)
+        print(f"{n} readings per file")
+        print(f"{'file':<14}{'MiB':>8}{'import, s':>11}{'rows/s':>10}{'peak MiB':>10}{'again, s':>10}{'again new':>11}")
+        for path in paths:
+            db_file = os.path.join(tmp, os.path.basename(path) + '.db')
+            out = subprocess.run([sys.executable, __file__, '--measure', path, db_file],
+                                 check=True, capture_output=True, text=True).stdout
+            result = json.loads(out.splitlines()[-1])
+            assert result['inserted'] == result['read'] == n, result
+            print(f"{os.path.basename(path):<14}{os.path.getsize(path) / 2 ** 20:>8.1f}{result['seconds']:>11.2f}"
+                  f"{n / result['seconds']:>10.0f}{result['peak_mib']:>10.1f}{result['again_seconds']:>10.2f}"
+                  f"{result['again_inserted']:>11}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--measure']:
+        measure(*sys.argv[2:4])
+    else:
+        main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,50 @@
+"""Sustained ingest throughput of insert_data: one transaction per reading vs write-behind batches.
+
+Usage: python benchmarks/bench_ingest.py [n_readings] [synchronous]
+
+``synchronous`` overrides the connection pragma (e.g. FULL to fsync on every commit, as a
+rollback-journal database would).
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+def ingest(n, now):
+    start = time.perf_counter()
+    for i in range(n):
+        database.insert_data(i % 50, 100.0 + i % 80, 5.5, now - i)
+    database.flush_writes()
+    return n / (time.perf_counter() - start)
+
+
+def main(n=20000, synchronous='NORMAL'):
+    database.PRAGMAS = tuple(p for p in database.PRAGMAS if 'synchronous' not in p) + \
+        (f'PRAGMA synchronous={synchronous}',)
+    now = int(time.time())
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_FILE = os.path.join(tmp, 'direct.db')
+        direct = ingest(n, now)
+        database.close_connections()
+
+        database.DB_FILE = os.path.join(tmp, 'buffered.db')
+        writer = database.enable_write_behind(max_batch=1000, max_delay=0.5)
+        buffered = ingest(n, now)
+        database.disable_write_behind()
+        count = database.select_window_stats(0)[0] * 50  # 50 users, equal shares
+        database.close_connections()
+
+    print(f"synchronous={synchronous}, {n} readings")
+    print(f"{'one commit per reading':<28}{direct:>10.0f} readings/s")
+    print(f"{'write-behind batches':<28}{buffered:>10.0f} readings/s"
+          f"  ({writer.flushed_batches} batches, {direct and buffered / direct:.1f}x)")
+    assert count == n, count
+
+
+if __name__ == "__main__":
+    main(*(int(arg) if arg.isdigit() else arg for arg in sys.argv[1:3]))
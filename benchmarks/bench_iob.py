@@ -0,0 +1,63 @@
+"""IOB series for every CGM entry of a period: per-entry total_IOB_for_period vs iob_series.
+
+This is the feature column combined_glucose_prediction builds. The legacy loop re-filters every
+treatment and re-parses its date for each entry.
+
+Usage: python benchmarks/bench_iob.py [days]
+"""
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.nightscout_data import make_entries, make_treatments  # noqa: E402
+from drafts.isf import NightscoutAnalyzer, exponential_curve  # noqa: E402
+
+
+def legacy_total_iob(treatments, target_time, dia_hours):
+    # total_IOB_for_period before the vectorized engine, over the treatment documents
+    target_time = target_time.replace(tzinfo=timezone.utc)
+    start_time = target_time - timedelta(hours=dia_hours)
+    total = 0
+    for entry in treatments:
+        if entry.get('insulin') and start_time <= datetime.fromisoformat(
+                entry['created_at'].replace('Z', '+00:00')) <= target_time:
+            elapsed = (target_time - datetime.fromisoformat(entry['created_at'].replace('Z', '+00:00'))
+                       ).total_seconds() / 3600
+            total += entry['insulin'] * (1 - elapsed / dia_hours) if elapsed <= dia_hours else 0
+    return total
+
+
+def main(days=30):
+    analyzer = NightscoutAnalyzer('http://localhost')
+    analyzer.entries = make_entries(days * 288)
+    treatments = make_treatments(days)
+    analyzer.treatments = treatments
+    timestamps = analyzer.entries.date.tolist()
+
+    start = time.perf_counter()
+    legacy = [legacy_total_iob(treatments, datetime.utcfromtimestamp(ts / 1000), 4.5) for ts in timestamps]
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    series = analyzer.iob_series(np.array(timestamps) / 1000)
+    linear_time = time.perf_counter() - start
+    assert np.allclose(series, legacy, atol=1e-9)
+
+    analyzer.iob_curve, analyzer.dia_hours = exponential_curve(75), 6
+    start = time.perf_counter()
+    analyzer.iob_series(np.array(timestamps) / 1000)
+    exponential_time = time.perf_counter() - start
+
+    print(f"{len(timestamps)} entries, {len(analyzer.treatments)} treatments")
+    print(f"{'per-entry loop, ms':<28}{legacy_time * 1000:>12.1f}")
+    print(f"{'iob_series linear, ms':<28}{linear_time * 1000:>12.1f}")
+    print(f"{'iob_series exponential, ms':<28}{exponential_time * 1000:>12.1f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,96 @@
+"""NightscoutAnalyzer.analyze_data: linear scans with per-entry date parsing vs the sorted columns.
+
+Covers the start/end glucose lookups of _compute_isf (searchsorted in the entry time column) and
+the meal proximity check (searchsorted in the sorted meal times). The legacy versions are timed on a few corrections
+and extrapolated, since running them over every correction of a 100k-entry dataset takes hours.
+
+Usage: python benchmarks/bench_isf.py [n_entries] [corrections_per_day]
+"""
+import os
+import sys
+import time
+from datetime import timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.nightscout_data import make_entries, make_treatments  # noqa: E402
+from drafts.isf import NightscoutAnalyzer, epoch_us  # noqa: E402
+
+LEGACY_SAMPLE = 3
+
+
+def legacy_compute_isf(self, treatment):
+    # NightscoutAnalyzer._compute_isf before the time index; self holds the documents as lists
+    start_time = self._parse_date(treatment.get('created_at'))
+    end_time = start_time + timedelta(hours=4)
+    start_glucose = next((e['sgv'] for e in self.entries if self._parse_date(e.get('dateString')) == start_time), None)
+    if not start_glucose:
+        start_glucose = next((e['sgv'] for e in self.entries if self._parse_date(e.get('dateString')) > start_time),
+                             None)
+    end_glucose = next((e['sgv'] for e in self.entries if self._parse_date(e.get('dateString')) == end_time), None)
+    if not end_glucose:
+        sorted_entries = sorted(self.entries, key=lambda x: x.get('dateString', ''), reverse=True)
+        end_glucose = next((e['sgv'] for e in sorted_entries if self._parse_date(e.get('dateString')) < end_time),
+                           None)
+    if start_glucose and end_glucose and treatment.get('insulin', 0) not in [0, None]:
+        return (start_glucose - end_glucose) / treatment.get('insulin')
+    return None
+
+
+def legacy_is_near_meal(self, treatment):
+    # NightscoutAnalyzer._is_near_meal before the sweep
+    treatment_time = self._parse_date(treatment.get('created_at'))
+    return any(t.get('eventType') == 'Meal Bolus' and
+               abs((self._parse_date(t.get('created_at')) - treatment_time).total_seconds()) < 4 * 3600
+               for t in self.treatments)
+
+
+class Documents:
+    # The analyzer's data as it was kept before the columns: lists of API documents
+    _parse_date = NightscoutAnalyzer._parse_date
+
+    def __init__(self, entries, treatments):
+        self.entries, self.treatments = entries, treatments
+
+
+def main(n_entries=100000, corrections_per_day=4):
+    documents = Documents(make_entries(n_entries),
+                          make_treatments(n_entries // 288 + 1, corrections_per_day=corrections_per_day))
+    corrections = [t for t in documents.treatments if t['eventType'] == 'Correction Bolus']
+
+    start = time.perf_counter()
+    legacy = [legacy_compute_isf(documents, t) for t in corrections[-LEGACY_SAMPLE:]]
+    legacy_each = (time.perf_counter() - start) / LEGACY_SAMPLE
+    start = time.perf_counter()
+    legacy_near = [legacy_is_near_meal(documents, t) for t in corrections[-LEGACY_SAMPLE:]]
+    legacy_near_each = (time.perf_counter() - start) / LEGACY_SAMPLE
+
+    start = time.perf_counter()
+    analyzer = NightscoutAnalyzer('http://localhost')
+    analyzer.entries, analyzer.treatments = documents.entries, documents.treatments
+    load_total = time.perf_counter() - start
+    start = time.perf_counter()
+    indexed = [analyzer._compute_isf(t) for t in corrections]
+    indexed_total = time.perf_counter() - start
+    assert indexed[-LEGACY_SAMPLE:] == legacy
+    start = time.perf_counter()
+    near = analyzer._near_meal_flags(np.array([epoch_us(t['created_at']) for t in corrections])).tolist()
+    sweep_total = time.perf_counter() - start
+    assert near[-LEGACY_SAMPLE:] == legacy_near
+    start = time.perf_counter()
+    analyzer.analyze_data()
+    analyze_total = time.perf_counter() - start
+
+    print(f"{n_entries} entries, {len(corrections)} corrections")
+    print(f"{'legacy, s (extrapolated)':<32}{legacy_each * len(corrections):>12.1f}")
+    print(f"{'columns load, s':<32}{load_total:>12.3f}")
+    print(f"{'column lookups one by one, s':<32}{indexed_total:>12.3f}")
+    print(f"{'legacy meal scan, s (extrap.)':<32}{legacy_near_each * len(corrections):>12.1f}")
+    print(f"{'meal sweep, s':<32}{sweep_total:>12.3f}")
+    print(f"{'analyze_data, s':<32}{analyze_total:>12.3f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
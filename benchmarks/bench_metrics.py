@@ -0,0 +1,68 @@
+"""Overhead of the metrics instrumentation, with recording on and off.
+
+Times a bare Histogram.observe, the timed_query/timed_handler wrappers around a no-op, and two real
+paths (get_avg, the cheapest query, and a handler serving a history page) with
+metrics.registry.enabled set to True and to False.
+
+Usage: python benchmarks/bench_metrics.py [n_calls]
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+import timeit
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+import metrics  # noqa: E402
+from benchmarks.suite import StubBot  # noqa: E402
+from benchmarks.synthetic import make_readings  # noqa: E402
+
+
+def per_call(fn, n):
+    return min(timeit.repeat(fn, number=n, repeat=5)) / n
+
+
+def noop():
+    return None
+
+
+def main(n=20000):
+    import main as bot_main
+    logging.disable(logging.INFO)
+    bot_main.reply_cache.enabled = False  # time the page queries, not cache hits
+    bot_main.bot = StubBot()
+    histogram = metrics.registry.histogram('bench_seconds')
+    query, handler = metrics.timed_query(noop), metrics.timed_handler(noop)
+    print(f"{'':<28}{'per call':>12}")
+    print(f"{'Histogram.observe':<28}{per_call(lambda: histogram.observe(0.003), n) * 1e9:>10.0f}ns")
+    print(f"{'bare no-op call':<28}{per_call(noop, n) * 1e9:>10.0f}ns")
+    print(f"{'timed_query(no-op)':<28}{per_call(query, n) * 1e9:>10.0f}ns")
+    print(f"{'timed_handler(no-op)':<28}{per_call(handler, n) * 1e9:>10.0f}ns")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_FILE = os.path.join(tmp, 'metrics.db')
+        database.init_db()
+        conn = database.get_connection()
+        with conn:
+            conn.executemany('INSERT INTO user_inputs (ts, user_id, mg_dl, mmol_l) VALUES (?, ?, ?, ?)',
+                             make_readings(1, 30, int(time.time())))
+        call = SimpleNamespace(data='week', from_user=SimpleNamespace(id=1),
+                               message=SimpleNamespace(chat=SimpleNamespace(id=1)))
+        paths = (('get_avg', lambda: bot_main.get_avg(1, '60'), n),
+                 ('history page handler', lambda: bot_main.process_callback_history(call), n // 50))
+        print(f"\n{'path':<28}{'metrics off':>14}{'metrics on':>14}{'overhead':>10}")
+        for name, fn, calls in paths:
+            metrics.registry.enabled = False
+            off = per_call(fn, calls)
+            metrics.registry.enabled = True
+            on = per_call(fn, calls)
+            print(f"{name:<28}{off * 1e6:>12.1f}µs{on * 1e6:>12.1f}µs{(on - off) / off:>10.1%}")
+        database.close_connections()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,55 @@
+"""Full download vs incremental sync of a Nightscout site, against a local fake Nightscout.
+
+Times the first sync of ``days`` of data, then a re-run after one more day of readings has arrived,
+and compares with the legacy fetch of everything in one response.
+
+Usage: python benchmarks/bench_ns_sync.py [days]
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+from benchmarks.fake_nightscout import FakeNightscout  # noqa: E402
+from benchmarks.nightscout_data import make_entries, make_treatments  # noqa: E402
+from drafts.isf import NightscoutAnalyzer  # noqa: E402
+from nightscout_sync import NightscoutSync  # noqa: E402
+
+
+def main(days=365):
+    logging.disable(logging.INFO)
+    entries = make_entries((days + 1) * 288)
+    site = FakeNightscout(entries[:days * 288], make_treatments(days)).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_FILE = os.path.join(tmp, 'ns.db')
+        analyzer = NightscoutAnalyzer(site.url)
+
+        start = time.perf_counter()
+        analyzer.fetch_data(count=len(entries))
+        legacy = time.perf_counter() - start
+
+        sync = NightscoutSync(site.url)
+        start = time.perf_counter()
+        analyzer.fetch_data(sync=sync)
+        first = time.perf_counter() - start
+
+        site.add('entries', entries[days * 288:])
+        site.served = 0
+        start = time.perf_counter()
+        analyzer.fetch_data(sync=sync)
+        delta = time.perf_counter() - start
+        database.close_connections()
+    site.stop()
+
+    print(f"{days} days: {len(analyzer.entries)} entries, {len(analyzer.treatments)} treatments")
+    print(f"{'legacy full fetch, s':<28}{legacy:>10.2f}")
+    print(f"{'first sync + load, s':<28}{first:>10.2f}")
+    print(f"{'delta sync + load, s':<28}{delta:>10.2f}   ({site.served} documents downloaded)")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
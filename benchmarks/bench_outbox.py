@@ -0,0 +1,90 @@
+"""Reply bursts against a rate-limited fake Telegram API: inline sends versus the outbox.
+
+A burst of replies to many chats is sent from several handler threads, either with a blocking
+bot.send_message per reply or through outbox.Outbox. The fake API enforces Telegram-like flood
+limits (``--chat-limit`` and ``--global-limit`` messages per second) and answers 429 above them.
+Reports how long the handlers were busy sending, when the last reply arrived, how many API messages
+carried the replies (the outbox merges texts queued for one chat), and how many sends were refused
+and how many replies lost.
+
+Usage: python benchmarks/bench_outbox.py [--replies 300] [--chats 60] [--handlers 8]
+                                         [--chat-limit 3] [--global-limit 30]
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telebot  # noqa: E402
+from telebot.apihelper import ApiTelegramException  # noqa: E402
+
+from benchmarks.fake_telegram import FakeTelegram, use_fake_api  # noqa: E402
+from outbox import Outbox  # noqa: E402
+
+
+def burst(send, replies, chats, handlers):
+    """Send ``replies`` texts round-robin over ``chats`` from ``handlers`` threads; returns (seconds, errors)."""
+    errors = []
+    jobs = iter(range(replies))
+    lock = threading.Lock()
+
+    def handler():
+        while True:
+            with lock:
+                i = next(jobs, None)
+            if i is None:
+                return
+            try:
+                send(1 + i % chats, f'reply {i}')
+            except ApiTelegramException as e:
+                errors.append(e.error_code)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=handler) for _ in range(handlers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--replies', type=int, default=300)
+    parser.add_argument('--chats', type=int, default=60)
+    parser.add_argument('--handlers', type=int, default=8)
+    parser.add_argument('--chat-limit', type=int, default=3)
+    parser.add_argument('--global-limit', type=int, default=30)
+    args = parser.parse_args(argv)
+    logging.disable(logging.WARNING)
+
+    print(f"{args.replies} replies to {args.chats} chats from {args.handlers} handler threads; "
+          f"limits {args.chat_limit}/s per chat, {args.global_limit}/s overall")
+    print(f"{'mode':<8}{'handlers busy, s':>18}{'last reply, s':>15}{'messages':>10}{'429s':>7}{'lost':>7}")
+    for mode in ('inline', 'outbox'):
+        api = FakeTelegram(chat_limit=args.chat_limit, global_limit=args.global_limit).start()
+        use_fake_api(api.port)
+        bot = telebot.TeleBot('1:bench')
+        start = time.perf_counter()
+        if mode == 'inline':
+            busy, _ = burst(bot.send_message, args.replies, args.chats, args.handlers)
+        else:
+            # Per-chat and global rates just under the limits, bursts within them
+            outbox = Outbox(bot, global_rate=args.global_limit * 0.8, global_burst=max(1, args.global_limit // 6),
+                            chat_rate=args.chat_limit * 0.5, chat_burst=1).start()
+            busy, _ = burst(outbox.send_message, args.replies, args.chats, args.handlers)
+            outbox.wait_idle()
+            outbox.stop()
+        last = max((at for _, _, at in api.sent), default=start) - start
+        delivered = sum(text.count('reply ') for _, text, _ in api.sent)
+        api.stop()
+        print(f"{mode:<8}{busy:>18.3f}{last:>15.2f}{len(api.sent):>10}{len(api.rejected):>7}"
+              f"{args.replies - delivered:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Cost of a fresh 3-hour forecast after each new CGM reading: batch predict_glucose vs StreamingForecaster.
+
+For each history length, an analyzer holds ``days`` days of synthetic entries and treatments
+(benchmarks/nightscout_data.py). The next 50 readings then arrive one at a time, and after each one
+the forecast is produced both ways:
+- batch: the reading is appended to the analyzer's entries and predict_glucose runs once per hour
+  ahead, which recomputes analyze_data and the IOB from the whole history;
+- streaming: StreamingForecaster.add_entry plus forecast().
+The streaming time should not grow with the history. The table also shows the forecasters' largest
+difference from the batch results, and how long building the state from the history (from_analyzer) took.
+
+Usage: python benchmarks/bench_predict_stream.py [max_days]
+"""
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.nightscout_data import make_entries, make_treatments  # noqa: E402
+from drafts.isf import US_PER_SECOND, NightscoutAnalyzer  # noqa: E402
+from forecast import StreamingForecaster  # noqa: E402
+
+HOURS_AHEAD = 3
+NEW_READINGS = 50
+
+
+def main(max_days=365):
+    logging.disable(logging.INFO)
+    print(f"{'days':>6}{'entries':>9}{'build, s':>10}{'batch, ms':>11}{'stream, us':>12}{'max diff':>10}")
+    for days in (7, 30, 90, 365):
+        if days > max_days:
+            break
+        entries = make_entries(days * 288 + NEW_READINGS)
+        analyzer = NightscoutAnalyzer('http://localhost')
+        analyzer.entries = entries[:-NEW_READINGS]
+        analyzer.treatments = make_treatments(days)
+        start = time.perf_counter()
+        forecaster = StreamingForecaster.from_analyzer(analyzer)
+        build = time.perf_counter() - start
+
+        batch_seconds = stream_seconds = worst = 0.0
+        for entry in entries[-NEW_READINGS:]:
+            start = time.perf_counter()
+            analyzer.entries.append(entry)
+            now = analyzer.entries.time[-1] / US_PER_SECOND
+            batch = [analyzer.predict_glucose(hours, now) for hours in range(1, HOURS_AHEAD + 1)]
+            batch_seconds += time.perf_counter() - start
+
+            start = time.perf_counter()
+            forecaster.add_entry(entry)
+            streamed = forecaster.forecast(HOURS_AHEAD, now)
+            stream_seconds += time.perf_counter() - start
+            worst = max(worst, *(abs(a - b) for a, b in zip(batch, streamed)))
+        print(f"{days:>6}{len(analyzer.entries):>9}{build:>10.2f}{batch_seconds / NEW_READINGS * 1000:>11.2f}"
+              f"{stream_seconds / NEW_READINGS * 1e6:>12.1f}{worst:>10.1e}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,81 @@
+"""History and A1C taps served from the reply cache versus computed from SQLite every time.
+
+A database holds USERS users' DAYS days of 5-minute readings (benchmarks/synthetic.py). A stream of
+taps picks a user (a few heavy users tap most, Zipf-like) and one of the history or /a1c buttons; with
+probability ``write share`` the user first sends a new reading, which invalidates their entries. The
+same stream is replayed with main.reply_cache disabled and enabled, and the table shows the time per
+tap, the SQL statements run per tap (a hit runs none), the hit rate and the cache's estimated size.
+
+Usage: python benchmarks/bench_reply_cache.py [taps]
+"""
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+from benchmarks.synthetic import make_readings  # noqa: E402
+
+USERS = 100
+DAYS = 14
+BUTTONS = (('history', 'week'), ('history', 'month'), ('history', '1 day'), ('a1c', '60'), ('a1c', '90'))
+
+
+def make_taps(taps, write_share, seed=0):
+    rng = random.Random(seed)
+    weights = [1 / rank for rank in range(1, USERS + 1)]
+    users = rng.choices(range(1, USERS + 1), weights, k=taps)
+    return [(user_id, rng.choice(BUTTONS), rng.random() < write_share) for user_id in users]
+
+
+def replay(bot_main, taps, now):
+    """Run the taps; returns (seconds per tap, SQL statements per tap)."""
+    conn, statements = database.get_connection(), []
+    conn.set_trace_callback(statements.append)
+    start = time.perf_counter()
+    try:
+        for i, (user_id, (kind, period), write) in enumerate(taps):
+            if write:
+                database.insert_data(user_id, 120.0, 6.66, now + i)
+            if kind == 'history':
+                bot_main.history_page(user_id, period)
+            else:
+                bot_main.a1c_message(user_id, period)
+        elapsed = time.perf_counter() - start
+    finally:
+        conn.set_trace_callback(None)
+    writes = sum(1 for *_, write in taps if write)
+    # Statements of the writes themselves (BEGIN, INSERT, COMMIT) are not part of a tap
+    return elapsed / len(taps), (len(statements) - 3 * writes) / len(taps)
+
+
+def main(taps=20000):
+    import main as bot_main
+    logging.disable(logging.INFO)
+    now = int(time.time())
+    print(f"{'write share':>12}{'cache':>7}{'per tap, us':>13}{'SQL/tap':>9}{'hit rate':>10}{'KiB':>8}")
+    for write_share in (0.0, 0.05, 0.25):
+        stream = make_taps(taps, write_share)
+        for enabled in (False, True):
+            with tempfile.TemporaryDirectory() as tmp:
+                database.DB_FILE = os.path.join(tmp, 'replies.db')
+                database.init_db()
+                database.insert_readings(make_readings(USERS, DAYS, now))
+                cache = bot_main.reply_cache
+                cache.clear()
+                cache.enabled = enabled
+                cache.hits = cache.misses = 0
+                per_tap, per_tap_sql = replay(bot_main, stream, now)
+                counters = cache.counters()
+                print(f"{write_share:>12.0%}{'on' if enabled else 'off':>7}{per_tap * 1e6:>13.1f}{per_tap_sql:>9.2f}"
+                      f"{counters['hit_rate'] if enabled else 0:>10.1%}{counters['bytes'] / 1024:>8.0f}")
+                database.close_connections()
+    bot_main.reply_cache.enabled = True
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,90 @@
+"""Cost of "all"-period reads for one user as their history grows, with and without tiered retention.
+
+For each history length a fresh database gets one user's 5-minute readings (benchmarks/synthetic.py)
+ending now. The "all" reads are then timed before and after a retention.compact() pass with the
+default windows: select_all_data, the stats load (stats.load_readings), the chart load, which
+switches to daily means past main.CHART_MAX_DAYS days of data, and the all-time average
+(select_window_stats). The table also shows how many rows each read returns, how long
+compaction took, and the longest single compaction transaction, which is how long bot writes
+can be kept waiting.
+
+Usage: python benchmarks/bench_retention.py [max_days]
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+import retention  # noqa: E402
+import stats  # noqa: E402
+from benchmarks.synthetic import make_readings  # noqa: E402
+
+CHART_MAX_DAYS = 90  # main.CHART_MAX_DAYS without a config
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+def measure(repeat):
+    """(all rows ms, rows, stats load ms, chart load ms, window stats ms) for user 1."""
+    all_ms, rows = timed(lambda: database.select_all_data(1), repeat)
+    load_ms, _ = timed(lambda: stats.load_readings(1), repeat)
+    chart_ms, _ = timed(lambda: stats.load_readings(1, max_days=CHART_MAX_DAYS), repeat)
+    window_ms, _ = timed(lambda: database.select_window_stats(1), repeat * 10)
+    return all_ms, len(rows), load_ms, chart_ms, window_ms
+
+
+def longest_transaction(fn):
+    """Run ``fn`` and return (its result, the longest time between a BEGIN and its COMMIT, ms)."""
+    conn = database.get_connection()
+    spans, began = [], []
+
+    def trace(statement):
+        if statement.startswith('BEGIN'):
+            began.append(time.perf_counter())
+        elif statement == 'COMMIT' and began:
+            spans.append(time.perf_counter() - began.pop())
+    conn.set_trace_callback(trace)
+    try:
+        result = fn()
+    finally:
+        conn.set_trace_callback(None)
+    return result, max(spans, default=0) * 1000
+
+
+def main(max_days=5 * 365, repeat=3):
+    logging.disable(logging.INFO)
+    now = int(time.time())
+    print(f"{'days':>6}{'tiers':>7}{'all, ms':>9}{'rows':>9}{'stats, ms':>11}{'chart, ms':>11}{'avg, ms':>9}"
+          f"{'compact, s':>12}{'max txn, ms':>13}")
+    days = 30
+    while True:
+        with tempfile.TemporaryDirectory() as tmp:
+            database.DB_FILE = os.path.join(tmp, 'retention.db')
+            database.init_db()
+            database.insert_readings(make_readings(1, days, now))
+            raw = measure(repeat)
+            start = time.perf_counter()
+            _, txn = longest_transaction(lambda: retention.compact(now))
+            compact_s = time.perf_counter() - start
+            tiered = measure(repeat)
+            for label, (all_ms, rows, load_ms, chart_ms, window_ms), extra in (
+                    ('raw', raw, ''), ('yes', tiered, f'{compact_s:>12.2f}{txn:>13.1f}')):
+                print(f"{days:>6}{label:>7}{all_ms:>9.1f}{rows:>9}{load_ms:>11.1f}{chart_ms:>11.1f}{window_ms:>9.3f}"
+                      f"{extra}")
+            database.close_connections()
+        if days >= max_days:
+            break
+        days = min(max_days, days * 4)
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
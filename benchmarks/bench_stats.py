@@ -0,0 +1,72 @@
+"""Time to compute /stats for 90 days of 5-minute CGM data (~26k readings).
+
+Compares the vectorized stats.compute_stats with the same figures computed by a plain Python loop
+over row tuples, the way get_avg used to, and times the full load-from-SQLite path as well.
+
+Usage: python benchmarks/bench_stats.py [days]
+"""
+import math
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+import stats  # noqa: E402
+
+STEP = 300
+
+
+def loop_stats(rows):
+    values = [row[2] for row in rows]
+    n = len(values)
+    mean = sum(values) / n
+    sd = math.sqrt(sum((v - mean) ** 2 for v in values) / (n - 1))
+    in_range = sum(1 for v in values if stats.TARGET_LOW <= v <= stats.TARGET_HIGH) / n
+    by_hour = {}
+    for row in rows:
+        by_hour.setdefault(time.localtime(row[0]).tm_hour, []).append(row[2])
+    profile = {hour: sorted(v)[len(v) // 2] for hour, v in by_hour.items()}
+    return mean, sd, in_range, profile
+
+
+def best_of(fn, repeat=20):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(days=90):
+    now = int(time.time())
+    n = days * 86400 // STEP
+    rng = np.random.default_rng(0)
+    mg_dl = np.clip(140 + 50 * np.sin(np.arange(n) / 40) + rng.normal(0, 15, n), 40, 400).astype(np.float32)
+    ts = now - STEP * np.arange(n, dtype=np.int64)[::-1]
+    rows = [(int(t), 1, float(v), float(v) / 18) for t, v in zip(ts, mg_dl)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_FILE = os.path.join(tmp, 'stats.db')
+        database.init_db()
+        conn = database.get_connection()
+        with conn:
+            conn.executemany('INSERT INTO user_inputs (ts, user_id, mg_dl, mmol_l) VALUES (?, ?, ?, ?)', rows)
+        loop = best_of(lambda: loop_stats(rows), repeat=3)
+        vectorized = best_of(lambda: stats.compute_stats(ts, mg_dl))
+        loaded = best_of(lambda: stats.user_stats(1), repeat=5)
+        database.close_connections()
+
+    print(f"{n} readings over {days} days")
+    print(f"{'python loop (subset of figures), ms':<40}{loop * 1000:>10.2f}")
+    print(f"{'compute_stats, ms':<40}{vectorized * 1000:>10.2f}")
+    print(f"{'user_stats incl. SQLite load, ms':<40}{loaded * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
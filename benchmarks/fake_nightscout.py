@@ -0,0 +1,87 @@
+"""A local stand-in for the Nightscout REST API, used by the sync tests and benchmarks.
+
+Serves ``/api/v1/entries.json`` and ``/api/v1/treatments.json`` newest first, honouring ``count``
+and ``find[<field>][$gt|$gte|$lt|$lte]`` filters like the real API, and counts the requests and
+documents it serves.
+"""
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+SORT_FIELDS = {'entries': 'date', 'treatments': 'created_at'}
+FIND = re.compile(r'find\[(\w+)\]\[\$(gt|gte|lt|lte)\]')
+OPERATORS = {
+    'gt': lambda a, b: a > b,
+    'gte': lambda a, b: a >= b,
+    'lt': lambda a, b: a < b,
+    'lte': lambda a, b: a <= b,
+}
+
+
+class FakeNightscout(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, entries=(), treatments=(), port=0):
+        super().__init__(('127.0.0.1', port), FakeNightscoutHandler)
+        self.collections = {'entries': list(entries), 'treatments': list(treatments)}
+        self.requests = []
+        self.served = 0
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def add(self, collection, documents):
+        self.collections[collection].extend(documents)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def query(self, collection, params):
+        field = SORT_FIELDS[collection]
+        documents = self.collections[collection]
+        for key, value in params.items():
+            match = FIND.fullmatch(key)
+            if match:
+                name, op = match.groups()
+                # Like Nightscout, numeric filters on numeric fields are compared as numbers
+                value = int(value) if name == 'date' else value
+                documents = [d for d in documents if name in d and OPERATORS[op](d[name], value)]
+        documents = sorted(documents, key=lambda d: d[field], reverse=True)
+        return documents[:int(params.get('count', 10))]
+
+
+class FakeNightscoutHandler(BaseHTTPRequestHandler):
+    server: FakeNightscout
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        match = re.fullmatch(r'/api/v1/(entries|treatments)\.json', url.path)
+        if not match:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        params = dict(parse_qsl(url.query))
+        documents = self.server.query(match.group(1), params)
+        self.server.requests.append((match.group(1), params))
+        self.server.served += len(documents)
+        body = json.dumps(documents).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,204 @@
+"""A local stand-in for the Telegram Bot API, used by the load tests.
+
+It serves queued updates through getUpdates, accepts sendMessage (and answers every other method
+with ``true``), and records when each update was handed out and when its reply arrived. Point the
+bot at it with ``use_fake_api(port)``. Optionally it enforces flood limits on sendMessage the way
+Telegram does, answering 429 with a ``retry_after``.
+"""
+import asyncio
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+
+
+def make_message_update(update_id, user_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time.time()), 'text': text,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+            'chat': {'id': user_id, 'type': 'private'},
+        },
+    }
+
+
+def make_callback_update(update_id, user_id, data):
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id), 'from': user, 'chat_instance': str(user_id), 'data': data,
+            'message': {'message_id': update_id, 'date': int(time.time()), 'text': 'menu', 'from': user,
+                        'chat': {'id': user_id, 'type': 'private'}},
+        },
+    }
+
+
+def use_fake_api(port):
+    """Point both the sync and the asyncio telebot helpers at a FakeTelegram on ``port``."""
+    from telebot import apihelper, asyncio_helper
+    url = f'http://127.0.0.1:{port}/bot{{0}}/{{1}}'
+    apihelper.API_URL = url
+    asyncio_helper.API_URL = url
+
+
+class FakeTelegram:
+    """Fake Bot API server running on its own event loop thread.
+
+    ``on_reply(chat_id, text)`` is called for each sendMessage and may return new updates to enqueue,
+    which lets a load generator keep each simulated user in a closed request/reply loop.
+
+    With ``chat_limit`` or ``global_limit`` set, a sendMessage that would exceed that many messages
+    in the last ``window`` seconds, to its chat or overall, is refused with a 429 asking to retry
+    after ``retry_after`` seconds and recorded in ``rejected``.
+    """
+
+    def __init__(self, port=0, on_reply=None, chat_limit=None, global_limit=None, window=1.0, retry_after=1):
+        self.port = port
+        self.on_reply = on_reply
+        self.chat_limit = chat_limit
+        self.global_limit = global_limit
+        self.window = window
+        self.retry_after = retry_after
+        self.rejected = []
+        self._recent = deque()
+        self._recent_by_chat = defaultdict(deque)
+        self.sent = []
+        self.latencies = []
+        self._updates = deque()
+        self._served_at = defaultdict(deque)
+        self._lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        self._new_updates = None
+        self._runner = None
+        self._thread = threading.Thread(target=self._loop.run_forever, name='FakeTelegram', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def expect_reply(self, update, at=None):
+        """Start the latency clock for ``update``; it stops at the next sendMessage to the same chat."""
+        with self._lock:
+            self._served_at[_chat_id(update)].append(time.perf_counter() if at is None else at)
+
+    def enqueue(self, updates):
+        with self._lock:
+            self._updates.extend(updates)
+        self._loop.call_soon_threadsafe(self._new_updates.set)
+
+    async def _start(self):
+        self._new_updates = asyncio.Event()
+        # The sync helper puts sendMessage text in the query string, so allow long request lines
+        app = web.Application(handler_args={'max_line_size': 1 << 20, 'max_field_size': 1 << 20})
+        app.router.add_route('*', '/bot{token}/{method}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def _params(self, request):
+        params = dict(request.query)
+        if request.can_read_body:
+            if request.content_type == 'application/json':
+                params.update(await request.json())
+            else:
+                # The asyncio helper sends form bodies even with GET, which request.post() ignores
+                params.update(parse_qsl(await request.text()))
+        return params
+
+    async def _handle(self, request):
+        method = request.match_info['method']
+        params = await self._params(request)
+        if method == 'getUpdates':
+            return self._ok(await self._get_updates(params))
+        if method == 'sendMessage' and self._over_limit(int(params['chat_id'])):
+            self.rejected.append((int(params['chat_id']), time.perf_counter()))
+            return web.Response(status=429, content_type='application/json', text=json.dumps(
+                {'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {self.retry_after}',
+                 'parameters': {'retry_after': self.retry_after}}))
+        if method in ('sendMessage', 'editMessageText'):
+            return self._ok(self._send_message(params))
+        if method == 'getMe':
+            return self._ok({'id': 1, 'is_bot': True, 'first_name': 'bot', 'username': 'fake_bot'})
+        return self._ok(True)
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = min(float(params.get('timeout') or 0), 1.0)
+        with self._lock:
+            while self._updates and self._updates[0]['update_id'] < offset:
+                self._updates.popleft()
+            ready = [u for u in self._updates if u['update_id'] >= offset]
+        if not ready and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            with self._lock:
+                ready = [u for u in self._updates if u['update_id'] >= offset]
+        for update in ready:
+            if not update.get('_served'):
+                update['_served'] = True
+                self.expect_reply(update)
+        return [{k: v for k, v in u.items() if k != '_served'} for u in ready]
+
+    def _over_limit(self, chat_id):
+        """Count a send in the sliding windows, or return True when it would go over a limit."""
+        if self.chat_limit is None and self.global_limit is None:
+            return False
+        now = time.monotonic()
+        recent, in_chat = self._recent, self._recent_by_chat[chat_id]
+        for window in (recent, in_chat):
+            while window and window[0] <= now - self.window:
+                window.popleft()
+        if (self.global_limit is not None and len(recent) >= self.global_limit
+                or self.chat_limit is not None and len(in_chat) >= self.chat_limit):
+            return True
+        recent.append(now)
+        in_chat.append(now)
+        return False
+
+    def _send_message(self, params):
+        chat_id = int(params['chat_id'])
+        text = params.get('text', '')
+        now = time.perf_counter()
+        with self._lock:
+            self.sent.append((chat_id, text, now))
+            if self._served_at[chat_id]:
+                self.latencies.append(now - self._served_at[chat_id].popleft())
+        if self.on_reply:
+            more = self.on_reply(chat_id, text)
+            if more:
+                self.enqueue(more)
+        return {'message_id': len(self.sent), 'date': int(time.time()), 'text': text,
+                'chat': {'id': chat_id, 'type': 'private'}}
+
+    @staticmethod
+    def _ok(result):
+        return web.Response(text=json.dumps({'ok': True, 'result': result}), content_type='application/json')
+
+
+def _chat_id(update):
+    if 'message' in update:
+        return update['message']['chat']['id']
+    return update['callback_query']['message']['chat']['id']
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
@@ -0,0 +1,118 @@
+"""Handler latency under concurrent users, against a local fake Telegram API.
+
+Every simulated user sends its next update as soon as the previous reply arrives: mostly glucose
+readings, with every fifth update an "all" history request over a preloaded history. Latency is
+measured from the moment getUpdates hands an update to the bot until its reply reaches the API.
+
+Usage: python benchmarks/load_bot.py [sync|async] [updates_per_user] [history_rows]
+"""
+import asyncio
+import itertools
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_telegram import (FakeTelegram, make_callback_update, make_message_update,  # noqa: E402
+                                      percentile, use_fake_api)
+
+USER_COUNTS = (1, 10, 50, 100)
+
+# Shared across runs: the bot keeps its getUpdates offset between them
+update_ids = itertools.count(1)
+
+
+class ClosedLoopUsers:
+    def __init__(self, users, updates_per_user):
+        self.remaining = {user_id: updates_per_user for user_id in users}
+        self.pending_replies = len(self.remaining) * updates_per_user
+        self.finished_at = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def next_update(self, user_id):
+        with self._lock:
+            if self.remaining[user_id] == 0:
+                return None
+            self.remaining[user_id] -= 1
+            n = self.remaining[user_id]
+            update_id = next(update_ids)
+        if n % 5 == 4:
+            return make_callback_update(update_id, user_id, 'all')
+        return make_message_update(update_id, user_id, str(90 + n % 100))
+
+    def on_reply(self, chat_id, text):
+        with self._lock:
+            self.pending_replies -= 1
+            if not self.pending_replies:
+                self.finished_at = time.perf_counter()
+                self.done.set()
+        update = self.next_update(chat_id)
+        return [update] if update else None
+
+
+def preload(users, history_rows):
+    import database
+    now = int(time.time())
+    conn = database.get_connection()
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO user_inputs (ts, user_id, mg_dl, mmol_l) VALUES (?, ?, ?, ?)',
+                         ((now - 3600 - 300 * i, user_id, 100.0 + i % 80, 5.5)
+                          for user_id in users for i in range(history_rows)))
+
+
+def run_sync(api, users):
+    import main
+    thread = threading.Thread(target=main.bot.polling, kwargs={'non_stop': True, 'interval': 0, 'timeout': 1},
+                              daemon=True)
+    thread.start()
+    api.enqueue([users.next_update(user_id) for user_id in users.remaining])
+    users.done.wait()
+    main.bot.stop_polling()
+    thread.join()
+
+
+def run_async(api, users):
+    import async_main
+
+    async def drive():
+        polling = asyncio.create_task(async_main.bot.polling(non_stop=True, interval=0, timeout=1))
+        api.enqueue([users.next_update(user_id) for user_id in users.remaining])
+        await asyncio.get_running_loop().run_in_executor(None, users.done.wait)
+        await async_main.bot.close_session()
+        polling.cancel()
+
+    asyncio.run(drive())
+
+
+def main(mode='async', updates_per_user=20, history_rows=500):
+    import database
+    logging.disable(logging.INFO)
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_FILE = os.path.join(tmp, 'load.db')
+        database.init_db()
+        print(f"mode={mode}, {updates_per_user} updates per user, {history_rows} history rows per user")
+        print(f"{'users':>6}{'updates':>9}{'p50 ms':>9}{'p99 ms':>9}{'updates/s':>11}")
+        for n_users in USER_COUNTS:
+            user_ids = range(1000 * n_users, 1000 * n_users + n_users)
+            preload(user_ids, history_rows)
+            users = ClosedLoopUsers(user_ids, updates_per_user)
+            api = FakeTelegram(on_reply=users.on_reply).start()
+            use_fake_api(api.port)
+            start = time.perf_counter()
+            (run_sync if mode == 'sync' else run_async)(api, users)
+            elapsed = users.finished_at - start
+            api.stop()
+            lat = api.latencies
+            print(f"{n_users:>6}{len(lat):>9}{percentile(lat, 50) * 1000:>9.1f}{percentile(lat, 99) * 1000:>9.1f}"
+                  f"{len(lat) / elapsed:>11.0f}")
+        database.close_connections()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(*(args[:1] + [int(a) for a in args[1:3]]))
@@ -0,0 +1,108 @@
+"""Dispatcher mode end to end: replay updates through one receiver and 1, 2 and 4 worker processes.
+
+All updates are queued on a fake Telegram API up front. The receiver long-polls them with getUpdates
+and dispatches them to workers running the handlers from main.py against one temporary database; the
+workers' replies go back to the fake API. Reports the overall rate, every worker's share and rate, and
+whether each chat got its glucose confirmations in the order the readings were sent.
+
+Usage: python benchmarks/load_dispatcher.py [n_updates] [workers,...] [updates.jsonl]
+
+Without a file, synthetic updates from 50 users are used (every fifth one a "week" history request).
+The rate can only grow with the worker count on a machine with that many free cores.
+"""
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dispatcher  # noqa: E402
+from benchmarks.fake_telegram import FakeTelegram, make_message_update, percentile, use_fake_api  # noqa: E402
+from benchmarks.load_webhook import synthetic_updates  # noqa: E402
+
+TOKEN = '1:load-test'
+SAVED = re.compile(r'saved, which is (\d+(?:\.\d+)?) mg/dl')
+
+
+def worker_init(port):
+    use_fake_api(port)
+    logging.disable(logging.INFO)
+
+
+def replies_in_order(updates, sent):
+    """True when every chat's confirmations echo its numeric readings in the order they were sent."""
+    expected, got = defaultdict(list), defaultdict(list)
+    for update in updates:
+        text = update.get('message', {}).get('text', '')
+        if text.isnumeric():
+            expected[update['message']['chat']['id']].append(float(text))
+    for chat_id, text, _ in sent:
+        match = SAVED.search(text)
+        if match:
+            got[chat_id].append(float(match.group(1)))
+    return got == expected
+
+
+def run(updates, workers, tmp):
+    import database
+
+    # Workers are spawned, so they find the database through the environment
+    os.environ['T1D_DB_FILE'] = database.DB_FILE = os.path.join(tmp, f'dispatcher-{workers}.db')
+    database.init_db()
+    database.close_connections()
+    api = FakeTelegram().start()
+    use_fake_api(api.port)
+    # FakeTelegram marks the documents it serves, so every run gets fresh copies
+    api.enqueue([dict(update) for update in updates])
+    pool = dispatcher.Dispatcher('main:bot', workers, initializer=worker_init, initargs=(api.port,)).start()
+    try:
+        # Let every worker finish importing before the clock starts
+        warmup = [make_message_update(-1 - shard, shard, '/help') for shard in range(workers * 4)]
+        for update in warmup:
+            pool.dispatch(update)
+        pool.wait_idle(120)
+        before = {slot: figures['processed'] for slot, figures in pool.stats().items()}
+        sent_before, latencies_before = len(api.sent), len(api.latencies)
+
+        start = time.perf_counter()
+        offset = None
+        while pool.dispatched - len(warmup) < len(updates):
+            offset = dispatcher.receive(pool, TOKEN, offset, timeout=1)
+        pool.wait_idle()
+        elapsed = time.perf_counter() - start
+        stats = pool.stats()
+    finally:
+        pool.stop()
+        api.stop()
+    for slot, figures in stats.items():
+        figures['processed'] -= before.get(slot, 0)
+    return elapsed, stats, api.sent[sent_before:], api.latencies[latencies_before:]
+
+
+def main(n=2000, worker_counts='1,2,4', path=None):
+    logging.disable(logging.INFO)
+    if path:
+        with open(path) as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = list(synthetic_updates(n))
+
+    print(f"{len(updates)} updates, {os.cpu_count()} CPUs")
+    print(f"{'workers':>8}{'updates/s':>11}{'p50 ms':>9}{'p99 ms':>9}{'in order':>10}  per worker (processed, /s busy)")
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in (int(w) for w in str(worker_counts).split(',')):
+            elapsed, stats, sent, latencies = run(updates, workers, tmp)
+            shares = ', '.join(f"{f['processed']} @ {f['processed'] / max(f['busy_seconds'], 1e-9):.0f}"
+                               for f in stats.values())
+            print(f"{workers:>8}{len(updates) / elapsed:>11.0f}{percentile(latencies, 50) * 1000:>9.1f}"
+                  f"{percentile(latencies, 99) * 1000:>9.1f}{str(replies_in_order(updates, sent)):>10}  {shares}")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(*[int(a) for a in args[:1]], *args[1:3])
@@ -0,0 +1,121 @@
+"""Webhook mode end to end: POST updates at a fixed rate and measure ack and handler latency.
+
+Updates are POSTed to a local WebhookServer running the handlers from main.py, whose replies go to
+a fake Telegram API. "ack" is the time until the webhook answers the POST; "e2e" runs until the
+reply reaches the API.
+
+Usage: python benchmarks/load_webhook.py [rate_per_s] [seconds] [updates.jsonl]
+
+Without a file, synthetic updates from 50 users are used (every fifth one a "week" history request).
+"""
+import http.client
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_telegram import (FakeTelegram, make_callback_update, make_message_update,  # noqa: E402
+                                      percentile, use_fake_api)
+
+SECRET = 'load-test-secret'
+SENDERS = 8
+
+
+def synthetic_updates(n, users=50):
+    for i in range(n):
+        user_id = 1 + i % users
+        if i % 5 == 4:
+            yield make_callback_update(i + 1, user_id, 'week')
+        else:
+            yield make_message_update(i + 1, user_id, str(90 + i % 100))
+
+
+def post_all(port, updates, rate, api):
+    """POST ``updates`` spread evenly at ``rate`` per second from SENDERS threads; return ack latencies."""
+    acks, statuses = [], []
+    start = time.perf_counter()
+    lock = threading.Lock()
+    schedule = iter(enumerate(updates))
+
+    def sender():
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        while True:
+            with lock:
+                item = next(schedule, None)
+            if item is None:
+                break
+            i, update = item
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            body = json.dumps(update)
+            sent_at = time.perf_counter()
+            api.expect_reply(update, sent_at)
+            conn.request('POST', '/', body, {'Content-Type': 'application/json',
+                                             'X-Telegram-Bot-Api-Secret-Token': SECRET})
+            response = conn.getresponse()
+            response.read()
+            with lock:
+                acks.append(time.perf_counter() - sent_at)
+                statuses.append(response.status)
+        conn.close()
+
+    threads = [threading.Thread(target=sender) for _ in range(SENDERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return acks, statuses
+
+
+def main(rate=200, seconds=5, path=None):
+    import database
+    import main as bot_main
+    import webhook
+    logging.disable(logging.INFO)
+
+    if path:
+        with open(path) as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = list(synthetic_updates(int(rate * seconds)))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_FILE = os.path.join(tmp, 'webhook.db')
+        database.init_db()
+        api = FakeTelegram().start()
+        use_fake_api(api.port)
+        bot_main.bot.threaded = False
+        server = webhook.WebhookServer(bot_main.bot, '127.0.0.1', 0, '/', SECRET, workers=4, queue_size=1000)
+        server.start_workers()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        start = time.perf_counter()
+        acks, statuses = post_all(server.server_address[1], updates, rate, api)
+        post_elapsed = time.perf_counter() - start
+        deadline = time.monotonic() + 30
+        while len(api.latencies) < statuses.count(200) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        server.shutdown()
+        api.stop()
+        database.close_connections()
+
+    e2e = api.latencies
+    print(f"{len(updates)} updates offered at {rate}/s over {post_elapsed:.1f}s; "
+          f"status counts: { {s: statuses.count(s) for s in sorted(set(statuses))} }")
+    print(f"{'':<6}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for name, values in (('ack', acks), ('e2e', e2e)):
+        print(f"{name:<6}{percentile(values, 50) * 1000:>9.2f}{percentile(values, 99) * 1000:>9.2f}"
+              f"{max(values) * 1000:>9.2f}")
+    print(f"handled throughput: {len(e2e) / elapsed:.0f} updates/s")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    main(*[int(a) for a in args[:2]], *args[2:3])
@@ -0,0 +1,46 @@
+"""Deterministic synthetic Nightscout data for the analyzer benchmarks and tests.
+
+Entries are 5-minute CGM readings shaped like the API's JSON (``sgv``, ``date`` in ms,
+``dateString``); treatments are meal boluses around meal times and correction boluses in between.
+"""
+import math
+import random
+from datetime import datetime, timedelta, timezone
+
+STEP = timedelta(minutes=5)
+NS_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def ns_date(when: datetime) -> str:
+    return when.strftime(NS_DATE_FORMAT)
+
+
+def make_entries(n, start=START, seed=0):
+    rng = random.Random(seed)
+    entries = []
+    for i in range(n):
+        when = start + i * STEP
+        sgv = int(140 + 50 * math.sin(i / 40) + rng.gauss(0, 15))
+        entries.append({'_id': f'e{i}', 'type': 'sgv', 'device': 'synthetic', 'direction': 'Flat',
+                        'sgv': max(40, min(400, sgv)), 'date': int(when.timestamp() * 1000),
+                        'dateString': ns_date(when)})
+    return entries
+
+
+def make_treatments(days, start=START, corrections_per_day=4, seed=0):
+    """Three meal boluses a day plus ``corrections_per_day`` corrections at random times, in time order."""
+    rng = random.Random(seed)
+    treatments = []
+    for day in range(days):
+        midnight = start + timedelta(days=day)
+        for hour in (8, 13, 19):
+            when = midnight + timedelta(hours=hour, minutes=rng.randrange(0, 60, 5))
+            treatments.append({'eventType': 'Meal Bolus', 'created_at': ns_date(when),
+                               'insulin': round(rng.uniform(2, 8), 1), 'carbs': rng.randrange(20, 90)})
+        for _ in range(corrections_per_day):
+            when = midnight + timedelta(minutes=rng.randrange(0, 24 * 60, 5))
+            treatments.append({'eventType': 'Correction Bolus', 'created_at': ns_date(when),
+                               'insulin': round(rng.uniform(0.5, 3), 1)})
+    treatments.sort(key=lambda t: t['created_at'])
+    return treatments
@@ -0,0 +1,236 @@
+"""Benchmark suite for the bot's database and analytics hot paths, with a regression check.
+
+Every size is N users x D days of synthetic 5-minute readings (benchmarks/synthetic.py) loaded into
+a fresh temporary database; the Nightscout cases use one user's D days of entries and treatments.
+Each case is timed ``--repeat`` times per size and the results are written as JSON. With a baseline
+(by default benchmarks/baseline.json, written with --save-baseline) the best time of every case is
+compared against it and the run fails when one is slower by more than ``--threshold``.
+
+Runs offline: Telegram sends go to a stub and nothing talks to Nightscout.
+
+Usage: python benchmarks/suite.py [--sizes 1x30,10x90] [--repeat 5] [--output results.json]
+                                  [--baseline FILE] [--threshold 0.25] [--save-baseline]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+from benchmarks.synthetic import make_nightscout, make_readings  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = '1x30,10x90,10x365'
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+DEFAULT_OUTPUT = os.path.join(BENCH_DIR, 'results.json')
+DEFAULT_THRESHOLD = 0.25
+# Cases faster than this are too noisy to flag
+MIN_COMPARABLE_SECONDS = 50e-6
+INSERTS = 100
+
+CASES = []
+
+
+def case(name, ops=1):
+    """Register a hot path; ``fn(ctx)`` runs it once, performing ``ops`` operations."""
+    def register(fn):
+        CASES.append((name, fn, ops))
+        return fn
+    return register
+
+
+class StubBot:
+    """Stands in for main.bot so the send paths run without Telegram."""
+
+    def send_message(self, chat_id, text, **kwargs):
+        return None
+
+
+@case('insert_data', ops=INSERTS)
+def bench_insert_data(ctx):
+    # A user of its own with fresh timestamps, so every insert is a real write
+    ts = ctx['next_ts']
+    ctx['next_ts'] += INSERTS
+    for i in range(INSERTS):
+        database.insert_data(ctx['users'] + 1, 120.0, 6.66, ts + i)
+
+
+@case('select_history_data')
+def bench_select_history_data(ctx):
+    database.select_history_data(1, ctx['now'] - 30 * 86400, ctx['now'])
+
+
+@case('get_avg')
+def bench_get_avg(ctx):
+    ctx['main'].get_avg(1, '60')
+
+
+@case('send_history_data')
+def bench_send_history_data(ctx):
+    ctx['main'].send_history_data(1, 1, 'month')
+
+
+@case('user_stats')
+def bench_user_stats(ctx):
+    ctx['stats'].user_stats(1, ctx['now'] - 90 * 86400, ctx['now'])
+
+
+@case('analyzer_load')
+def bench_analyzer_load(ctx):
+    analyzer = ctx['analyzer']
+    analyzer.entries, analyzer.treatments = ctx['entries'], ctx['treatments']
+
+
+@case('analyze_data')
+def bench_analyze_data(ctx):
+    ctx['analyzer'].analyze_data()
+
+
+@case('iob_series')
+def bench_iob_series(ctx):
+    analyzer = ctx['analyzer']
+    analyzer.iob_series(analyzer.entries.date / 1000)
+
+
+@case('predict_glucose')
+def bench_predict_glucose(ctx):
+    ctx['analyzer'].predict_glucose(hours_ahead=3)
+
+
+def parse_sizes(text):
+    return [tuple(int(part) for part in size.split('x')) for size in text.split(',') if size]
+
+
+def timed(fn, ctx, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(ctx)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run(sizes, repeat=5, progress=print):
+    """Time every case at every (users, days) size; returns {'meta': ..., 'results': {key: figures}}."""
+    import main as bot_main
+    import stats
+    from drafts.isf import NightscoutAnalyzer
+
+    logging.disable(logging.INFO)
+    results = {}
+    db_file, bot = database.DB_FILE, bot_main.bot
+    bot_main.bot = StubBot()
+    # The cases time the queries behind a reply, not repeated hits on the reply cache
+    bot_main.reply_cache.enabled = False
+    try:
+        for users, days in sizes:
+            now = int(time.time())
+            with tempfile.TemporaryDirectory() as tmp:
+                database.close_connections()
+                database.DB_FILE = os.path.join(tmp, 'bench.db')
+                database.init_db()
+                conn = database.get_connection()
+                start = time.perf_counter()
+                with conn:
+                    conn.executemany('INSERT INTO user_inputs (ts, user_id, mg_dl, mmol_l) VALUES (?, ?, ?, ?)',
+                                     make_readings(users, days, now))
+                load_seconds = time.perf_counter() - start
+                rows = users * days * 288
+                results[f'bulk_load[{users}x{days}]'] = {'users': users, 'days': days, 'ops': rows,
+                                                         'min': load_seconds, 'median': load_seconds, 'repeat': 1}
+                entries, treatments = make_nightscout(days, now)
+                ctx = {'users': users, 'days': days, 'now': now, 'next_ts': now + 1, 'main': bot_main,
+                       'stats': stats, 'entries': entries, 'treatments': treatments,
+                       'analyzer': NightscoutAnalyzer('http://localhost')}
+                bench_analyzer_load(ctx)
+                for name, fn, ops in CASES:
+                    times = timed(fn, ctx, repeat)
+                    results[f'{name}[{users}x{days}]'] = {'users': users, 'days': days, 'ops': ops,
+                                                         'min': min(times), 'median': statistics.median(times),
+                                                         'repeat': repeat}
+                progress(f"{users} users x {days} days ({rows} readings) done")
+                database.close_connections()
+    finally:
+        database.close_connections()
+        database.DB_FILE, bot_main.bot = db_file, bot
+        bot_main.reply_cache.enabled = True
+        logging.disable(logging.NOTSET)
+    meta = {'created': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count(), 'repeat': repeat,
+            'sizes': [f'{users}x{days}' for users, days in sizes]}
+    return {'meta': meta, 'results': results}
+
+
+def compare(current, baseline, threshold=DEFAULT_THRESHOLD):
+    """Return [(key, baseline s, current s, ratio)] of the cases slower than baseline by more than threshold.
+
+    Best times are compared, as the least noisy figure; cases missing from either run are skipped.
+    """
+    regressions = []
+    for key, figures in current['results'].items():
+        before = baseline['results'].get(key)
+        if before is None or max(figures['min'], before['min']) < MIN_COMPARABLE_SECONDS:
+            continue
+        ratio = figures['min'] / before['min']
+        if ratio > 1 + threshold:
+            regressions.append((key, before['min'], figures['min'], ratio))
+    return regressions
+
+
+def report(current, baseline=None):
+    print(f"{'case':<36}{'best, ms':>12}{'median, ms':>12}{'per op, µs':>12}{'vs baseline':>13}")
+    for key, figures in current['results'].items():
+        before = baseline['results'].get(key) if baseline else None
+        change = f"{figures['min'] / before['min'] - 1:+.0%}" if before else ''
+        print(f"{key:<36}{figures['min'] * 1000:>12.3f}{figures['median'] * 1000:>12.3f}"
+              f"{figures['min'] / figures['ops'] * 1e6:>12.2f}{change:>13}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma-separated USERSxDAYS (default %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='results JSON (default %(default)s)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline JSON (default %(default)s)')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed slowdown before a case counts as a regression (default %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results as the new baseline')
+    args = parser.parse_args(argv)
+
+    current = run(parse_sizes(args.sizes), args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump(current, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(current, f, indent=2)
+        report(current)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(current, baseline)
+    if baseline is None:
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create one")
+        return 0
+    regressions = compare(current, baseline, args.threshold)
+    for key, before, after, ratio in regressions:
+        print(f"REGRESSION {key}: {before * 1000:.3f} ms -> {after * 1000:.3f} ms ({ratio:.2f}x)")
+    print(f"{len(regressions)} regressions above {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
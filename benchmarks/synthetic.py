@@ -0,0 +1,35 @@
+"""Deterministic synthetic data for N users x D days: bot readings plus Nightscout entries/treatments.
+
+Readings are 5-minute CGM values shaped like user_inputs rows (ts, user_id, mg_dl, mmol_l) ending at
+``end``; every user gets their own seed, so the same (users, days, end) always gives the same rows.
+Treatments are the meal and correction boluses of nightscout_data.make_treatments.
+"""
+import math
+import random
+from datetime import datetime, timezone
+
+from benchmarks.nightscout_data import STEP, make_entries, make_treatments
+
+STEP_SECONDS = int(STEP.total_seconds())
+
+
+def glucose(i, rng):
+    """A daily swing plus noise, clamped to the CGM range."""
+    return max(40, min(400, int(140 + 50 * math.sin(i / 40) + rng.gauss(0, 15))))
+
+
+def make_readings(users, days, end, seed=0):
+    """Yield user_inputs rows for ``users`` users (ids 1..users), newest reading at ``end`` (epoch seconds)."""
+    end -= end % STEP_SECONDS
+    per_user = days * 24 * 3600 // STEP_SECONDS
+    for user_id in range(1, users + 1):
+        rng = random.Random(seed * 100003 + user_id)
+        for i in range(per_user):
+            mg_dl = glucose(i, rng)
+            yield end - i * STEP_SECONDS, user_id, float(mg_dl), round(mg_dl / 18.0182, 2)
+
+
+def make_nightscout(days, end, seed=0):
+    """(entries, treatments) API documents for one user's ``days`` days up to ``end`` (epoch seconds)."""
+    start = datetime.fromtimestamp(end - end % STEP_SECONDS - days * 24 * 3600, tz=timezone.utc)
+    return make_entries(days * 24 * 3600 // STEP_SECONDS, start, seed), make_treatments(days, start, seed=seed)
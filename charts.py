@@ -0,0 +1,126 @@
+# charts.py
+"""Glucose charts for the history periods.
+
+PNGs are rendered with matplotlib in a pool of worker processes, so drawing never holds the GIL of
+the process that handles updates. Once a chart has been uploaded, Telegram's file_id for it is kept
+in an LRU cache keyed by (user_id, period, data marker): a repeated tap resends the file_id without
+rendering, and any new reading changes the marker so the next tap renders a fresh chart.
+"""
+import io
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import metrics
+from stats import TARGET_HIGH, TARGET_LOW
+
+DEFAULT_WORKERS = 2
+DEFAULT_CACHE_SIZE = 1024
+# Relative periods ("1 day") move with the clock, so a cached chart is only reused for this long
+DEFAULT_MAX_AGE = 3600
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def render_chart(ts: np.ndarray, mg_dl: np.ndarray, title: str) -> bytes:
+    """Draw the readings with the target range shaded and return the PNG bytes."""
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.dates import AutoDateLocator, ConciseDateFormatter
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(8, 4), dpi=100)
+    ax = figure.subplots()
+    ax.axhspan(TARGET_LOW, TARGET_HIGH, color='tab:green', alpha=0.15)
+    times = ts.astype('datetime64[s]') + np.timedelta64(time.localtime().tm_gmtoff, 's')
+    ax.plot(times, mg_dl, '.-', markersize=3, linewidth=0.8, color='tab:blue')
+    locator = AutoDateLocator()
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(ConciseDateFormatter(locator))
+    ax.set_ylabel('mg/dl')
+    ax.set_title(title)
+    ax.grid(alpha=0.3)
+    figure.tight_layout()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+def render_pool(workers=DEFAULT_WORKERS) -> ProcessPoolExecutor:
+    """The shared rendering pool, started on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers)
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+def submit_render(ts, mg_dl, title):
+    """Render on the worker pool; returns a concurrent.futures.Future of the PNG bytes."""
+    return render_pool().submit(render_chart, ts, mg_dl, title)
+
+
+class ChartCache:
+    """Thread-safe LRU map of chart keys to Telegram file_ids, bounded to ``max_entries``.
+
+    Entries older than ``max_age`` seconds count as misses.
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE, max_age=DEFAULT_MAX_AGE, name='charts'):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[1] > self.max_age:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, file_id):
+        with self._lock:
+            self._entries[key] = (file_id, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def counters(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def register_metrics(self):
+        """Expose the size and hit rate as gauges (also listed by /perf)."""
+        metrics.registry.gauge('cache_entries', lambda: len(self), 'Entries in a cache', cache=self.name)
+        metrics.registry.gauge('cache_hit_rate', lambda: round(self.counters()['hit_rate'], 3),
+                               'Share of cache lookups that were hits', cache=self.name)
+        return self
+
+
+chart_cache = ChartCache().register_metrics()
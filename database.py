@@ -1,61 +1,486 @@
 # database.py
+import atexit
+import logging
 import os
 import sqlite3
-from typing import List, Tuple
+import threading
+import time
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+
+import metrics
+from migrations import DAILY_STATS_FROM_TIERS, SECONDS_PER_DAY, USER_INPUTS_DDL, migrate
+
+DB_FILE = os.environ.get('T1D_DB_FILE',
+                         os.path.join(os.path.dirname(os.path.abspath(__file__)), 'user_inputs.db'))
+
+# Pragmas applied to every long-lived connection. WAL lets readers run alongside the writer,
+# synchronous=NORMAL is durable across application crashes in WAL mode and only fsyncs on checkpoint.
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-8000',
+    'PRAGMA temp_store=MEMORY',
+)
+# Size of the per-connection prepared statement cache (sqlite3 default is 128).
+CACHED_STATEMENTS = 256
+# A rollup bucket read in place of the readings it replaced: its start time and mean, in the
+# (ts, user_id, mg_dl, mmol_l) shape of a reading
+ROLLUP_ROW = 'ts, user_id, ROUND(sum_mg_dl / n, 1), ROUND(sum_mg_dl / n / 18.0182, 2)'
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_known_tables = set()
+_writer = None
+_write_listeners = []
 
 
 def create_connection():
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    db_file = os.path.join(current_dir, 'user_inputs.db')
-    conn = sqlite3.connect(db_file)
+    conn = sqlite3.connect(DB_FILE)
     return conn
 
 
-def create_table(table_name):
-    conn = create_connection()
-    c = conn.cursor()
-    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
-    if c.fetchone():
-        pass
-    else:
-        c.execute('''CREATE TABLE {} (timestamp TIMESTAMP, user_id INTEGER, mg_dl REAL, mmol_l REAL)'''.format(table_name))
-        print(f"Table {table_name} has been created.")
-    conn.close()
+def get_connection():
+    """Return the calling thread's long-lived connection, opening it on first use."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE, cached_statements=CACHED_STATEMENTS, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        _local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+
+def close_connections():
+    """Close every pooled connection, e.g. on shutdown or after switching DB_FILE."""
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+        _known_tables.clear()
+    _local.__dict__.clear()
 
 
-def insert_data(user_id, mg_dl, mmol_l, timestamp=None, table_name='user_inputs'):
+def init_db(table_name='user_inputs'):
+    """Run schema setup and pending migrations once at startup so the query functions can skip it."""
+    migrate(get_connection())
     create_table(table_name)
-    conn = create_connection()
-    c = conn.cursor()
-    if timestamp is None:
-        c.execute("INSERT INTO {} (timestamp, user_id, mg_dl, mmol_l) VALUES (datetime('now'), ?, ?, ?)".format(table_name), (user_id, mg_dl, mmol_l))
+
+
+def create_table(table_name):
+    conn = get_connection()
+    with conn:
+        conn.execute(USER_INPUTS_DDL.format(table_name))
+    _known_tables.add(table_name)
+
+
+def to_epoch(value) -> int:
+    """Convert a datetime, ISO string or number to integer epoch seconds.
+
+    Naive datetimes and strings are taken as local time, like datetime.timestamp() does.
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return int(value.timestamp())
+
+
+def _ensure_table(table_name):
+    if table_name not in _known_tables:
+        init_db(table_name)
+
+
+class BufferedWriter:
+    """Write-behind queue for readings, flushed with one executemany transaction per batch.
+
+    A background thread flushes when ``max_batch`` readings are queued or the oldest one has waited
+    ``max_delay`` seconds. flush() is a barrier: it returns once everything queued before it is committed.
+    A batch that fails to commit goes back to the head of the queue and flush() raises the error; the
+    background thread retries it after ``max_delay``. After ``max_retries`` failures in a row the batch
+    is dropped and counted in ``dropped_rows``.
+    """
+
+    def __init__(self, max_batch=500, max_delay=1.0, table_name='user_inputs', max_retries=3):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.table_name = table_name
+        self.max_retries = max_retries
+        self.flushed_rows = 0
+        self.flushed_batches = 0
+        self.failed_batches = 0
+        self.dropped_rows = 0
+        self._failures = 0
+        self._buffer = []
+        self._pending = {}
+        self._first_queued_at = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='BufferedWriter', daemon=True)
+        self._thread.start()
+
+    def add(self, user_id, mg_dl, mmol_l, ts):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('BufferedWriter is closed')
+            self._buffer.append((ts, user_id, mg_dl, mmol_l))
+            self._pending[user_id] = self._pending.get(user_id, 0) + 1
+            if self._first_queued_at is None:
+                self._first_queued_at = time.monotonic()
+            if len(self._buffer) >= self.max_batch:
+                self._cond.notify()
+
+    def queue_depth(self):
+        return len(self._buffer)
+
+    def has_pending(self, user_id=None):
+        with self._cond:
+            return bool(self._pending) if user_id is None else user_id in self._pending
+
+    def flush(self):
+        """Commit everything queued so far and wait until it is visible to readers."""
+        with self._write_lock:
+            with self._cond:
+                batch, self._buffer = self._buffer, []
+                self._first_queued_at = None
+            if batch:
+                self._write(batch)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+
+    def _write(self, batch):
+        requeued = False
+        try:
+            conn = get_connection()
+            with conn:
+                conn.executemany(f"INSERT OR IGNORE INTO {self.table_name} (ts, user_id, mg_dl, mmol_l) "
+                                 f"VALUES (?, ?, ?, ?)", batch)
+        except sqlite3.Error:
+            self.failed_batches += 1
+            with self._cond:
+                self._failures += 1
+                if self._failures <= self.max_retries:
+                    # Ahead of anything queued since, so the rows are still committed in order
+                    self._buffer[:0] = batch
+                    self._first_queued_at = time.monotonic()
+                    requeued = True
+                else:
+                    self._failures = 0
+                    self.dropped_rows += len(batch)
+            if not requeued:
+                logger.error(f'Dropped {len(batch)} buffered readings after {self.max_retries + 1} failed writes')
+                metrics.registry.inc('write_behind_dropped_rows_total', len(batch),
+                                     'Buffered readings dropped after failed writes')
+            raise
+        else:
+            self._failures = 0
+            self.flushed_rows += len(batch)
+            self.flushed_batches += 1
+        finally:
+            if not requeued:
+                # Committed or dropped: either way no longer pending, so reads stop waiting for it
+                with self._cond:
+                    for _, user_id, _, _ in batch:
+                        self._pending[user_id] -= 1
+                        if not self._pending[user_id]:
+                            del self._pending[user_id]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if len(self._buffer) >= self.max_batch:
+                        break
+                    if self._first_queued_at is not None:
+                        remaining = self._first_queued_at + self.max_delay - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+                closed = self._closed
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # Requeued, and retried once max_delay has passed
+                logger.exception('Failed to flush buffered readings')
+            if closed:
+                return
+
+
+def enable_write_behind(max_batch=500, max_delay=1.0):
+    """Route insert_data through a BufferedWriter. It is flushed on disable_write_behind() and at exit."""
+    global _writer
+    if _writer is None:
+        _ensure_table('user_inputs')
+        _writer = BufferedWriter(max_batch=max_batch, max_delay=max_delay)
+        metrics.registry.gauge('queue_depth', _writer.queue_depth, 'Items waiting in a queue', queue='write_behind')
+        atexit.register(disable_write_behind)
+    return _writer
+
+
+def disable_write_behind():
+    """Flush and stop the write-behind queue; insert_data writes synchronously again."""
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        metrics.registry.remove_gauge('queue_depth', queue='write_behind')
+        writer.close()
+
+
+def flush_writes():
+    """Barrier: return once every reading passed to insert_data so far is committed."""
+    if _writer is not None:
+        _writer.flush()
+
+
+def _read_barrier(user_id=None):
+    # Reads must see the caller's own earlier writes, so flush if that user still has queued readings
+    if _writer is not None and _writer.has_pending(user_id):
+        _writer.flush()
+
+
+def add_write_listener(listener):
+    """Call ``listener(user_id)`` after readings of that user are stored or queued, e.g. to drop cached replies."""
+    _write_listeners.append(listener)
+
+
+def remove_write_listener(listener):
+    if listener in _write_listeners:
+        _write_listeners.remove(listener)
+
+
+def notify_write(user_ids):
+    """Tell the write listeners that the readings of ``user_ids`` changed."""
+    for listener in _write_listeners:
+        for user_id in user_ids:
+            try:
+                listener(user_id)
+            except Exception:
+                logger.exception(f'Write listener failed for user {user_id}')
+
+
+def _collect_users(rows, user_ids):
+    for row in rows:
+        user_ids.add(row[1])
+        yield row
+
+
+@metrics.timed_query
+def insert_data(user_id, mg_dl, mmol_l, timestamp=None, table_name='user_inputs') -> Optional[bool]:
+    """Store one reading; returns whether it was stored, or None when it was queued by the write-behind.
+
+    A second reading from the same user within the same second is ignored, and so are readings older
+    than the user's compacted horizon (retention.py); both return False. The daily_stats buckets are
+    updated by trigger in the same transaction. With write-behind enabled the reading is queued and
+    committed with the next batch, so whether it is a duplicate is not known yet.
+    """
+    _ensure_table(table_name)
+    ts = int(time.time()) if timestamp is None else to_epoch(timestamp)
+    if _writer is not None and table_name == _writer.table_name:
+        _writer.add(user_id, mg_dl, mmol_l, ts)
+        stored = None
     else:
-        c.execute("INSERT INTO {} (timestamp, user_id, mg_dl, mmol_l) VALUES (?, ?, ?, ?)".format(table_name), (timestamp, user_id, mg_dl, mmol_l))
-    conn.commit()
-    conn.close()
+        conn = get_connection()
+        with conn:
+            stored = conn.execute(f"INSERT OR IGNORE INTO {table_name} (ts, user_id, mg_dl, mmol_l) "
+                                  f"VALUES (?, ?, ?, ?)", (ts, user_id, mg_dl, mmol_l)).rowcount > 0
+    if stored is not False:
+        notify_write((user_id,))
+    return stored
 
 
+@metrics.timed_query
+def insert_readings(rows, table_name='user_inputs') -> int:
+    """Store a batch of (ts, user_id, mg_dl, mmol_l) rows in one transaction; returns how many were new.
+
+    Rows whose (user_id, ts) is already stored are skipped, and so are rows older than the user's
+    compacted horizon.
+    """
+    _ensure_table(table_name)
+    user_ids = set()
+    conn = get_connection()
+    with conn:
+        cursor = conn.executemany(f"INSERT OR IGNORE INTO {table_name} (ts, user_id, mg_dl, mmol_l) "
+                                  "VALUES (?, ?, ?, ?)", _collect_users(rows, user_ids))
+    notify_write(user_ids)
+    return cursor.rowcount
+
+
+def _iter_tiers(conn, table_name, user_id, date_from=None, date_to=None, before=None, after=None):
+    """Yield one user's rows in the range from every storage tier that holds part of it, newest first.
+
+    Readings older than the user's compacted horizon live in the 15-minute and hourly rollups
+    (retention.py) and come back as one row per bucket, after the raw readings. The tiers hold
+    disjoint periods, so the keyset cursors work across them; with ``after`` every tier is read oldest
+    first, in reverse order. Each tier's query only starts once the previous one is exhausted.
+    """
+    where, params = ['user_id=?'], [user_id]
+    for op, value in (('>=', date_from), ('<=', date_to), ('<', before), ('>', after)):
+        if value is not None:
+            where.append(f'ts {op} ?')
+            params.append(to_epoch(value))
+    where = ' AND '.join(where)
+    order = 'ASC' if after is not None else 'DESC'
+    queries = [f'SELECT * FROM {table_name} WHERE {where} ORDER BY ts {order}']
+    horizon = None
+    if table_name == 'user_inputs':
+        horizon = conn.execute('SELECT raw_before, rollup_before FROM retention_state WHERE user_id=?',
+                               (user_id,)).fetchone()
+    if horizon is not None:
+        low = max((to_epoch(value) for value in (date_from, after) if value is not None), default=None)
+        for table, newest in (('rollup_15m', horizon[0]), ('rollup_1h', horizon[1])):
+            if low is None or low < newest:
+                queries.append(f'SELECT {ROLLUP_ROW} FROM {table} WHERE {where} ORDER BY ts {order}')
+    if after is not None:
+        queries.reverse()
+    for query in queries:
+        c = conn.execute(query, params)
+        try:
+            yield from c
+        finally:
+            c.close()
+
+
+@metrics.timed_query
 def select_all_data(user_id: int = None, table_name='user_inputs'):
-    create_table(table_name)
-    conn = create_connection()
-    c = conn.cursor()
+    """Return one user's rows from every tier, newest first, or every raw reading of all users."""
+    _ensure_table(table_name)
+    _read_barrier(user_id or None)
+    conn = get_connection()
     if user_id:
-        c.execute("SELECT * FROM ? WHERE user_id=?", (table_name, user_id,))
+        rows = list(_iter_tiers(conn, table_name, user_id))
     else:
-        q = f"SELECT * FROM {table_name}"
-        c.execute(q)
-    rows = c.fetchall()
-    conn.close()
+        rows = conn.execute(f"SELECT * FROM {table_name}").fetchall()
+    metrics.add_rows(len(rows))
     return rows
 
 
-def select_history_data(user_id: int, date_from: str, date_to: str, table_name='user_inputs') -> List[Tuple]:
-    create_table(table_name)
-    conn = create_connection()
-    c = conn.cursor()
-    q = f'SELECT * FROM {table_name} ' \
-        f'WHERE user_id={user_id} AND timestamp BETWEEN ? AND ? ORDER BY timestamp DESC'
-    c.execute(q, (date_from, date_to))
-    rows = c.fetchall()
-    conn.close()
+@metrics.timed_query
+def select_history_data(user_id: int, date_from, date_to, table_name='user_inputs') -> List[Tuple]:
+    """Return (ts, user_id, mg_dl, mmol_l) rows for one user between two points in time, newest first.
+
+    Compacted periods are covered by rollup bucket rows, see _iter_tiers.
+    """
+    _ensure_table(table_name)
+    _read_barrier(user_id)
+    rows = list(_iter_tiers(get_connection(), table_name, user_id, date_from, date_to))
+    metrics.add_rows(len(rows))
     return rows
+
+
+@metrics.timed_query
+def iter_history_data(user_id: int, date_from=None, date_to=None, before=None, after=None,
+                      table_name='user_inputs') -> Iterator[Tuple]:
+    """Lazily yield (ts, user_id, mg_dl, mmol_l) rows for one user, newest first.
+
+    ``before``/``after`` are keyset cursors: only rows strictly older than ``before`` or strictly newer
+    than ``after`` are returned, and with ``after`` the rows come oldest first. Every combination is a
+    single range scan of the (user_id, ts) key per storage tier, so a page deep in the history costs the
+    same as the first one; periods older than the user's compacted horizon come from the rollups, one
+    row per bucket. Rows are stepped out of SQLite as they are consumed; closing the generator ends
+    the query.
+    """
+    _ensure_table(table_name)
+    _read_barrier(user_id)
+    yield from _iter_tiers(get_connection(), table_name, user_id, date_from, date_to, before, after)
+
+
+@metrics.timed_query
+def select_daily_means(user_id: int, date_from=None, date_to=None) -> List[Tuple]:
+    """Return one (day start ts, user_id, mean mg_dl, mean mmol_l) row per UTC day with readings, newest first.
+
+    Read from daily_stats, which counts the readings of every storage tier, so it costs O(days) however
+    many readings the user has. Days overlapping the window are included whole.
+    """
+    _ensure_table('user_inputs')
+    _read_barrier(user_id)
+    where, params = ['user_id=?'], [user_id]
+    for op, value in (('>=', date_from), ('<=', date_to)):
+        if value is not None:
+            where.append(f'day {op} ?')
+            params.append(to_epoch(value) // SECONDS_PER_DAY)
+    rows = get_connection().execute(
+        f"SELECT day * {SECONDS_PER_DAY}, user_id, ROUND(sum_mg_dl / n, 1), ROUND(sum_mg_dl / n / 18.0182, 2) "
+        f"FROM daily_stats WHERE {' AND '.join(where)} ORDER BY day DESC", params).fetchall()
+    metrics.add_rows(len(rows))
+    return rows
+
+
+@metrics.timed_query
+def select_data_marker(user_id: int) -> Tuple[int, int]:
+    """Return (newest ts, reading count) for one user: changes whenever readings are added or removed.
+
+    One primary key lookup plus the user's daily_stats buckets, so it is cheap enough to check on every
+    request that serves cached results.
+    """
+    _ensure_table('user_inputs')
+    _read_barrier(user_id)
+    conn = get_connection()
+    newest = conn.execute("SELECT MAX(ts) FROM user_inputs WHERE user_id=?", (user_id,)).fetchone()[0]
+    count = conn.execute("SELECT TOTAL(n) FROM daily_stats WHERE user_id=?", (user_id,)).fetchone()[0]
+    return newest or 0, int(count)
+
+
+@metrics.timed_query
+def select_window_stats(user_id: int, days=None) -> Tuple[int, float, float]:
+    """Return (count, sum, sum of squares) of mg/dL readings over the last ``days`` UTC days including today.
+
+    Reads O(days) daily_stats buckets instead of the raw readings; ``days=None`` covers all the user's data.
+    """
+    _ensure_table('user_inputs')
+    _read_barrier(user_id)
+    conn = get_connection()
+    if days is None:
+        c = conn.execute("SELECT COUNT(*), TOTAL(n), TOTAL(sum_mg_dl), TOTAL(sumsq_mg_dl) FROM daily_stats "
+                         "WHERE user_id=?", (user_id,))
+    else:
+        day_from = int(time.time()) // SECONDS_PER_DAY - int(days)
+        c = conn.execute("SELECT COUNT(*), TOTAL(n), TOTAL(sum_mg_dl), TOTAL(sumsq_mg_dl) FROM daily_stats "
+                         "WHERE user_id=? AND day >= ?", (user_id, day_from))
+    buckets, n, total, total_sq = c.fetchone()
+    metrics.add_rows(buckets)
+    return int(n), total, total_sq
+
+
+def check_daily_stats(tolerance=1e-6) -> List[Tuple]:
+    """Rebuild the daily buckets from user_inputs and the rollups and diff them against the stored ones.
+
+    Returns (user_id, day, stored, expected) for every bucket that differs; either side is None when the
+    bucket is missing there.
+    """
+    _ensure_table('user_inputs')
+    _read_barrier()
+    conn = get_connection()
+    expected = {(row[0], row[1]): row[2:] for row in conn.execute(DAILY_STATS_FROM_TIERS, (-2 ** 63, 2 ** 63 - 1))}
+    stored = {(row[0], row[1]): row[2:]
+              for row in conn.execute("SELECT user_id, day, n, sum_mg_dl, sumsq_mg_dl FROM daily_stats")}
+    mismatches = []
+    for key in sorted(expected.keys() | stored.keys()):
+        want, have = expected.get(key), stored.get(key)
+        if want is None or have is None or want[0] != have[0] or \
+                any(abs(a - b) > tolerance * max(1.0, abs(a)) for a, b in zip(want[1:], have[1:])):
+            mismatches.append((key[0], key[1], have, want))
+    return mismatches
+
+
+def rebuild_daily_stats():
+    """Recompute every daily bucket from user_inputs and the rollups in one transaction."""
+    _ensure_table('user_inputs')
+    _read_barrier()
+    conn = get_connection()
+    with conn:
+        conn.execute("DELETE FROM daily_stats")
+        conn.execute(f"INSERT INTO daily_stats (user_id, day, n, sum_mg_dl, sumsq_mg_dl) {DAILY_STATS_FROM_TIERS}",
+                     (-2 ** 63, 2 ** 63 - 1))
@@ -0,0 +1,197 @@
+# digest.py
+"""Daily digest: a summary of the previous UTC day sent to every user who asked for one.
+
+The figures of all subscribers come from a single grouped query. It walks digest_subscriptions in
+user order, range-scans each subscriber's day of readings on the (user_id, ts) key, and looks up
+their daily_stats buckets for the A1C estimate. Its cost is one pass over the day's readings plus an
+index seek per subscriber, not a round of queries per user.
+
+Messages are handed to ``send`` ``batch_size`` at a time; with the outbox that queues them at BULK
+priority, and its rate limits pace them behind interactive replies. Once every message of a batch
+has gone out (or failed), the batch's last user id is committed to digest_runs. An interrupted run
+therefore resumes after it, and only a batch in flight at the time can be sent twice.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from typing import NamedTuple, Optional
+
+from telebot import apihelper, asyncio_helper
+
+import database
+import metrics
+from migrations import SECONDS_PER_DAY
+from outbox import TokenBucket
+from stats import TARGET_HIGH, TARGET_LOW
+
+# Hour of the day (UTC) at which the digest of the previous day goes out
+DIGEST_HOUR = 7
+BATCH_SIZE = 200
+# Days of readings, ending with the digest day, that the A1C estimate averages
+A1C_DAYS = 60
+
+logger = logging.getLogger(__name__)
+
+# Failed sends of the sync and of the async bot
+TELEGRAM_ERRORS = (apihelper.ApiTelegramException, asyncio_helper.ApiTelegramException)
+
+FIGURES_QUERY = f'''SELECT s.user_id, s.chat_id, COUNT(*), AVG(u.mg_dl), SUM(u.mg_dl < {TARGET_LOW}),
+        SUM(u.mg_dl > {TARGET_HIGH}), MIN(u.mg_dl), MAX(u.mg_dl),
+        (SELECT TOTAL(d.sum_mg_dl) / TOTAL(d.n) FROM daily_stats d
+         WHERE d.user_id = s.user_id AND d.day BETWEEN ?1 - {A1C_DAYS - 1} AND ?1)
+    FROM digest_subscriptions s
+    JOIN user_inputs u ON u.user_id = s.user_id
+        AND u.ts >= ?1 * {SECONDS_PER_DAY} AND u.ts < (?1 + 1) * {SECONDS_PER_DAY}
+    WHERE s.user_id > ?2
+    GROUP BY s.user_id ORDER BY s.user_id'''
+
+
+class DigestFigures(NamedTuple):
+    user_id: int
+    chat_id: int
+    count: int  # readings on the day
+    mean: float  # mg/dL
+    below: int  # readings below TARGET_LOW
+    above: int  # readings above TARGET_HIGH
+    lowest: float
+    highest: float
+    a1c_mean: float  # mean mg/dL over the A1C_DAYS days ending with the day
+
+
+class DigestResult(NamedTuple):
+    sent: int
+    failed: int
+    finished: bool
+
+
+def subscribe(user_id: int, chat_id: int):
+    conn = database.get_connection()
+    with conn:
+        conn.execute('INSERT INTO digest_subscriptions (user_id, chat_id) VALUES (?, ?) '
+                     'ON CONFLICT (user_id) DO UPDATE SET chat_id = excluded.chat_id', (user_id, chat_id))
+
+
+def unsubscribe(user_id: int) -> bool:
+    """Stop the user's digest; returns whether they had one."""
+    conn = database.get_connection()
+    with conn:
+        return conn.execute('DELETE FROM digest_subscriptions WHERE user_id=?', (user_id,)).rowcount > 0
+
+
+def digest_figures(day: int, after: Optional[int] = None):
+    """DigestFigures of every subscriber with readings on UTC day ``day``, by user id; only after ``after``."""
+    database.flush_writes()
+    conn = database.get_connection()
+    rows = conn.execute(FIGURES_QUERY, (day, -2 ** 63 if after is None else after)).fetchall()
+    metrics.add_rows(len(rows))
+    return [DigestFigures(*row) for row in rows]
+
+
+def due_day(now=None, hour=DIGEST_HOUR) -> int:
+    """The UTC day whose digest is due at ``now``: yesterday once ``hour`` has passed, else the day before."""
+    now = time.time() if now is None else now
+    today = int(now) // SECONDS_PER_DAY
+    return today - 1 if now - today * SECONDS_PER_DAY >= hour * 3600 else today - 2
+
+
+def day_label(day: int) -> str:
+    return datetime.fromtimestamp(day * SECONDS_PER_DAY, tz=timezone.utc).strftime('%Y-%m-%d')
+
+
+def _send_error(result) -> Optional[Exception]:
+    """Wait for a send to go out; returns what it raised, if anything."""
+    if isinstance(result, Future):
+        return result.exception()
+    return result if isinstance(result, Exception) else None
+
+
+def run_digest(day: int, send, format_message, batch_size=BATCH_SIZE, rate=None, stop=None) -> DigestResult:
+    """Send the digest of UTC day ``day``, resuming after the last batch a previous run committed.
+
+    ``send(chat_id, text)`` returns the sent message or a Future of it; ``format_message(day, figures)``
+    builds the text. ``rate`` (messages per second) paces sends that are not paced by an outbox.
+    ``stop`` is an optional threading.Event checked between batches; a stopped run is not finished.
+    """
+    conn = database.get_connection()
+    with conn:
+        conn.execute('INSERT OR IGNORE INTO digest_runs (day, last_user_id, sent, failed) VALUES (?, ?, 0, 0)',
+                     (day, -2 ** 63))
+    last_user_id, sent, failed, finished_at = conn.execute(
+        'SELECT last_user_id, sent, failed, finished_at FROM digest_runs WHERE day=?', (day,)).fetchone()
+    if finished_at is not None:
+        return DigestResult(sent, failed, True)
+
+    figures = digest_figures(day, after=last_user_id)
+    logger.info(f'Sending the digest of {day_label(day)} to {len(figures)} users')
+    bucket = TokenBucket(rate, 1, time.monotonic()) if rate else None
+    for start in range(0, len(figures), batch_size):
+        if stop is not None and stop.is_set():
+            return DigestResult(sent, failed, False)
+        batch = figures[start:start + batch_size]
+        pending = []
+        for row in batch:
+            if bucket is not None:
+                time.sleep(bucket.wait_time(time.monotonic()))
+                bucket.take(time.monotonic())
+            try:
+                result = send(row.chat_id, format_message(day, row))
+            except Exception as e:
+                result = e
+            pending.append((row, result))
+        batch_sent = batch_failed = 0
+        for row, result in pending:
+            error = _send_error(result)
+            if error is None:
+                batch_sent += 1
+                continue
+            batch_failed += 1
+            if isinstance(error, TELEGRAM_ERRORS) and error.error_code == 403:
+                # Blocked by the user or removed from the chat
+                unsubscribe(row.user_id)
+            logger.warning(f'Digest for user {row.user_id} not sent: {error}')
+        with conn:
+            conn.execute('UPDATE digest_runs SET last_user_id=?, sent=sent+?, failed=failed+? WHERE day=?',
+                         (batch[-1].user_id, batch_sent, batch_failed, day))
+        sent += batch_sent
+        failed += batch_failed
+        metrics.registry.inc('digest_messages_total', batch_sent, 'Daily digest messages', status='sent')
+        metrics.registry.inc('digest_messages_total', batch_failed, 'Daily digest messages', status='failed')
+    with conn:
+        conn.execute('UPDATE digest_runs SET finished_at=? WHERE day=?', (int(time.time()), day))
+    logger.info(f'Digest of {day_label(day)}: {sent} sent, {failed} failed')
+    return DigestResult(sent, failed, True)
+
+
+class DigestJob:
+    """Runs the due digest on a daemon thread: at start (finishing an interrupted run) and daily at ``hour``."""
+
+    def __init__(self, send, format_message, hour=DIGEST_HOUR, **options):
+        self.send = send
+        self.format_message = format_message
+        self.hour = hour
+        self.options = options
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='DigestJob', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                run_digest(due_day(hour=self.hour), self.send, self.format_message, stop=self._stop, **self.options)
+            except Exception:
+                logger.exception('Daily digest failed')
+            # Next due time: today's hour if it is still ahead, else tomorrow's
+            now = time.time()
+            next_run = int(now) // SECONDS_PER_DAY * SECONDS_PER_DAY + self.hour * 3600
+            if next_run <= now:
+                next_run += SECONDS_PER_DAY
+            self._stop.wait(next_run - now)
@@ -0,0 +1,299 @@
+# dispatcher.py
+"""Dispatcher serving mode: one receiver process feeding a pool of worker processes.
+
+The receiver long-polls getUpdates and routes each raw update to a shard, ``hash(user_id) % shards``.
+Every shard is owned by one worker, which runs the bot's handlers on its updates one at a time,
+so a user's updates stay in order while different users are handled on different cores.
+
+Workers report every finished update on their own results pipe. Until then the update is in flight
+for that worker. A monitor thread reads the pipes and waits on the worker processes. When one dies,
+its shards are reassigned, either to a replacement process or, without respawning, to the live
+worker owning the fewest shards. Its in-flight updates are delivered again to the new owner before
+anything newer for those shards. Pipe writes are synchronous, so the oldest in-flight update is the
+one the worker was handling when it died; it is charged an attempt and dropped as poison after
+``max_attempts``. The updates queued behind it are redelivered as they were.
+"""
+import importlib
+import logging
+import multiprocessing
+import multiprocessing.connection
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+import metrics
+from webhook import update_user_id
+
+logger = logging.getLogger(__name__)
+
+POLL_TIMEOUT = 20
+MONITOR_INTERVAL = 0.1
+# Seconds to wait after a failed getUpdates, doubling with every failure in a row up to MAX_RETRY_DELAY
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+
+def load_bot(spec):
+    """Resolve a "module:attribute" bot spec, e.g. "main:bot"."""
+    module, attribute = spec.split(':')
+    return getattr(importlib.import_module(module), attribute)
+
+
+def _worker_main(inbox, results, bot_spec, initializer, initargs):
+    """Worker process: run the bot's handlers on each update from ``inbox``, report it on ``results``."""
+    from telebot.types import Update
+
+    if initializer is not None:
+        initializer(*initargs)
+    bot = load_bot(bot_spec)
+    # Handlers run inline, one update at a time, which keeps each user's updates ordered
+    bot.threaded = False
+    while True:
+        update = inbox.get()
+        if update is None:
+            return
+        start = time.perf_counter()
+        ok = True
+        try:
+            bot.process_new_updates([Update.de_json(update)])
+        except Exception:
+            ok = False
+            logger.exception(f'Failed to process update {update.get("update_id")}')
+        results.send((update['update_id'], time.perf_counter() - start, ok))
+
+
+class Worker:
+    """Parent-side state of one worker slot."""
+
+    def __init__(self, slot, process, inbox, results):
+        self.slot = slot
+        self.process = process
+        self.inbox = inbox
+        self.results = results
+        # update_id -> (update, workers it has crashed), in delivery order
+        self.in_flight = OrderedDict()
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.started_at = time.monotonic()
+
+
+class Dispatcher:
+    """Routes updates to ``workers`` processes over ``shards`` user shards (default 4 per worker).
+
+    ``bot_spec`` names the bot whose handlers the workers run ("module:attribute"), imported in each
+    worker; ``initializer(*initargs)`` runs in a worker before that. Workers are started with the
+    ``start_method`` multiprocessing context; "spawn" keeps them from inheriting the receiver's
+    threads and database connections.
+    """
+
+    def __init__(self, bot_spec='main:bot', workers=4, shards=None, respawn=True, max_attempts=2,
+                 start_method='spawn', initializer=None, initargs=()):
+        self.bot_spec = bot_spec
+        self.n_workers = workers
+        self.n_shards = shards or 4 * workers
+        self.respawn = respawn
+        self.max_attempts = max_attempts
+        self.initializer = initializer
+        self.initargs = initargs
+        self.crashes = 0
+        self.dropped = 0
+        self.dispatched = 0
+        self._context = multiprocessing.get_context(start_method)
+        self._workers = {}
+        # shard -> worker slot
+        self.assignment = {shard: shard % workers for shard in range(self.n_shards)}
+        self._lock = threading.RLock()
+        self._idle = threading.Condition(self._lock)
+        self._stopping = False
+        self._monitor = threading.Thread(target=self._monitor_loop, name='dispatcher-monitor', daemon=True)
+
+    def start(self):
+        with self._lock:
+            for slot in range(self.n_workers):
+                self._spawn(slot)
+        self._monitor.start()
+        return self
+
+    def _spawn(self, slot):
+        inbox = self._context.Queue()
+        results, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_worker_main, name=f'dispatcher-worker-{slot}', daemon=True,
+            args=(inbox, sender, self.bot_spec, self.initializer, self.initargs))
+        process.start()
+        # Only the worker holds the writing end, so the pipe reads EOF once it exits
+        sender.close()
+        self._workers[slot] = Worker(slot, process, inbox, results)
+        metrics.registry.gauge('queue_depth', lambda: len(self._workers[slot].in_flight),
+                               'Items waiting in a queue', queue=f'dispatcher_worker_{slot}')
+        logger.info(f'Started dispatcher worker {slot} (pid {process.pid})')
+
+    def shard_of(self, update):
+        return hash(update_user_id(update)) % self.n_shards
+
+    def dispatch(self, update: dict):
+        """Queue an update on the worker owning its user's shard."""
+        with self._lock:
+            if not self._workers:
+                raise RuntimeError('Every dispatcher worker has exited')
+            self._deliver(self._workers[self.assignment[self.shard_of(update)]], update, 0)
+            self.dispatched += 1
+
+    def _deliver(self, worker, update, crashed):
+        worker.in_flight[update['update_id']] = (update, crashed)
+        worker.inbox.put(update)
+
+    def in_flight(self):
+        with self._lock:
+            return sum(len(worker.in_flight) for worker in self._workers.values())
+
+    def wait_idle(self, timeout=None):
+        """Block until every dispatched update has been handled or dropped; False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._idle:
+            while any(worker.in_flight for worker in self._workers.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining if remaining is not None else MONITOR_INTERVAL)
+            return True
+
+    def _monitor_loop(self):
+        while not self._stopping:
+            with self._lock:
+                owners = {}
+                for worker in self._workers.values():
+                    owners[worker.results] = owners[worker.process.sentinel] = worker
+            ready = multiprocessing.connection.wait(list(owners), MONITOR_INTERVAL)
+            with self._lock:
+                if self._stopping:
+                    break
+                for worker in dict.fromkeys(owners[handle] for handle in ready):
+                    if self._workers.get(worker.slot) is not worker:
+                        continue
+                    self._drain(worker)
+                    if not worker.process.is_alive():
+                        self._recover(worker)
+                self._idle.notify_all()
+
+    def _drain(self, worker):
+        """Settle every result the worker has written so far."""
+        while worker.results.poll():
+            try:
+                update_id, seconds, ok = worker.results.recv()
+            except EOFError:
+                return
+            worker.in_flight.pop(update_id, None)
+            worker.processed += 1
+            worker.failed += not ok
+            worker.busy_seconds += seconds
+            metrics.registry.histogram('dispatcher_update_seconds', 'Update handling time in a dispatcher worker',
+                                       worker=str(worker.slot)).observe(seconds)
+
+    def _recover(self, dead):
+        """Reassign a dead worker's shards and deliver its in-flight updates again."""
+        self.crashes += 1
+        shards = [shard for shard, slot in self.assignment.items() if slot == dead.slot]
+        logger.error(f'Dispatcher worker {dead.slot} (pid {dead.process.pid}) exited with code '
+                     f'{dead.process.exitcode}; reassigning {len(shards)} shards')
+        metrics.registry.inc('dispatcher_worker_crashes_total', help_text='Dispatcher worker crashes')
+        dead.process.join(0)
+        dead.results.close()
+        if self.respawn:
+            self._spawn(dead.slot)
+        else:
+            del self._workers[dead.slot]
+            metrics.registry.remove_gauge('queue_depth', queue=f'dispatcher_worker_{dead.slot}')
+            if not self._workers:
+                logger.error('Every dispatcher worker has exited')
+                self.dropped += len(dead.in_flight)
+                return
+            for shard in shards:
+                owned = {slot: 0 for slot in self._workers}
+                for slot in self.assignment.values():
+                    if slot in owned:
+                        owned[slot] += 1
+                self.assignment[shard] = min(owned, key=owned.get)
+        for position, (update, crashed) in enumerate(dead.in_flight.values()):
+            if position == 0:
+                crashed += 1  # the update being handled when the worker died
+                if crashed >= self.max_attempts:
+                    self.dropped += 1
+                    logger.error(f'Dropping update {update["update_id"]} after {crashed} crashed attempts')
+                    continue
+            self._deliver(self._workers[self.assignment[self.shard_of(update)]], update, crashed)
+
+    def stats(self):
+        """Per-worker figures: pid, shards owned, updates handled and their rate since the worker started."""
+        with self._lock:
+            now = time.monotonic()
+            return {slot: {'pid': worker.process.pid,
+                           'shards': sum(1 for owner in self.assignment.values() if owner == slot),
+                           'processed': worker.processed, 'failed': worker.failed,
+                           'in_flight': len(worker.in_flight),
+                           'per_second': worker.processed / max(now - worker.started_at, 1e-9),
+                           'busy_seconds': worker.busy_seconds}
+                    for slot, worker in sorted(self._workers.items())}
+
+    def stop(self, timeout=10):
+        """Let the workers finish what they were given, then stop them."""
+        self.wait_idle(timeout)
+        with self._lock:
+            self._stopping = True
+            workers = list(self._workers.values())
+        for worker in workers:
+            worker.inbox.put(None)
+        for worker in workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            metrics.registry.remove_gauge('queue_depth', queue=f'dispatcher_worker_{worker.slot}')
+        self._monitor.join()
+        for worker in workers:
+            worker.results.close()
+
+
+def receive(dispatcher, token, offset=None, timeout=POLL_TIMEOUT):
+    """Long-poll one getUpdates batch and dispatch it; returns the offset to poll from next."""
+    from telebot import apihelper
+
+    for update in apihelper.get_updates(token, offset=offset, timeout=timeout, long_polling_timeout=timeout):
+        dispatcher.dispatch(update)
+        offset = update['update_id'] + 1
+    return offset
+
+
+def serve(token, bot_spec='main:bot', workers=4, report_every=60, **kwargs):
+    """Receive updates in this process and dispatch them until interrupted.
+
+    A failed getUpdates (Bot API error, network error or timeout) is logged and retried after a
+    growing delay; updates already dispatched are not affected.
+    """
+    from telebot import apihelper
+
+    dispatcher = Dispatcher(bot_spec, workers, **kwargs).start()
+    apihelper.delete_webhook(token)
+    offset, last_report, delay = None, time.monotonic(), RETRY_DELAY
+    logger.info(f'Dispatching updates to {workers} worker processes')
+    try:
+        while True:
+            try:
+                offset = receive(dispatcher, token, offset)
+            except (apihelper.ApiException, requests.RequestException) as e:
+                logger.error(f'Polling for updates failed, retrying in {delay}s: {e}')
+                metrics.registry.inc('dispatcher_poll_errors_total', help_text='Failed getUpdates calls')
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                continue
+            delay = RETRY_DELAY
+            if time.monotonic() - last_report >= report_every:
+                last_report = time.monotonic()
+                for slot, figures in dispatcher.stats().items():
+                    logger.info(f'Worker {slot}: {figures}')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dispatcher.stop()
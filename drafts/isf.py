@@ -1,98 +1,462 @@
 import re
+import os
+import csv
 import sys
+import math
+import time
+import pickle
+import hashlib
+import inspect
 import logging
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import requests
+from bisect import bisect_left
 from datetime import datetime, timedelta, timezone
 
-from sklearn.model_selection import train_test_split
-from sklearn.ensemble import RandomForestRegressor
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+US_PER_SECOND = 10 ** 6
+NS_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+DEFAULT_DIA_HOURS = 4.5
+
+# A backtest target reading may be this much later than the forecast time it stands for
+BACKTEST_TOLERANCE_MS = 5 * 60 * 1000
+
+# Corrections closer than this to a meal bolus, before or after, are left out of the ISF estimate
+MEAL_WINDOW_SECONDS = 4 * 3600
+
+
+def linear_curve(elapsed_hours, dia_hours):
+    """Fraction of a bolus still on board: straight line from 1 at injection to 0 at the end of DIA."""
+    return 1 - elapsed_hours / dia_hours
+
+
+class ExponentialCurve:
+    """Exponential insulin activity curve (as used by OpenAPS) with its peak at ``peak_minutes``.
+
+    A class rather than a closure so analyzers using it can be shipped to backtest worker processes.
+    """
+
+    def __init__(self, peak_minutes=75):
+        self.peak_minutes = peak_minutes
+
+    def __repr__(self):
+        return f"ExponentialCurve(peak_minutes={self.peak_minutes!r})"
+
+    def __call__(self, elapsed_hours, dia_hours):
+        t, td, tp = elapsed_hours * 60, dia_hours * 60, self.peak_minutes
+        tau = tp * (1 - tp / td) / (1 - 2 * tp / td)
+        a = 2 * tau / td
+        scale = 1 / (1 - a + (1 + a) * np.exp(-td / tau))
+        return 1 - scale * (1 - a) * ((t ** 2 / (tau * td * (1 - a)) - t / tau - 1) * np.exp(-t / tau) + 1)
+
+
+def exponential_curve(peak_minutes=75):
+    """Curve function for NightscoutAnalyzer(iob_curve=...); DIA should be well above twice the peak."""
+    return ExponentialCurve(peak_minutes)
+
+
+def curve_key(curve):
+    """Description of an IOB curve that is the same in every run, for model keys.
+
+    Module-level functions are named by module and qualified name and ExponentialCurve by its peak.
+    Other callables (lambdas, closures) fall back to repr, which holds their address: models fitted
+    with them are never shared with another curve, but neither are they found again in a later run.
+    """
+    if inspect.isfunction(curve) and '<' not in curve.__qualname__:
+        return f"{curve.__module__}.{curve.__qualname__}"
+    return repr(curve)
+
+
+class ModelRegistry:
+    """Trained models keyed by the version of the data they were fitted on.
+
+    Models are kept in memory and, with a ``directory``, pickled to disk so another run on the same
+    data skips training; only the ``keep`` most recently used files are kept. ``fits`` and
+    ``fit_seconds`` show how often training actually ran.
+    """
+
+    def __init__(self, directory=None, keep=8):
+        self.directory = directory
+        self.keep = keep
+        self.models = {}
+        self.fits = 0
+        self.fit_seconds = 0.0
+        self.hits = 0
+        self.disk_hits = 0
+        self.logger = logging.getLogger(self.__class__.__name__)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"model-{hashlib.sha1(key.encode()).hexdigest()}.pkl")
+
+    def get_or_fit(self, key, fit):
+        if key in self.models:
+            self.hits += 1
+            return self.models[key]
+        if self.directory and os.path.exists(self._path(key)):
+            with open(self._path(key), 'rb') as f:
+                model = pickle.load(f)
+            os.utime(self._path(key))
+            self.disk_hits += 1
+        else:
+            start = time.perf_counter()
+            model = fit()
+            elapsed = time.perf_counter() - start
+            self.fits += 1
+            self.fit_seconds += elapsed
+            self.logger.info(f"Fitted model for data version {key} in {elapsed:.2f}s (fit #{self.fits})")
+            if self.directory:
+                self._save(key, model)
+        # Only the newest data version is useful in memory
+        self.models = {key: model}
+        return model
+
+    def _save(self, key, model):
+        tmp_path = self._path(key) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path(key))
+        files = sorted((os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                        if name.startswith('model-') and name.endswith('.pkl')), key=os.path.getmtime, reverse=True)
+        for path in files[self.keep:]:
+            os.remove(path)
+
+    def stats(self):
+        return {'fits': self.fits, 'fit_seconds': round(self.fit_seconds, 3), 'hits': self.hits,
+                'disk_hits': self.disk_hits}
+
+
+def epoch_us(date_str):
+    """Parse a Nightscout ISO date into integer epoch microseconds (UTC when it has no offset)."""
+    when = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return (when - EPOCH) // MICROSECOND
+
+
+def format_ns_date(us):
+    return (EPOCH + timedelta(microseconds=int(us))).strftime(NS_DATE_FORMAT)
+
+
+class EntryColumns(Sequence):
+    """CGM readings as typed columns, sorted by time.
+
+    ``time`` is the dateString as int64 epoch microseconds, ``date`` the API's int64 epoch milliseconds
+    and ``sgv`` float32 mg/dL: 20 bytes a reading, where the API's JSON document takes about a
+    kilobyte as a dict. Dates are parsed once, when the columns are built. Indexing returns a
+    document shaped like the API's (sgv, date, dateString); slicing returns columns sharing the arrays.
+    """
+
+    dtype = np.dtype([('time', np.int64), ('date', np.int64), ('sgv', np.float32)])
+
+    def __init__(self, time=None, date=None, sgv=None):
+        self.time = np.empty(0, np.int64) if time is None else time
+        self.date = np.empty(0, np.int64) if date is None else date
+        self.sgv = np.empty(0, np.float32) if sgv is None else sgv
+
+    @staticmethod
+    def row(doc):
+        """(time, date, sgv) of an entry document; None for documents without a reading.
+
+        Also usable as a json ``object_hook``, so a response is never held as a list of dicts.
+        """
+        sgv, date, date_string = doc.get('sgv'), doc.get('date'), doc.get('dateString')
+        if sgv is None or (date is None and not date_string):
+            return None
+        time = epoch_us(date_string) if date_string else int(date) * 1000
+        return time, int(date) if date is not None else time // 1000, sgv
+
+    @classmethod
+    def from_rows(cls, rows):
+        data = np.fromiter((row for row in rows if row is not None), dtype=cls.dtype)
+        data = data[np.argsort(data['time'], kind='stable')]
+        return cls(*(np.ascontiguousarray(data[field]) for field in cls.dtype.names))
+
+    @classmethod
+    def from_documents(cls, documents):
+        return cls.from_rows(map(cls.row, documents))
+
+    @classmethod
+    def from_cache(cls, rows):
+        """Columns of (date, sgv, date_string) rows of the ns_entries cache, e.g. a cursor."""
+        return cls.from_rows((epoch_us(date_string) if date_string else date * 1000, date, sgv)
+                             for date, sgv, date_string in rows)
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return EntryColumns(self.time[key], self.date[key], self.sgv[key])
+        i = range(len(self))[key]
+        sgv = float(self.sgv[i])
+        return {'sgv': int(sgv) if sgv.is_integer() else sgv, 'date': int(self.date[i]),
+                'dateString': format_ns_date(self.time[i])}
+
+    def copy(self):
+        return self[:]
+
+    def extend(self, documents):
+        new = EntryColumns.from_documents(documents)
+        self.time, self.date, self.sgv = (np.concatenate((getattr(self, f), getattr(new, f))) for f in self.dtype.names)
+        if len(new) and len(self) > len(new) and new.time[0] < self.time[-len(new) - 1]:
+            order = np.argsort(self.time, kind='stable')
+            self.time, self.date, self.sgv = self.time[order], self.date[order], self.sgv[order]
+
+    def append(self, document):
+        self.extend([document])
+
+
+class TreatmentColumns(Sequence):
+    """Treatments as typed columns, in the order given.
+
+    ``time`` is created_at as int64 epoch microseconds, ``event`` an int16 code into ``event_types``
+    and ``insulin`` float64 units, NaN when absent. Indexing returns a document with created_at,
+    eventType and insulin.
+    """
+
+    dtype = np.dtype([('time', np.int64), ('event', np.int16), ('insulin', np.float64)])
+
+    def __init__(self, time=None, event=None, insulin=None, event_types=()):
+        self.time = np.empty(0, np.int64) if time is None else time
+        self.event = np.empty(0, np.int16) if event is None else event
+        self.insulin = np.empty(0, np.float64) if insulin is None else insulin
+        self.event_types = tuple(event_types)
+        self._derived = {}
+
+    @staticmethod
+    def row(doc):
+        """(time, eventType, insulin) of a treatment document; None without created_at.
+
+        Insulin that is missing or not a number (Nightscout stores whatever the uploader sent) is NaN.
+        """
+        created_at = doc.get('created_at')
+        if not created_at or not isinstance(created_at, str):
+            return None
+        return epoch_us(created_at), doc.get('eventType'), TreatmentColumns.units(doc.get('insulin'))
+
+    @staticmethod
+    def units(insulin):
+        try:
+            return float(insulin)
+        except (TypeError, ValueError):
+            return math.nan
+
+    @classmethod
+    def from_rows(cls, rows, event_types=()):
+        codes = {event: code for code, event in enumerate(event_types)}
+        data = np.fromiter(((time, codes.setdefault(event, len(codes)), insulin)
+                            for time, event, insulin in (row for row in rows if row is not None)), dtype=cls.dtype)
+        return cls(*(np.ascontiguousarray(data[field]) for field in cls.dtype.names), event_types=codes)
+
+    @classmethod
+    def from_documents(cls, documents, event_types=()):
+        return cls.from_rows(map(cls.row, documents), event_types)
+
+    @classmethod
+    def from_cache(cls, rows, event_types=()):
+        """Columns of (created_at, event_type, insulin, carbs) rows of the ns_treatments cache, e.g. a cursor."""
+        return cls.from_rows(((epoch_us(created_at), event_type, cls.units(insulin))
+                              for created_at, event_type, insulin, _ in rows), event_types)
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return TreatmentColumns(self.time[key], self.event[key], self.insulin[key], self.event_types)
+        i = range(len(self))[key]
+        insulin = float(self.insulin[i])
+        return {'created_at': format_ns_date(self.time[i]), 'eventType': self.event_types[self.event[i]],
+                'insulin': None if math.isnan(insulin) else insulin}
+
+    def copy(self):
+        return self[:]
+
+    def extend(self, documents):
+        new = TreatmentColumns.from_documents(documents, self.event_types)
+        self.time, self.event, self.insulin = (np.concatenate((getattr(self, f), getattr(new, f)))
+                                               for f in self.dtype.names)
+        self.event_types = new.event_types
+        self._derived = {}
+
+    def append(self, document):
+        self.extend([document])
+
+    def is_event(self, event_type):
+        """Boolean mask of the treatments of one event type."""
+        if event_type not in self.event_types:
+            return np.zeros(len(self), dtype=bool)
+        return self.event == self.event_types.index(event_type)
+
+    def meal_times(self):
+        """Sorted epoch microseconds of the meal boluses."""
+        if 'meals' not in self._derived:
+            self._derived['meals'] = np.sort(self.time[self.is_event('Meal Bolus')])
+        return self._derived['meals']
+
+    def boluses(self):
+        """(epoch seconds, units) of every treatment with insulin, sorted by time."""
+        if 'boluses' not in self._derived:
+            given = ~np.isnan(self.insulin) & (self.insulin != 0)
+            order = np.argsort(self.time[given], kind='stable')
+            self._derived['boluses'] = (self.time[given][order] / US_PER_SECOND, self.insulin[given][order])
+        return self._derived['boluses']
 
 
 class NightscoutAnalyzer:
-    def __init__(self, url, token=None):
+    def __init__(self, url, token=None, meal_window=MEAL_WINDOW_SECONDS, dia_hours=DEFAULT_DIA_HOURS,
+                 iob_curve=linear_curve, models=None):
         self.url = url
         self.token = token
-        self.entries = []
-        self.treatments = []
+        self._entries = EntryColumns()
+        self._treatments = TreatmentColumns()
+        self.meal_window = meal_window
+        # Insulin on board: duration of insulin action and decay curve
+        self.dia_hours = dia_hours
+        self.iob_curve = iob_curve
+        self.models = models or ModelRegistry()
+        self.pinned_version = None
         self.logger = logging.getLogger(self.__class__.__name__)
+        # One keep-alive connection pool for every request to the site
+        self.session = requests.Session()
         self.headers = {}
         self.default_isf = 18 * 4
         if self.token:
             self.headers["Authorization"] = f"Bearer {self.token}"
 
-    def _fetch_from_endpoint(self, endpoint, params={}):
+    @property
+    def entries(self):
+        """CGM readings as EntryColumns; assign columns or any iterable of entry documents."""
+        return self._entries
+
+    @entries.setter
+    def entries(self, value):
+        self._entries = value.copy() if isinstance(value, EntryColumns) else EntryColumns.from_documents(value)
+
+    @property
+    def treatments(self):
+        """Treatments as TreatmentColumns; assign columns or any iterable of treatment documents."""
+        return self._treatments
+
+    @treatments.setter
+    def treatments(self, value):
+        self._treatments = value.copy() if isinstance(value, TreatmentColumns) else \
+            TreatmentColumns.from_documents(value)
+
+    def _fetch_from_endpoint(self, endpoint, params={}, object_hook=None):
         """Utility function to fetch data from Nightscout API endpoint."""
         try:
-            response = requests.get(f"{self.url}/api/v1/{endpoint}.json", headers=self.headers, params=params)
+            response = self.session.get(f"{self.url}/api/v1/{endpoint}.json", headers=self.headers, params=params)
             response.raise_for_status()
-            return response.json()
+            return response.json(object_hook=object_hook)
         except requests.RequestException as e:
             self.logger.error(f"Error fetching data from {endpoint}: {e}")
             return []
 
-    def fetch_data(self, start_time=None, end_time=None, count=1000):
-        params = {"count": count, "start": start_time, "end": end_time}
-        self.entries = sorted(self._fetch_from_endpoint('entries', params), key=lambda x: x.get('date', ''))
-        self.treatments = self._fetch_from_endpoint('treatments')
+    def fetch_data(self, start_time=None, end_time=None, count=1000, sync=None):
+        """Load entries and treatments for the period.
+
+        With a ``sync`` (a nightscout_sync.NightscoutSync for this site) only data newer than the last
+        sync is downloaded, and the period is read from the local cache; ``count`` is then ignored.
+        """
+        if sync is not None:
+            sync.sync()
+            # Cached rows go straight into the columns, without a document per row
+            entries, treatments = sync.rows(start_time, end_time)
+            self._entries, self._treatments = EntryColumns.from_cache(entries), TreatmentColumns.from_cache(treatments)
+        else:
+            # Responses are decoded straight into column rows, so the documents are never all held as dicts
+            params = {"count": count, "start": start_time, "end": end_time}
+            self.entries = EntryColumns.from_rows(
+                self._fetch_from_endpoint('entries', params, object_hook=EntryColumns.row))
+            self.treatments = TreatmentColumns.from_rows(
+                self._fetch_from_endpoint('treatments', object_hook=TreatmentColumns.row))
         self.logger.info(f"Fetched {len(self.entries)} entries and {len(self.treatments)} treatments")
-        self.logger.info(f"Entries: {self.entries if len(self.entries) < 10 else self.entries[:10]}")
-        self.logger.info(f"Treatments: {self.treatments if len(self.treatments) < 10 else self.treatments[:10]}")
+        self.logger.info(f"Entries: {list(self.entries[:10])}")
+        self.logger.info(f"Treatments: {list(self.treatments[:10])}")
         return False if not self.entries else True
 
     def analyze_data(self):
         """Calculate average ISF from correction periods."""
-        correction_periods = [
-            self._compute_isf(treatment)
-            for treatment in self.treatments
-            if treatment.get('eventType') == 'Correction Bolus' and not self._is_near_meal(treatment)
-        ]
+        corrections = self.treatments.is_event('Correction Bolus')
+        times, insulin = self.treatments.time[corrections], self.treatments.insulin[corrections]
+        far = ~self._near_meal_flags(times)
+        correction_periods = self._isf_values(times[far], insulin[far]).tolist()
         # Remove None values
-        correction_periods = [x for x in correction_periods if x is not None]
+        correction_periods = [x for x in correction_periods if not math.isnan(x)]
 
         average_isf = sum(correction_periods) / len(correction_periods) if correction_periods else None
         return average_isf
 
     def _parse_date(self, date_str):
         """Parse ISO formatted date string into datetime object."""
-        return datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
+        return datetime.strptime(date_str, NS_DATE_FORMAT).replace(tzinfo=timezone.utc)
 
     def _compute_isf(self, treatment):
         """Compute ISF (Insulin Sensitivity Factor) for a given treatment.
         ISF is the amount of glucose points that 1 unit of insulin will reduce.
         ISF = (start_glucose - end_glucose) / insulin
+        """
+        insulin = treatment.get('insulin')
+        isf = self._isf_values(np.array([epoch_us(treatment.get('created_at'))]),
+                               np.array([math.nan if insulin is None else insulin], dtype=np.float64))[0]
+        return None if math.isnan(isf) else float(isf)
+
+    def _isf_values(self, start_times, insulin):
+        """ISF of corrections given at ``start_times`` (epoch µs) with ``insulin`` units; NaN where unknown.
 
+        Start glucose is the entry at the start time, or else the first one after it; end glucose the
+        entry 4 hours later, or else the last one before that. Both are searchsorted lookups in the
+        entry time column. A zero reading counts as missing, like a missing one.
+        """
+        times, n = self.entries.time, len(self.entries)
+        if not n:
+            return np.full(len(start_times), np.nan)
+        sgv = self.entries.sgv.astype(np.float64)
+        end_times = start_times + 4 * 3600 * US_PER_SECOND
+
+        i = np.searchsorted(times, start_times, side='left')
+        at = np.minimum(i, n - 1)
+        exact = (i < n) & (times[at] == start_times) & (sgv[at] != 0)
+        i = np.where(exact, i, np.searchsorted(times, start_times, side='right'))
+        start_glucose = np.where(i < n, sgv[np.minimum(i, n - 1)], 0)
+
+        i = np.searchsorted(times, end_times, side='left')
+        at = np.minimum(i, n - 1)
+        exact = (i < n) & (times[at] == end_times) & (sgv[at] != 0)
+        i = np.where(exact, i, i - 1)
+        end_glucose = np.where(i >= 0, sgv[np.maximum(i, 0)], 0)
+
+        known = (start_glucose != 0) & (end_glucose != 0) & ~np.isnan(insulin) & (insulin != 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(known, (start_glucose - end_glucose) / insulin, np.nan)
+
+    def _near_meal_flags(self, times):
+        """For corrections at ``times`` (epoch µs), whether a meal bolus is within meal_window of each.
+
+        One searchsorted of every correction into the sorted meal times: the first meal after
+        ``time - meal_window`` is the only one that can be close enough.
         """
-        start_time = self._parse_date(treatment.get('created_at'))
-        end_time = start_time + timedelta(hours=4)
-
-        start_glucose = next((e['sgv'] for e in self.entries if self._parse_date(e.get('dateString')) == start_time), None)
-        # If there is no entry for the start time, use the first entry after the start time
-        if not start_glucose:
-            start_glucose = next((e['sgv'] for e in self.entries if self._parse_date(e.get('dateString')) > start_time), None)
-        end_glucose = next((e['sgv'] for e in self.entries if self._parse_date(e.get('dateString')) == end_time), None)
-        # If there is no entry for the end time, use the first entry before the end time
-        if not end_glucose:
-            # entries sorted by dateString
-            sorted_entries = sorted(self.entries, key=lambda x: x.get('dateString', ''), reverse=True)
-            end_glucose = next((e['sgv'] for e in sorted_entries if self._parse_date(e.get('dateString')) < end_time), None)
-
-        if start_glucose and end_glucose and treatment.get('insulin', 0) not in [0, None]:
-            return (start_glucose - end_glucose) / treatment.get('insulin')
-        return None
+        meals = self.treatments.meal_times()
+        window = round(self.meal_window * US_PER_SECOND)
+        if not len(meals):
+            return np.zeros(len(times), dtype=bool)
+        i = np.searchsorted(meals, times - window, side='right')
+        return (i < len(meals)) & (meals[np.minimum(i, len(meals) - 1)] - times < window)
 
     def _is_near_meal(self, treatment):
         """Check if the treatment is near a meal."""
-        treatment_time = self._parse_date(treatment.get('created_at'))
-        # Check if there is a meal bolus within 4 hours of the treatment
-        FOUR_HOURS_IN_SECONDS = 4 * 3600
-        return any(
-            t.get('eventType') == 'Meal Bolus' and abs(
-                (self._parse_date(t.get('created_at')) - treatment_time).total_seconds()) < FOUR_HOURS_IN_SECONDS
-            for t in self.treatments
-        )
-
-    def predict_glucose(self, hours_ahead=1):
-        current_glucose = self.entries[-1]['sgv'] if self.entries else None
+        return bool(self._near_meal_flags(np.array([epoch_us(treatment.get('created_at'))]))[0])
+
+    def predict_glucose(self, hours_ahead=1, now=None):
+        """Glucose ``hours_ahead`` hours after ``now`` (epoch seconds, default the current time)."""
+        current_glucose = float(self.entries.sgv[-1]) if self.entries else None
         if not current_glucose:
             self.logger.warning("Insufficient data for prediction.")
             return None
@@ -101,10 +465,11 @@ class NightscoutAnalyzer:
         isf = self.analyze_data() or self.default_isf
 
         future_glucose = current_glucose
+        now = time.time() if now is None else now
 
         # Итеративно вычисляем уровень глюкозы для каждого часа вперед
         for hour in range(1, hours_ahead + 1):
-            future_iob = self.total_IOB_for_period(datetime.utcnow() + timedelta(hours=hour), self.calculate_dia())
+            future_iob = float(self.iob_series(np.array([now + hour * 3600]), self.calculate_dia())[0])
             glucose_change_due_to_insulin = future_iob * isf
             future_glucose -= glucose_change_due_to_insulin  # вычитаем, так как инсулин снижает уровень глюкозы
 
@@ -113,41 +478,67 @@ class NightscoutAnalyzer:
     def total_IOB_for_period(self, target_time, DIA_hours):
         # Make target_time offset-aware
         target_time = target_time.replace(tzinfo=timezone.utc)
-        insulin_entries = self._fetch_insulin_entries_for_period(target_time, DIA_hours)
-        return sum(self._compute_IOB(entry, target_time, DIA_hours) for entry in insulin_entries)
-
-    def _fetch_insulin_entries_for_period(self, end_time, duration_hours):
-        start_time = end_time - timedelta(hours=duration_hours)
-        return [entry for entry in self.treatments if entry.get('insulin') and start_time <= datetime.fromisoformat(
-            entry['created_at'].replace('Z', '+00:00')) <= end_time]
-
-    @staticmethod
-    def _compute_IOB(entry, target_time, DIA_hours):
-        time_since_injection = (target_time - datetime.fromisoformat(entry['created_at'].replace('Z', '+00:00'))).total_seconds() / 3600
-        return entry['insulin'] * (1 - (time_since_injection / DIA_hours)) if time_since_injection <= DIA_hours else 0
-
-    @staticmethod
-    def calculate_dia():
-        return 4.5  # Placeholder value
-
-    def combined_glucose_prediction(self, hours_ahead=1):
-        # Получаем текущие значения
-        current_glucose = self.entries[-1]['sgv'] if self.entries else None
-        if not current_glucose:
-            self.logger.warning("Insufficient data for prediction.")
-            return None
+        return float(self.iob_series(np.array([target_time.timestamp()]), DIA_hours)[0])
 
-        # Получаем ISF или используем дефолтное значение
-        isf = self.analyze_data() or self.default_isf
+    def iob_series(self, target_times, DIA_hours=None):
+        """Insulin on board at each of ``target_times`` (epoch seconds), in one vectorized pass.
 
-        # Готовим данные для обучения модели
-        timestamps = [entry.get('date', 0) for entry in self.entries if entry.get('date')]
-        glucose_values = [entry.get('sgv', 0) for entry in self.entries if entry.get('sgv')]
-        iob_values = [self.total_IOB_for_period(datetime.utcfromtimestamp(timestamp / 1000), self.calculate_dia()) for
-                      timestamp in timestamps]
+        A target's IOB is the sum of iob_curve over the boluses given in the DIA before it. The boluses
+        in each target's window are found with two searchsorted calls. For the linear curve the sum is
+        taken from prefix sums of units and units x time, so a whole series costs O((T + N) log N) for T
+        targets and N boluses; other curves are evaluated on the (target, bolus) pairs inside the windows.
+        """
+        dia = self.calculate_dia() if DIA_hours is None else DIA_hours
+        targets = np.asarray(target_times, dtype=np.float64)
+        times, units = self.treatments.boluses()
+        if not len(times) or not len(targets):
+            return np.zeros(len(targets))
+        # Relative to the first bolus, so the prefix sums of units x time stay small
+        origin = times[0]
+        times, targets = times - origin, targets - origin
+        dia_seconds = dia * 3600
+        lo = np.searchsorted(times, targets - dia_seconds, side='left')
+        hi = np.searchsorted(times, targets, side='right')
+        if self.iob_curve is linear_curve:
+            cum_units = np.concatenate(([0.0], np.cumsum(units)))
+            cum_unit_times = np.concatenate(([0.0], np.cumsum(units * times)))
+            total = cum_units[hi] - cum_units[lo]
+            weighted = cum_unit_times[hi] - cum_unit_times[lo]
+            return total - (targets * total - weighted) / dia_seconds
+        counts = hi - lo
+        target_idx = np.repeat(np.arange(len(targets)), counts)
+        bolus_idx = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+        elapsed_hours = (targets[target_idx] - times[bolus_idx]) / 3600
+        contributions = units[bolus_idx] * self.iob_curve(elapsed_hours, dia)
+        return np.bincount(target_idx, weights=contributions, minlength=len(targets))
+
+    def calculate_dia(self):
+        """Duration of insulin action in hours, set with the dia_hours constructor argument."""
+        return self.dia_hours
+
+    def data_version(self):
+        """Key of the data a model is trained on: last entry timestamp plus a hash of the treatment columns
+        and of the analyzer's parameters (DIA, IOB curve and meal window), which change the training features.
+
+        While ``pinned_version`` is set it is returned instead, so the current model keeps being used
+        as data arrives (the backtest's retrain cadence).
+        """
+        if self.pinned_version is not None:
+            return self.pinned_version
+        digest = hashlib.sha1(repr((self.dia_hours, curve_key(self.iob_curve), self.meal_window,
+                                    self.treatments.event_types)).encode())
+        for field in TreatmentColumns.dtype.names:
+            digest.update(getattr(self.treatments, field).tobytes())
+        last_date = int(self.entries.date[-1]) if self.entries else None
+        return f"{last_date}-{len(self.entries)}-{digest.hexdigest()[:16]}"
+
+    def _fit_model(self, timestamps, glucose_values, iob_values, isf):
+        # Imported on first fit: sklearn takes over a second to import, and the bot only needs the analyzer's data
+        from sklearn.ensemble import RandomForestRegressor
+        from sklearn.model_selection import train_test_split
 
         # Формируем массив признаков (timestamp, IOB, ISF) и целевую переменную (sgv)
-        X = list(zip(timestamps, iob_values, [isf] * len(timestamps)))
+        X = np.column_stack((timestamps, iob_values, np.full(len(timestamps), isf)))
         y = glucose_values
 
         # Разделяем на обучающую и тестовую выборки
@@ -159,50 +550,137 @@ class NightscoutAnalyzer:
         self.logger.debug(f"    Model score: {model.score(X_test, y_test)}")
         self.logger.debug(f"    Model feature importances: {model.feature_importances_}")
         self.logger.debug(f"    Model parameters: {model.get_params()}")
-        self.logger.debug(f"    Model estimators: {model.estimators_}")
-
-        # Предсказываем уровень глюкозы для каждого часа вперед
-        future_glucose = current_glucose
-        for hour in range(1, hours_ahead + 1):
-            future_timestamp = timestamps[-1] + hour * 3600 * 1000
-            future_iob = self.total_IOB_for_period(datetime.utcfromtimestamp(future_timestamp / 1000),
-                                                   self.calculate_dia())
-            prediction = model.predict([[future_timestamp, future_iob, isf]])
-            future_glucose += prediction[0] - current_glucose  # учитываем изменение
-
-        return future_glucose
+        return model
 
+    def combined_glucose_forecast(self, hours_ahead=1):
+        """Predicted glucose for each of the next ``hours_ahead`` hours, from one model.
 
-    def test_prediction(self, prediction_function, test_size=0.2):
-        # Разделить данные на обучающую и тестовую выборки
-        total_data_points = len(self.entries)
-        split_index = int((1 - test_size) * total_data_points)
-
-        train_entries = self.entries[:split_index]
-        test_entries = self.entries[split_index:]
+        The model is fitted once per data_version() and kept in self.models, so further calls on the
+        same data, for any horizon, reuse it.
+        """
+        # Получаем текущие значения
+        current_glucose = float(self.entries.sgv[-1]) if self.entries else None
+        if not current_glucose:
+            self.logger.warning("Insufficient data for prediction.")
+            return None
 
-        # Сохранить оригинальные данные и установить обучающую выборку
-        original_entries = self.entries
-        self.entries = train_entries
+        # Получаем ISF или используем дефолтное значение
+        isf = self.analyze_data() or self.default_isf
 
-        # Тестировать каждую точку в тестовой выборке
-        errors = []
-        for idx, entry in enumerate(test_entries[:-1]):
-            # Используем функцию предсказания для получения предсказанного значения уровня глюкозы
-            predicted_glucose = prediction_function(hours_ahead=1)
-            real_glucose = test_entries[idx + 1]['sgv']
-            error = abs(predicted_glucose - real_glucose)
-            errors.append(error)
+        # Готовим данные для обучения модели
+        timestamps, glucose_values = self.entries.date, self.entries.sgv
+        model = self.models.get_or_fit(
+            self.data_version(),
+            lambda: self._fit_model(timestamps, glucose_values, self.iob_series(timestamps / 1000), isf))
+
+        # Предсказываем уровень глюкозы для всех часов вперед одним вызовом модели
+        future_timestamps = timestamps[-1] + np.arange(1, hours_ahead + 1) * 3600 * 1000
+        future_iob = self.iob_series(future_timestamps / 1000)
+        predictions = model.predict(np.column_stack((future_timestamps, future_iob, np.full(hours_ahead, isf))))
+        # Каждый час добавляет своё изменение к предыдущему прогнозу
+        return (current_glucose + np.cumsum(predictions - current_glucose)).tolist()
 
-            # Добавляем текущую точку в обучающие данные для следующего шага
-            self.entries.append(entry)
+    def combined_glucose_prediction(self, hours_ahead=1):
+        forecast = self.combined_glucose_forecast(hours_ahead)
+        return forecast[-1] if forecast else None
 
-        # Восстановить оригинальные данные
-        self.entries = original_entries
 
-        # Вернуть среднюю ошибку
-        mean_error = sum(errors) / len(errors)
-        return mean_error
+    def test_prediction(self, prediction_function, test_size=0.2):
+        """Mean absolute error of 1-hour predictions over the last ``test_size`` of the entries."""
+        return self.backtest(prediction_function.__name__, test_size=test_size)[1]['mae']
+
+    def backtest(self, method='combined_glucose_forecast', test_size=0.2, horizons=1, retrain_every=1,
+                 workers=None, output=None):
+        """Walk-forward backtest of a prediction method over the last ``test_size`` of the entries.
+
+        At every test step the method sees only the entries before it and forecasts 1..``horizons``
+        hours ahead; each forecast is scored against the first reading at or just after its time.
+        The steps are split into contiguous folds that run on a process pool (``workers`` processes,
+        default one per CPU) over snapshots of the entry and treatment columns, so self.entries is never
+        touched.
+        Models are refitted every ``retrain_every`` steps; folds start on retrain boundaries, so
+        the fits are the same as in a serial run.
+
+        Returns {horizon: {'n', 'mae', 'rmse'}}. With ``output`` every step's forecasts are written there
+        as CSV (step, date, horizon, predicted, actual).
+        """
+        entries, treatments = self.entries.copy(), self.treatments.copy()
+        steps = list(range(int((1 - test_size) * len(entries)), len(entries)))
+        workers = workers or os.cpu_count() or 1
+        # Contiguous folds whose starts are retrain boundaries
+        blocks = [steps[i:i + retrain_every] for i in range(0, len(steps), retrain_every)]
+        per_fold = max(1, math.ceil(len(blocks) / workers))
+        folds = [[step for block in blocks[i:i + per_fold] for step in block] for i in range(0, len(blocks), per_fold)]
+        params = {'url': self.url, 'meal_window': self.meal_window, 'dia_hours': self.dia_hours,
+                  'iob_curve': self.iob_curve}
+        args = [(params, entries[:fold[-1] + 1], treatments, method, fold, horizons, retrain_every) for fold in folds]
+        if workers == 1 or len(folds) == 1:
+            results = [_backtest_fold(*a) for a in args]
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(folds))) as pool:
+                results = list(pool.map(_backtest_fold, *zip(*args)))
+
+        # Score against the full entry columns, which extend past each fold's snapshot
+        dates, sgv = entries.date.tolist(), entries.sgv.tolist()
+        rows = []
+        for fold in results:
+            for step, forecast in fold:
+                for horizon, predicted in enumerate(forecast, start=1):
+                    target = dates[step - 1] + horizon * 3600 * 1000
+                    i = bisect_left(dates, target)
+                    actual = sgv[i] if i < len(dates) and dates[i] - target <= BACKTEST_TOLERANCE_MS else None
+                    rows.append((step, dates[step - 1], horizon, predicted, actual))
+        if output:
+            with open(output, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(('step', 'date', 'horizon', 'predicted', 'actual'))
+                writer.writerows(rows)
+
+        summary = {}
+        for horizon in range(1, horizons + 1):
+            errors = [predicted - actual for _, _, h, predicted, actual in rows
+                      if h == horizon and predicted is not None and actual is not None]
+            summary[horizon] = {
+                'n': len(errors),
+                'mae': sum(abs(e) for e in errors) / len(errors) if errors else None,
+                'rmse': math.sqrt(sum(e * e for e in errors) / len(errors)) if errors else None,
+            }
+        return summary
+
+
+def _backtest_fold(params, entries, treatments, method, steps, horizons, retrain_every):
+    """Run one backtest fold in a fresh analyzer; returns [(step, [forecast per horizon])].
+
+    Each step is predicted as of its last reading: the analyzer holds the entries and the treatments up
+    to that moment, and methods taking ``now`` get its time rather than the wall clock.
+    """
+    analyzer = NightscoutAnalyzer(params['url'], meal_window=params['meal_window'], dia_hours=params['dia_hours'],
+                                  iob_curve=params['iob_curve'])
+    # Sorted by created_at, so the treatments up to a step are a prefix slice
+    order = np.argsort(treatments.time, kind='stable')
+    treatments = TreatmentColumns(treatments.time[order], treatments.event[order], treatments.insulin[order],
+                                  treatments.event_types)
+    predict = getattr(analyzer, method)
+    takes_now = 'now' in inspect.signature(predict).parameters
+    results, given = [], None
+    for n, step in enumerate(steps):
+        step_time = int(entries.time[step - 1])
+        # A prefix slice of the columns: views of the same arrays, nothing is copied
+        analyzer.entries = entries[:step]
+        known = int(np.searchsorted(treatments.time, step_time, side='right'))
+        if known != given:
+            # A new slice only when a treatment was added, so its derived arrays are computed once
+            analyzer.treatments, given = treatments[:known], known
+        if retrain_every > 1:
+            # A new version, and so a fresh fit, at the start of every block of retrain_every steps
+            analyzer.pinned_version = f"backtest-{steps[0]}-{n // retrain_every}"
+        options = {'now': step_time / US_PER_SECOND} if takes_now else {}
+        forecast = predict(hours_ahead=horizons, **options)
+        if not isinstance(forecast, list):
+            # The call above is the last horizon's forecast
+            forecast = [predict(hours_ahead=h, **options) for h in range(1, horizons)] + [forecast]
+        results.append((step, forecast))
+    return results
 
 
 def get_start_end_time(period=None):
@@ -245,9 +723,10 @@ if __name__ == "__main__":
         "COUNT": 100000,
         "HOUR_TO_PREDICT": 5,
         "TEST_SIZE": 0.2,
+        "MODEL_DIR": os.path.join(os.path.dirname(os.path.abspath(__file__)), '.models'),
     }
 
-    analyzer = NightscoutAnalyzer(config['NS_URL'], config['TOKEN'])
+    analyzer = NightscoutAnalyzer(config['NS_URL'], config['TOKEN'], models=ModelRegistry(config['MODEL_DIR']))
     start_time, end_time = get_start_end_time(config['PERIOD'])
     exit(1) if not analyzer.fetch_data(start_time=start_time, end_time=end_time, count=config['COUNT']) else None
     isf = analyzer.analyze_data()
@@ -279,8 +758,8 @@ if __name__ == "__main__":
     logger.info("")
 
     logger.info("Predictions based on ISF and IOB and ML:")
-    for hours in (range(1, config['HOUR_TO_PREDICT'] + 1)):
-        predicted_glucose = analyzer.combined_glucose_prediction(hours_ahead=hours)
+    forecast = analyzer.combined_glucose_forecast(hours_ahead=config['HOUR_TO_PREDICT'])
+    for hours, predicted_glucose in enumerate(forecast, start=1):
 
         # timezone: Istanbul
         predicted_human_readable_time = (datetime.utcnow() + timedelta(hours=3 + hours)).strftime("%H:%M")
@@ -292,5 +771,6 @@ if __name__ == "__main__":
     mean_error = analyzer.test_prediction(analyzer.combined_glucose_prediction, test_size=0.2)
     logger.info(f"Mean error: {round(mean_error)} mg/dl ({round(mean_error/18,2)} mmol/l)")
 
+    logger.info(f"Model registry: {analyzer.models.stats()}")
     logger.info("")
     logger.info("Done.")
@@ -0,0 +1,377 @@
+# forecast.py
+"""Streaming glucose forecast: NightscoutAnalyzer.predict_glucose kept up to date one document at a time.
+
+predict_glucose() recomputes the correction ISF over every treatment (analyze_data) and the IOB of each
+hour ahead from the whole bolus history. StreamingForecaster keeps what those depend on instead:
+- the last reading and the one before it (current glucose and trend);
+- the running sum and count of the ISF of every settled correction, plus the few corrections of the
+  last hours whose ISF can still change (their 4-hour end reading or a nearby meal has not arrived);
+- the boluses still acting (within the duration of insulin action) for the IOB;
+- the readings of the last 4 hours and the meals of the last meal window, which the open corrections
+  are measured against.
+Feeding a reading or a treatment costs O(1) plus the corrections still open; a forecast costs
+O(boluses within DIA x hours ahead). Both are independent of how much history came before.
+
+Documents must arrive in time order within each collection, as Nightscout syncs deliver them. One older
+than what was already fed marks the forecaster ``stale``: its figures no longer match a batch
+recomputation and it has to be rebuilt (SiteForecaster does this from the local cache).
+"""
+import heapq
+import logging
+import math
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import deque
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+
+import database
+from drafts.isf import (DEFAULT_DIA_HOURS, MEAL_WINDOW_SECONDS, US_PER_SECOND, EntryColumns, TreatmentColumns,
+                        linear_curve)
+from nightscout_sync import NightscoutSync
+
+# A correction's ISF is the glucose drop over this long after it (NightscoutAnalyzer._isf_values)
+ISF_SECONDS = 4 * 3600
+DEFAULT_ISF = 18 * 4
+PREDICT_HOURS = 3
+SYNC_INTERVAL = 300
+
+logger = logging.getLogger(__name__)
+
+
+class Forecast(NamedTuple):
+    glucose: float  # last reading, mg/dL
+    reading_time: float  # epoch seconds
+    trend: Optional[float]  # mg/dL per 5 minutes
+    iob: float  # units on board now
+    isf: float  # mg/dL per unit, the estimate or the default
+    predictions: List[float]  # glucose 1, 2, ... hours from now
+
+
+class _Correction:
+    __slots__ = ('time', 'insulin', 'near_meal', 'isf', 'measured')
+
+    def __init__(self, time, insulin, near_meal):
+        self.time = time  # epoch us
+        self.insulin = insulin
+        self.near_meal = near_meal
+        self.isf = math.nan
+        # A reading at or past the end of the ISF window has arrived, so ``isf`` is final
+        self.measured = False
+
+
+class StreamingForecaster:
+    """Running state of NightscoutAnalyzer.predict_glucose, updated per reading and per treatment.
+
+    ``forecast(hours, now)[h - 1]`` matches ``predict_glucose(h, now)`` of an analyzer holding the same
+    documents, as long as ``now`` is not before the documents fed.
+    """
+
+    def __init__(self, meal_window=MEAL_WINDOW_SECONDS, dia_hours=DEFAULT_DIA_HOURS, iob_curve=linear_curve,
+                 default_isf=DEFAULT_ISF):
+        self.meal_window = meal_window
+        self.dia_hours = dia_hours
+        self.iob_curve = iob_curve
+        self.default_isf = default_isf
+        self.stale = False
+        self.last_time = None  # epoch us of the last reading
+        self.last_glucose = None
+        self.previous_time = None
+        self.previous_glucose = None
+        self.last_treatment_time = None
+        self._window = round(meal_window * US_PER_SECOND)
+        self._isf_span = ISF_SECONDS * US_PER_SECOND
+        self._isf_total = 0.0
+        self._isf_count = 0
+        self._open = deque()  # corrections whose ISF or meal flag can still change, oldest first
+        self._meals = deque()  # meal times within the meal window of the last treatment
+        self._boluses = deque()  # (epoch seconds, units) within DIA of the last treatment
+        # Readings of the last ISF_SECONDS plus the one before, as parallel lists trimmed from the front
+        self._times, self._sgv, self._head = [], [], 0
+        self._covered_from = -2 ** 63
+
+    @classmethod
+    def from_analyzer(cls, analyzer, **options):
+        """A forecaster with the analyzer's settings, fed its entries and treatments in time order."""
+        forecaster = cls(meal_window=analyzer.meal_window, dia_hours=analyzer.dia_hours,
+                         iob_curve=analyzer.iob_curve, default_isf=analyzer.default_isf, **options)
+        forecaster.feed(analyzer.entries, analyzer.treatments)
+        return forecaster
+
+    def feed(self, entries: EntryColumns, treatments: TreatmentColumns):
+        """Add entry and treatment columns, merged into one stream by time."""
+        event_types = treatments.event_types
+        # TreatmentColumns keep the order given
+        treatments = treatments[:]
+        order = np.argsort(treatments.time, kind='stable')
+        treatments.time, treatments.event, treatments.insulin = (treatments.time[order], treatments.event[order],
+                                                                 treatments.insulin[order])
+        stream = heapq.merge(
+            ((int(t), 0, float(sgv)) for t, sgv in zip(entries.time, entries.sgv)),
+            ((int(t), 1, event_types[event], float(insulin))
+             for t, event, insulin in zip(treatments.time, treatments.event, treatments.insulin)),
+            key=lambda row: row[:2])
+        for row in stream:
+            if row[1] == 0:
+                self.add_reading(row[0], row[2])
+            else:
+                self.add_event(row[0], row[2], row[3])
+
+    def add_entry(self, document):
+        row = EntryColumns.row(document)
+        if row is not None:
+            self.add_reading(row[0], row[2])
+
+    def add_treatment(self, document):
+        row = TreatmentColumns.row(document)
+        if row is not None:
+            self.add_event(*row)
+
+    def add_reading(self, when: int, sgv: float):
+        """One CGM reading at ``when`` (epoch us)."""
+        if self.last_time is not None and when < self.last_time:
+            self.stale = True
+            return
+        # Stored like EntryColumns.sgv (float32), so ISF values come out the same
+        sgv = float(np.float32(sgv))
+        if self.last_time is not None and when > self.last_time:
+            self.previous_time, self.previous_glucose = self.last_time, self.last_glucose
+        self.last_time, self.last_glucose = when, sgv
+        self._times.append(when)
+        self._sgv.append(sgv)
+        for correction in self._open:
+            if correction.time + self._isf_span > when:
+                break
+            if not correction.measured:
+                correction.isf, correction.measured = self._correction_isf(correction), True
+        self._settle()
+        self._trim_readings()
+
+    def add_event(self, when: int, event_type: Optional[str], insulin: float):
+        """One treatment at ``when`` (epoch us); ``insulin`` is NaN when it has none."""
+        if self.last_treatment_time is not None and when < self.last_treatment_time:
+            self.stale = True
+            return
+        self.last_treatment_time = when
+        if not math.isnan(insulin) and insulin != 0:
+            self._boluses.append((when / US_PER_SECOND, insulin))
+            horizon = when / US_PER_SECOND - self.dia_hours * 3600
+            while self._boluses[0][0] < horizon:
+                self._boluses.popleft()
+        if event_type == 'Meal Bolus':
+            for correction in self._open:
+                if when - self._window < correction.time:
+                    correction.near_meal = True
+            self._meals.append(when)
+        elif event_type == 'Correction Bolus' and not math.isnan(insulin) and insulin != 0:
+            if when < self._covered_from:
+                # Readings it is measured against were already dropped
+                self.stale = True
+                return
+            correction = _Correction(when, insulin, any(when - meal < self._window for meal in self._meals))
+            if self.last_time is not None and when + self._isf_span <= self.last_time:
+                correction.isf, correction.measured = self._correction_isf(correction), True
+            self._open.append(correction)
+        while self._meals and self._meals[0] <= when - self._window:
+            self._meals.popleft()
+        self._settle()
+
+    def _settle(self):
+        # A correction is final once it is measured and no meal within the window can still arrive
+        while self._open and self._open[0].measured and self.last_treatment_time is not None and \
+                self.last_treatment_time >= self._open[0].time + self._window:
+            correction = self._open.popleft()
+            if not correction.near_meal and not math.isnan(correction.isf):
+                self._isf_total += correction.isf
+                self._isf_count += 1
+
+    def _trim_readings(self):
+        # Corrections not measured yet are all within the last ISF_SECONDS
+        cutoff = self.last_time - self._isf_span
+        times, head = self._times, self._head
+        # Keep the last reading before the cutoff too: it is the end reading of a correction with a gap after it
+        while head + 1 < len(times) and times[head + 1] < cutoff:
+            head += 1
+        self._covered_from = max(self._covered_from, cutoff)
+        if head > 1024 and head * 2 > len(times):
+            del self._times[:head], self._sgv[:head]
+            head = 0
+        self._head = head
+
+    def _correction_isf(self, correction) -> float:
+        """ISF of one correction from the buffered readings, with the lookups of _isf_values."""
+        times, sgv, head, n = self._times, self._sgv, self._head, len(self._times)
+        start_time, end_time = correction.time, correction.time + self._isf_span
+        i = bisect_left(times, start_time, head)
+        if not (i < n and times[i] == start_time and sgv[i] != 0):
+            i = bisect_right(times, start_time, head)
+        start = sgv[i] if i < n else 0
+        i = bisect_left(times, end_time, head)
+        if not (i < n and times[i] == end_time and sgv[i] != 0):
+            i -= 1
+        end = sgv[i] if i >= head else 0
+        if not start or not end:
+            return math.nan
+        return (start - end) / correction.insulin
+
+    def isf(self) -> Optional[float]:
+        """NightscoutAnalyzer.analyze_data(): mean ISF of the corrections away from meals, None without any."""
+        total, count = self._isf_total, self._isf_count
+        for correction in self._open:
+            if correction.near_meal:
+                continue
+            isf = correction.isf if correction.measured else self._correction_isf(correction)
+            if not math.isnan(isf):
+                total += isf
+                count += 1
+        return total / count if count else None
+
+    def iob(self, targets) -> np.ndarray:
+        """Insulin on board at each of ``targets`` (epoch seconds)."""
+        targets = np.asarray(targets, dtype=np.float64)
+        if not self._boluses:
+            return np.zeros(len(targets))
+        times, units = (np.fromiter(column, np.float64, len(self._boluses)) for column in zip(*self._boluses))
+        elapsed = targets[:, None] - times[None, :]
+        dia_seconds = self.dia_hours * 3600
+        active = (elapsed >= 0) & (elapsed <= dia_seconds)
+        contributions = np.where(active, units * self.iob_curve(np.where(active, elapsed, 0) / 3600, self.dia_hours),
+                                 0)
+        return contributions.sum(axis=1)
+
+    def trend(self) -> Optional[float]:
+        """Change between the last two readings, in mg/dL per 5 minutes."""
+        if self.previous_time is None:
+            return None
+        return (self.last_glucose - self.previous_glucose) / (self.last_time - self.previous_time) * \
+            300 * US_PER_SECOND
+
+    def forecast(self, hours_ahead=PREDICT_HOURS, now=None) -> Optional[List[float]]:
+        """Predicted glucose 1..``hours_ahead`` hours after ``now`` (epoch seconds), or None without a reading."""
+        if not self.last_glucose:
+            return None
+        now = self.last_time / US_PER_SECOND if now is None else now
+        isf = self.isf() or self.default_isf
+        drops = self.iob(now + np.arange(1, hours_ahead + 1) * 3600) * isf
+        forecast, glucose = [], self.last_glucose
+        for drop in drops.tolist():
+            glucose -= drop
+            forecast.append(glucose)
+        return forecast
+
+    def predict(self, hours_ahead=1, now=None) -> Optional[float]:
+        forecast = self.forecast(hours_ahead, now)
+        return forecast[-1] if forecast else None
+
+
+class SiteForecaster:
+    """A StreamingForecaster of one Nightscout site, fed with what NightscoutSync adds to the local cache.
+
+    update() syncs the site and feeds only the rows newer than the last ones fed; the forecaster is
+    rebuilt from the whole cache on the first update, whenever it went stale, and when the rows already
+    fed changed in the cache. The last is read from the source's ns_changes counter, which triggers move
+    when a cached row is inserted behind the sync's high-water mark, updated or deleted (migrations.py),
+    so checking for it is one lookup however long the history.
+    """
+
+    def __init__(self, url, token=None, **options):
+        self.sync = NightscoutSync(url, token)
+        self.options = options
+        self.forecaster = None
+        self._entry_mark = None  # date of the last entry fed
+        self._treatment_mark = None  # (created_at, id) of the last treatment fed
+        self._fed = None  # _changes() when the rows fed were read
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return self.sync.url
+
+    def update(self, sync=True):
+        """Sync the site (unless ``sync`` is False) and feed the new entries and treatments."""
+        if sync:
+            self.sync.sync()
+        with self._lock:
+            # Read before the rows, so a change made while they are fed is seen on the next update
+            changes = self._changes()
+            if self.forecaster is None or self.forecaster.stale:
+                self._reset()
+            elif changes != self._fed:
+                logger.info(f'Rows already fed from {self.url} were added or changed, replaying the cache')
+                self._reset()
+            self._fed = changes
+            fed = self._feed_new()
+            if self.forecaster.stale:
+                # Something older than what was fed arrived: replay the whole cache
+                self._reset()
+                fed = self._feed_new()
+        logger.debug(f'Fed {fed[0]} entries and {fed[1]} treatments of {self.url}')
+        return fed
+
+    def summary(self, hours_ahead=PREDICT_HOURS, now=None) -> Optional[Forecast]:
+        """The current Forecast, read from the running state; None before the first reading."""
+        now = time.time() if now is None else now
+        with self._lock:
+            forecaster = self.forecaster
+            if forecaster is None or not forecaster.last_glucose:
+                return None
+            return Forecast(forecaster.last_glucose, forecaster.last_time / US_PER_SECOND, forecaster.trend(),
+                            float(forecaster.iob([now])[0]), forecaster.isf() or forecaster.default_isf,
+                            forecaster.forecast(hours_ahead, now))
+
+    def _reset(self):
+        self.forecaster, self._entry_mark, self._treatment_mark = StreamingForecaster(**self.options), None, None
+
+    def _changes(self):
+        row = database.get_connection().execute('SELECT changes FROM ns_changes WHERE source=?',
+                                                (self.url,)).fetchone()
+        return row[0] if row else 0
+
+    def _feed_new(self):
+        conn = database.get_connection()
+        entry_mark = -2 ** 63 if self._entry_mark is None else self._entry_mark
+        treatment_mark = ('', '') if self._treatment_mark is None else self._treatment_mark
+        entries = conn.execute('SELECT date, sgv, date_string FROM ns_entries WHERE source=? AND date > ? '
+                               'ORDER BY date', (self.url, entry_mark)).fetchall()
+        treatments = conn.execute('SELECT created_at, id, event_type, insulin FROM ns_treatments '
+                                  'WHERE source=? AND (created_at, id) > (?, ?) ORDER BY created_at, id',
+                                  (self.url, *treatment_mark)).fetchall()
+        self.forecaster.feed(
+            EntryColumns.from_documents({'sgv': sgv, 'date': date, 'dateString': date_string}
+                                        for date, sgv, date_string in entries),
+            TreatmentColumns.from_documents({'created_at': created_at, 'eventType': event_type, 'insulin': insulin}
+                                            for created_at, _, event_type, insulin in treatments))
+        if entries:
+            self._entry_mark = entries[-1][0]
+        if treatments:
+            self._treatment_mark = treatments[-1][:2]
+        return len(entries), len(treatments)
+
+
+class ForecastJob:
+    """Calls update() on every SiteForecaster every ``interval`` seconds on a daemon thread until stop()."""
+
+    def __init__(self, sites, interval=SYNC_INTERVAL):
+        self.sites = sites
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ForecastJob', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            for site in self.sites:
+                try:
+                    site.update()
+                except Exception:
+                    logger.exception(f'Forecast update of {site.url} failed')
+            self._stop.wait(self.interval)
@@ -0,0 +1,270 @@
+# importer.py
+"""Bulk import of CGM exports into user_inputs.
+
+Accepted files are Nightscout entries, either as the API's JSON array or one document per line
+(mongoexport), and CSV exports with a header row naming a timestamp column and one or more glucose
+columns (Dexcom Clarity, LibreView and similar). The file arrives as a stream of byte chunks and is
+decoded, parsed and written one batch at a time, so memory stays flat however long the history is.
+Each batch is one executemany transaction; readings already stored for the same (user_id, ts) are
+skipped by the table's primary key, so importing a file twice adds nothing. Readings older than the
+user's compacted horizon go into the rollup buckets instead (retention.roll_in).
+"""
+import codecs
+import csv
+import itertools
+import json
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+import database
+import retention
+from nightscout_sync import iter_json_array
+
+MG_DL = 'mg/dL'
+MMOL_L = 'mmol/L'
+MG_DL_PER_MMOL_L = 18.0182
+# Readings without a unit above this are mg/dL, at or below it mmol/L
+MMOL_L_MAX = 35
+
+BATCH_SIZE = 50000
+CHUNK_SIZE = 256 * 1024
+# A CSV header row must appear within this many lines
+HEADER_SCAN = 30
+# Data rows read ahead at most to tell apart timestamp formats that fit the first rows equally well,
+# e.g. day-month and month-day until a day past the 12th shows up
+FORMAT_SAMPLE = 20000
+
+# Timestamp formats after ISO 8601, in order of preference among those that read every sampled row
+TIME_FORMATS = (
+    '%m-%d-%Y %H:%M', '%d-%m-%Y %H:%M', '%m/%d/%Y %H:%M', '%d/%m/%Y %H:%M', '%d.%m.%Y %H:%M', '%Y/%m/%d %H:%M',
+    '%m-%d-%Y %I:%M %p', '%m/%d/%Y %I:%M %p',
+    '%m-%d-%Y %H:%M:%S', '%d-%m-%Y %H:%M:%S', '%m/%d/%Y %H:%M:%S', '%d/%m/%Y %H:%M:%S', '%d.%m.%Y %H:%M:%S',
+)
+
+
+class ImportFormatError(ValueError):
+    """The file is not an export this module can read."""
+
+
+class ImportResult(NamedTuple):
+    read: int  # readings found in the file
+    inserted: int  # readings that were not stored yet
+    skipped: int  # data rows without a usable timestamp or value
+    first_ts: Optional[int]
+    last_ts: Optional[int]
+    rolled_up: int = 0  # readings of compacted periods added to the rollups (retention.roll_in)
+    dropped: int = 0  # readings of compacted periods whose buckets already had data
+
+
+def normalize_glucose(value, unit=None):
+    """Return (mg_dl, mmol_l) of a reading in ``unit``; without one, values above MMOL_L_MAX are mg/dL."""
+    if unit is None:
+        unit = MG_DL if value > MMOL_L_MAX else MMOL_L
+    if unit == MG_DL:
+        return float(value), round(value / MG_DL_PER_MMOL_L, 2)
+    return round(value * MG_DL_PER_MMOL_L, 1), float(value)
+
+
+def iter_file(path, chunk_size=CHUNK_SIZE):
+    """Byte chunks of a file."""
+    with open(path, 'rb') as f:
+        yield from iter(lambda: f.read(chunk_size), b'')
+
+
+def iter_lines(chunks):
+    """Lines, with their newlines, of text arriving in chunks."""
+    tail = ''
+    for chunk in chunks:
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if tail:
+        yield tail
+
+
+def nightscout_reading(doc):
+    """(ts, sgv, MG_DL) of a Nightscout entry; None for entries without a glucose value or date."""
+    if not isinstance(doc, dict) or doc.get('sgv') is None:
+        return None
+    date = doc.get('date')
+    if isinstance(date, dict):
+        # mongoexport writes {"$numberLong": "..."}
+        date = next(iter(date.values()), None)
+    try:
+        if date is not None:
+            return int(date) // 1000, float(doc['sgv']), MG_DL
+        return database.to_epoch(doc['dateString'].replace('Z', '+00:00')), float(doc['sgv']), MG_DL
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def iso_time_parser():
+    """A parser of ISO 8601 timestamps to epoch seconds; naive ones are local time.
+
+    Exports list readings in time order, so the local-time conversion of naive "YYYY-MM-DDTHH:MM:SS"
+    values is done once per hour and the minutes and seconds are added to it. The hour it remembers is
+    the parser's own, so every import builds one (time_parsers). Hours a DST change repeats or skips have no single
+    start, and their timestamps are converted one by one.
+    """
+    last_prefix, last_start = '', None
+
+    def parse(text):
+        nonlocal last_prefix, last_start
+        if len(text) == 19 and text[13] == ':' and text[16] == ':':
+            if text[:13] != last_prefix:
+                hour = datetime.fromisoformat(text[:13] + ':00:00')
+                start = database.to_epoch(hour)
+                last_prefix, last_start = text[:13], start if database.to_epoch(hour.replace(fold=1)) == start else None
+            if last_start is not None:
+                return last_start + int(text[14:16]) * 60 + int(text[17:19])
+        return database.to_epoch(datetime.fromisoformat(text))
+
+    return parse
+
+
+def _strptime_time(fmt):
+    return lambda text: int(datetime.strptime(text, fmt).timestamp())
+
+
+def time_parsers():
+    """Timestamp parsers (str -> epoch seconds), most preferred first; new ones for every file."""
+    return (iso_time_parser(), *map(_strptime_time, TIME_FORMATS))
+
+
+def _parses(parse, text):
+    try:
+        parse(text)
+    except ValueError:
+        return False
+    return True
+
+
+def _header_columns(row):
+    """(time column, [(glucose column, unit)]) of a CSV header row, or None if it is not one."""
+    names = [name.strip().lower() for name in row]
+    time_column = next((i for i, name in enumerate(names) if 'timestamp' in name), None)
+    if time_column is None:
+        time_column = next((i for i, name in enumerate(names) if name in ('time', 'date', 'datetime', 'date time')),
+                           None)
+    glucose = [(i, MMOL_L if 'mmol' in name else MG_DL if 'mg' in name else None)
+               for i, name in enumerate(names)
+               if ('glucose' in name or name in ('sgv', 'bg')) and 'ketone' not in name and 'rate' not in name]
+    if time_column is None or not glucose:
+        return None
+    return time_column, glucose
+
+
+def csv_readings(lines, parsers=None):
+    """Yield (ts, value, unit) per data row of a CSV export, None for data rows that cannot be read.
+
+    ``parsers`` are the candidate timestamp parsers, time_parsers() by default.
+    """
+    head = list(itertools.islice(lines, HEADER_SCAN))
+    try:
+        dialect = csv.Sniffer().sniff(''.join(head), delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    rows = csv.reader(itertools.chain(head, lines), dialect)
+    for row in itertools.islice(rows, HEADER_SCAN):
+        columns = _header_columns(row)
+        if columns is not None:
+            break
+    else:
+        raise ImportFormatError('No header row with a timestamp and a glucose column')
+    time_column, glucose = columns
+    width = max(time_column, *(i for i, _ in glucose)) + 1
+
+    def value(row):
+        if len(row) < width or not row[time_column].strip():
+            return None, None
+        for i, unit in glucose:
+            text = row[i].strip()
+            if text:
+                return text, unit
+        return None, None
+
+    # Read ahead until a single timestamp format fits every data row so far
+    sample, parsers = [], time_parsers() if parsers is None else parsers
+    for row in rows:
+        sample.append(row)
+        if value(row)[0] is None:
+            continue
+        text = row[time_column].strip()
+        parsers = [parse for parse in parsers if _parses(parse, text)]
+        if not parsers:
+            raise ImportFormatError(f'Unrecognised timestamp format: {text!r}')
+        if len(parsers) == 1 or len(sample) >= FORMAT_SAMPLE:
+            break
+    parse = parsers[0]
+    for row in itertools.chain(sample, rows):
+        text, unit = value(row)
+        if text is None:
+            continue
+        try:
+            yield parse(row[time_column].strip()), float(text.replace(',', '.')), unit
+        except ValueError:
+            # "Low"/"High" markers, stray text
+            yield None
+
+
+def readings(chunks, parsers=None):
+    """Yield (ts, value, unit) from the byte chunks of an export, None for unreadable data rows."""
+    text = (chunk for chunk in codecs.iterdecode(chunks, 'utf-8-sig') if chunk)
+    first = next(text, '')
+    start = first.lstrip()[:1]
+    text = itertools.chain([first], text)
+    if start == '[':
+        yield from map(nightscout_reading, iter_json_array(text))
+    elif start == '{':
+        for line in iter_lines(text):
+            if line.strip():
+                try:
+                    yield nightscout_reading(json.loads(line))
+                except json.JSONDecodeError:
+                    yield None
+    elif start:
+        yield from csv_readings(iter_lines(text), parsers)
+
+
+def import_readings(user_id, chunks, progress=None, batch_size=BATCH_SIZE) -> ImportResult:
+    """Import an export into the user's readings; ``progress(read, inserted)`` is called after each batch."""
+    read = inserted = skipped = rolled_up = dropped = 0
+    first_ts = last_ts = None
+    batch = []
+    parsers = time_parsers()
+
+    def write():
+        nonlocal read, inserted, rolled_up, dropped, first_ts, last_ts
+        raw_before = retention.horizon(user_id)[0]
+        recent = [row for row in batch if row[0] >= raw_before]
+        if recent:
+            inserted += database.insert_readings(recent)
+        if len(recent) < len(batch):
+            rolled, lost = retention.roll_in(user_id, [row for row in batch if row[0] < raw_before])
+            rolled_up += rolled
+            dropped += lost
+        read += len(batch)
+        low, high = min(batch)[0], max(batch)[0]
+        first_ts = low if first_ts is None else min(first_ts, low)
+        last_ts = high if last_ts is None else max(last_ts, high)
+
+    try:
+        for reading in readings(chunks, parsers):
+            if reading is None:
+                skipped += 1
+                continue
+            ts, value, unit = reading
+            batch.append((ts, user_id, *normalize_glucose(value, unit)))
+            if len(batch) >= batch_size:
+                write()
+                batch = []
+                if progress is not None:
+                    progress(read, inserted)
+    except UnicodeDecodeError:
+        raise ImportFormatError('The file is not UTF-8 text') from None
+    if batch:
+        write()
+    if read == 0:
+        raise ImportFormatError('No glucose readings found')
+    return ImportResult(read, inserted, skipped, first_ts, last_ts, rolled_up, dropped)
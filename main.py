@@ -1,18 +1,45 @@
 import datetime
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
 import telebot
+from telebot import apihelper
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-from config import TOKEN
-from database import insert_data, select_all_data, select_history_data
+import config
+import metrics
+from charts import chart_cache, submit_render
+from database import add_write_listener, init_db, insert_data, iter_history_data, select_data_marker, \
+    select_window_stats
+from digest import A1C_DAYS, DIGEST_HOUR, DigestJob, day_label, subscribe, unsubscribe
+from forecast import PREDICT_HOURS, SYNC_INTERVAL, ForecastJob, SiteForecaster
+from importer import CHUNK_SIZE, ImportFormatError, import_readings, normalize_glucose
+from outbox import BULK, CHAT_RATE, GLOBAL_RATE, INTERACTIVE, SENDERS, Outbox
+from reply_cache import DEFAULT_MAX_AGE, DEFAULT_MAX_BYTES, ReplyCache
+from retention import INTERVAL, RAW_DAYS, ROLLUP_DAYS, RetentionJob
+from stats import PERCENTILES, TARGET_HIGH, TARGET_LOW, VERY_HIGH, VERY_LOW, load_readings, user_stats
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(funcName)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # connect to telegram bot using API key
-bot = telebot.TeleBot(TOKEN)
+bot = telebot.TeleBot(config.TOKEN)
+
+# Telegram user ids allowed to use /perf
+ADMIN_IDS = frozenset(getattr(config, 'ADMIN_IDS', ()))
+
+# Outbound message queue, started in __main__; while it is None replies are sent inline
+outbox = None
+
+
+def send_message(chat_id, text, priority=INTERACTIVE, **kwargs):
+    """Send a message through the outbox when it runs, otherwise straight away."""
+    if outbox is None:
+        return bot.send_message(chat_id, text, **kwargs)
+    return outbox.send_message(chat_id, text, priority, **kwargs)
 
 # button labels and callback data
 buttons = {
@@ -35,23 +62,39 @@ history_keyboard = [
     [InlineKeyboardButton(history_options[key]['label'], callback_data=history_options[key]['callback_data']) for key in
      history_options]]
 
+# /stats offers the same periods as history, with callback data "stats:<period>"
+STATS_PREFIX = 'stats:'
+stats_keyboard = [
+    [InlineKeyboardButton(option['label'], callback_data=STATS_PREFIX + option['callback_data'])
+     for option in history_options.values()]]
+
 
 def mg_dl_to_mmol_l(mg_dl):
     return round(mg_dl / 18.0182, 2)
 
 
+WELCOME_TEXT = "Welcome! I am your T1D assistant bot. How can I help you today?"
+
+HELP_TEXT = "Here are the available commands:\n"
+HELP_TEXT += "/start - start the bot\n"
+HELP_TEXT += "/help - display this help message\n"
+HELP_TEXT += "/glucose - input a glucose level (mg/dL)\n"
+HELP_TEXT += "/a1c - calculate your estimated A1C based on the last 7 days of glucose levels\n"
+HELP_TEXT += "/stats - time in range, variability and GMI for a period\n"
+HELP_TEXT += "/import - load your history from a Nightscout or CGM export file\n"
+HELP_TEXT += "/digest - get a summary of the previous day every morning (/digest off to stop)\n"
+HELP_TEXT += "/predict - glucose forecast for the next hours from your Nightscout data\n"
+HELP_TEXT += "or choose an option from below:\n"
+
+INVALID_INPUT_TEXT = "Invalid input. Please enter a number (glucose level) or choose an option"
+
+
 def handle_start_command(chat_id):
-    bot.send_message(chat_id, "Welcome! I am your T1D assistant bot. How can I help you today?")
+    send_message(chat_id, WELCOME_TEXT)
 
 
 def handle_help_command(chat_id):
-    help_text = "Here are the available commands:\n"
-    help_text += "/start - start the bot\n"
-    help_text += "/help - display this help message\n"
-    help_text += "/glucose - input a glucose level (mg/dL)\n"
-    help_text += "/a1c - calculate your estimated A1C based on the last 7 days of glucose levels\n"
-    help_text += "or choose an option from below:\n"
-    bot.send_message(chat_id=chat_id, text=help_text, reply_markup=InlineKeyboardMarkup(keyboard))
+    send_message(chat_id=chat_id, text=HELP_TEXT, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
 def handle_invalid_input(chat_id):
@@ -60,70 +103,184 @@ def handle_invalid_input(chat_id):
         It takes the update and context as inputs, and sends a message to the user
         indicating that their input is invalid.
     """
-    invalid_message = "Invalid input. Please enter a number (glucose level) or choose an option"
-    bot.send_message(chat_id, invalid_message, reply_markup=InlineKeyboardMarkup(keyboard))
+    send_message(chat_id, INVALID_INPUT_TEXT, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
-def insert_glucose_level(user_id: int, glucose_level: str):
-    if int(glucose_level) > 35:
-        mg_dl = float(glucose_level)
-        mmol_l = round(mg_dl / 18, 2)
-    else:
-        mmol_l = float(glucose_level)
-        mg_dl = mmol_l * 2
+def insert_glucose_level(user_id: int, glucose_level: str, timestamp=None):
+    """Store a reading the user sent; returns (mg_dl, mmol_l, stored), see database.insert_data."""
+    mg_dl, mmol_l = normalize_glucose(float(glucose_level))
     logger.info(f'User {user_id} sent {mg_dl} mg/dl ({mmol_l} mmol/L)')
-    insert_data(user_id, mg_dl, mmol_l)
-    return mg_dl, mmol_l
+    stored = insert_data(user_id, mg_dl, mmol_l, timestamp)
+    return mg_dl, mmol_l, stored
 
 
-def send_history_data(user_id: int, chat_id: int, time_period='month'):
-    """
-        It is used to send the data of the user's glucose level entries for the specified time period.
-        This function takes user_id, time_period and bot as the input parameter.
+# Telegram rejects messages longer than this many characters
+MESSAGE_LIMIT = 4096
 
-        The function first creates a connection to the sqlite3 database and retrieves the data from the 'user_inputs'
-        table based on the user_id and time_period passed as the parameter. It then loops through the data,
-        formats the timestamp and message, then sends the message to the user via the bot. Finally, it closes the
-        connection to the database.
-    """
-    logger.info(f'Chat ID: {chat_id}: User {user_id} requested a history data for period: {time_period}')
+# callback data of the "older" / "newer" buttons under a history page: hp:<o|n>:<cursor ts>:<period>
+HISTORY_PAGE_PREFIX = 'hp:'
+# callback data of the chart button under a history page: chart:<period>
+CHART_PREFIX = 'chart:'
+# Charts of periods with more days of data than this are drawn from daily means
+CHART_MAX_DAYS = getattr(config, 'CHART_MAX_DAYS', 90)
+
+# History pages and window averages already computed, per user; a user's entries go when they add readings
+reply_cache = ReplyCache(max_bytes=getattr(config, 'REPLY_CACHE_BYTES', DEFAULT_MAX_BYTES),
+                         max_age=getattr(config, 'REPLY_CACHE_MAX_AGE', DEFAULT_MAX_AGE)).register_metrics()
+add_write_listener(reply_cache.invalidate)
+
+
+def history_range(time_period):
+    """Return the (date_from, date_to) of a history option; (None, None) for "all", None if it is invalid."""
+    now = datetime.datetime.now()
     if time_period == "1 day":
-        date_range = (datetime.datetime.now() - datetime.timedelta(days=1), datetime.datetime.now())
+        return now - datetime.timedelta(days=1), now
     elif time_period == "2 days":
-        date_range = (datetime.datetime.now() - datetime.timedelta(days=2), datetime.datetime.now())
+        return now - datetime.timedelta(days=2), now
     elif time_period == "week":
-        date_range = (datetime.datetime.now() - datetime.timedelta(weeks=1), datetime.datetime.now())
+        return now - datetime.timedelta(weeks=1), now
     elif time_period == "month":
-        date_range = (datetime.datetime.now() - datetime.timedelta(days=30), datetime.datetime.now())
+        return now - datetime.timedelta(days=30), now
     elif time_period.isnumeric():
-        date_range = (datetime.datetime.now() - datetime.timedelta(days=int(time_period)), datetime.datetime.now())
+        return now - datetime.timedelta(days=int(time_period)), now
     elif time_period == "all":
-        rows = select_all_data(user_id)
+        return None, None
+    return None
+
+
+def format_history_row(row) -> str:
+    timestamp = datetime.datetime.fromtimestamp(row[0]).strftime("%d.%m %H:%M")
+    return "{} - {} mg/dl ({} mmol/l)\n".format(timestamp, row[2], round(row[3], 2))
+
+
+@reply_cache.cached('history')
+def history_page(user_id: int, time_period='month', before=None, after=None):
+    """
+        Build one page of the user's glucose level entries for the specified time period.
+
+        Returns (text, reply_markup). A page holds as many rows as fit in one message, newest first, and
+        ``before``/``after`` are the keyset cursors of the "older"/"newer" buttons. Rows are streamed from
+        the database and formatting stops at the first row that does not fit, so a page costs the same
+        wherever it is in the history and memory does not grow with the number of rows the user has.
+        Pages are kept in reply_cache, so tapping the same button again does not query the database.
+        Blocking: the async runtime calls it in an executor.
+    """
+    date_range = history_range(time_period)
+    if date_range is None:
+        return "Invalid time period", None
+    header = "Entries for the last {}:\n".format(time_period)
+    budget = MESSAGE_LIMIT - len(header)
+    lines, first_ts, last_ts, more = [], None, None, False
+    rows = iter_history_data(user_id, date_range[0], date_range[1], before=before, after=after)
+    try:
+        for row in rows:
+            line = format_history_row(row)
+            if len(line) > budget:
+                more = True
+                break
+            budget -= len(line)
+            lines.append(line)
+            if first_ts is None:
+                first_ts = row[0]
+            last_ts = row[0]
+    finally:
+        rows.close()
+    if not lines:
+        return "No entries for the {}".format(time_period), None
+
+    if after is not None:
+        # Fetched oldest first: show newest first like every other page
+        lines.reverse()
+        first_ts, last_ts = last_ts, first_ts
+        has_newer, has_older = more, True
     else:
-        message = "Invalid time period"
-        bot.send_message(chat_id, message)
-        logger.info(f'Sent: {message}')
-        return
-    if time_period != "all":
-        rows = select_history_data(user_id, date_range[0], date_range[1])
+        has_newer, has_older = before is not None, more
+    page_buttons = [InlineKeyboardButton('📈 chart', callback_data=CHART_PREFIX + time_period)]
+    if has_older:
+        page_buttons.insert(0, InlineKeyboardButton('⬅ older', callback_data=f'{HISTORY_PAGE_PREFIX}o:{last_ts}:'
+                                                                             f'{time_period}'))
+    if has_newer:
+        page_buttons.append(InlineKeyboardButton('newer ➡', callback_data=f'{HISTORY_PAGE_PREFIX}n:{first_ts}:'
+                                                                          f'{time_period}'))
+    return header + "".join(lines), InlineKeyboardMarkup([page_buttons])
+
+
+def parse_history_page(data: str):
+    """Split page button callback data into the history_page arguments (time_period, before, after)."""
+    direction, cursor, time_period = data[len(HISTORY_PAGE_PREFIX):].split(':', 2)
+    if direction == 'o':
+        return time_period, int(cursor), None
+    return time_period, None, int(cursor)
+
+
+def send_history_data(user_id: int, chat_id: int, time_period='month'):
+    """
+        It is used to send the first page of the user's glucose level entries for the specified time period.
+        This function takes user_id, chat_id and time_period as the input parameters.
+    """
+    logger.info(f'Chat ID: {chat_id}: User {user_id} requested a history data for period: {time_period}')
+    message, markup = history_page(user_id, time_period)
+    send_message(chat_id, message, reply_markup=markup)
+    logger.debug('Sent a history page of %d characters', len(message))
+
 
-    if len(rows) == 0:
-        message = "No entries for the {}".format(time_period)
-        bot.send_message(chat_id, message)
-        logger.info(f'Sent: {message}')
+def edit_history_page(user_id: int, chat_id: int, message_id: int, data: str):
+    """Replace a history page message with the older or newer page its button points to."""
+    time_period, before, after = parse_history_page(data)
+    message, markup = history_page(user_id, time_period, before=before, after=after)
+    bot.edit_message_text(message, chat_id, message_id, reply_markup=markup)
+
+
+def prepare_chart(user_id: int, time_period='month'):
+    """
+        Blocking part of a chart request. Returns (cache key, cached file_id, payload): the payload is None
+        on a cache hit, the (ts, mg_dl, title) arguments of render_chart on a miss, or the text to send
+        instead when there is nothing to draw.
+    """
+    key = (user_id, time_period, select_data_marker(user_id))
+    file_id = chart_cache.get(key)
+    if file_id is not None:
+        return key, file_id, None
+    date_range = history_range(time_period)
+    if date_range is None:
+        return key, None, "Invalid time period"
+    ts, mg_dl = load_readings(user_id, *date_range, max_days=CHART_MAX_DAYS)
+    if len(ts) == 0:
+        return key, None, "No entries for the {}".format(time_period)
+    return key, None, (ts, mg_dl, "Glucose for the last {}".format(time_period))
+
+
+# Sends rendered charts, so neither the handler threads nor the render pool's result thread wait on Telegram
+chart_senders = ThreadPoolExecutor(max_workers=2, thread_name_prefix='chart-send')
+
+
+def send_rendered_chart(chat_id: int, key, render):
+    """Send a finished render and remember its file_id under ``key``."""
+    try:
+        sent = bot.send_photo(chat_id, render.result())
+    except Exception:
+        logger.exception(f'Sending the chart {key} to chat {chat_id} failed')
+        send_message(chat_id, "The chart could not be drawn, please try again later")
         return
-    message = "Entries for the last {}:\n".format(time_period)
-    for row in rows:
-        try:
-            timestamp = datetime.datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S.%f')
-        except:
-            timestamp = datetime.datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S')
-        timestamp = timestamp.strftime("%d.%m %H:%M")
-        mg_dl = row[2]
-        mmol_l = row[3]
-        message += "{} - {} mg/dl ({} mmol/l)\n".format(timestamp, mg_dl, round(mmol_l, 2))
-    bot.send_message(chat_id, message)
-    logger.info(f'Sent: {message}')
+    chart_cache.put(key, sent.photo[-1].file_id)
+
+
+def send_chart(user_id: int, chat_id: int, time_period='month'):
+    """Send the period's chart, rendered on the chart worker pool unless its file_id is cached.
+
+    A render is not waited for: the handler returns once it is submitted, and the photo goes out when
+    it is done. Returns the render's Future, or None when nothing had to be rendered.
+    """
+    key, file_id, payload = prepare_chart(user_id, time_period)
+    if isinstance(payload, str):
+        send_message(chat_id, payload)
+        return None
+    if file_id is not None:
+        bot.send_photo(chat_id, file_id)
+        return None
+    render = submit_render(*payload)
+    render.add_done_callback(lambda done: chart_senders.submit(send_rendered_chart, chat_id, key, done))
+    return render
 
 
 def a1c_calculation(mg_dl):
@@ -133,72 +290,338 @@ def a1c_calculation(mg_dl):
     return a1c
 
 
+@reply_cache.cached('avg')
 def get_avg(user_id: int, time_period):
-    if time_period.isnumeric():
-        date_from = (datetime.datetime.now() - datetime.timedelta(days=int(time_period))).strftime("%Y-%m-%d")
-        date_to = datetime.datetime.now().strftime("%Y-%m-%d")
-        data = select_history_data(user_id, date_from, date_to)
-    else:
-        data = select_all_data(user_id)
-
-    if len(data) == 0:
+    days = int(time_period) if time_period.isnumeric() else None
+    count, total_mg_dl, _ = select_window_stats(user_id, days)
+    if count == 0:
         return None, None
-    total_mg_dl = 0
-    total_days = 0
-    for row in data:
-        total_mg_dl += row[2]
-        total_days += 1
-    avg_mg_dl = total_mg_dl / total_days
+    avg_mg_dl = total_mg_dl / count
     return round(avg_mg_dl), mg_dl_to_mmol_l(avg_mg_dl)
 
 
-def handle_last_a1c(user_id: int, chat_id: int, time_period='60'):
-    avg_mg_dl, _ = get_ag(user_id, time_period=time_period)
-    a1c = (avg_mg_dl + 46.7) / 28.7
-    message = f'Your calculated A1C for the last {time_period} days is {round(a1c, 2)}% \n'
+def a1c_message(user_id: int, time_period='60') -> str:
+    avg_mg_dl, _ = get_avg(user_id, time_period=time_period)
+    if avg_mg_dl is None:
+        return f'No entries for the last {time_period} days'
+    a1c = a1c_calculation(avg_mg_dl)
+    message = f'Your calculated A1C for the last {time_period} days is {a1c}% \n'
     message += "Please note that it is not a real A1C. " \
                "Please consider taking a real " \
                "[A1C blood test](https://www.healthline.com/health/type-2-diabetes/a1c-test)."
-    bot.send_message(chat_id, message)
+    return message
+
+
+def handle_last_a1c(user_id: int, chat_id: int, time_period='60'):
+    send_message(chat_id, a1c_message(user_id, time_period))
     return
 
 
+def glucose_message(user_id: int, user_input: str, timestamp=None) -> str:
+    """Store a reading and build the reply. ``timestamp`` is when the message was sent (Message.date);
+    stored under it, a message that Telegram delivers again is not stored twice."""
+    mg_dl, mmol_l, stored = insert_glucose_level(user_id, user_input, timestamp)
+    avg_mg_dl, avg_mmol_l = get_avg(user_id, time_period='60')
+    if stored is False:
+        message = f'{mg_dl} mg/dl or {mmol_l} mmol/l was not saved: a reading sent at the same second is ' \
+                  f'already stored. \n'
+    else:
+        message = f'Your input has been saved, which is {mg_dl} mg/dl or {mmol_l} mmol/l. \n'
+    message += f'Your avg level is {avg_mg_dl} mg/dl or {avg_mmol_l} mmol/l for the last 60 days.'
+    return message
+
+
+def stats_message(user_id: int, time_period='month') -> str:
+    """Build the /stats reply for the period. Blocking: the async runtime calls it in an executor."""
+    date_range = history_range(time_period)
+    if date_range is None:
+        return "Invalid time period"
+    stats = user_stats(user_id, *date_range)
+    if stats is None:
+        return "No entries for the {}".format(time_period)
+    percentiles = ", ".join(f"p{q} {round(v)}" for q, v in zip(PERCENTILES, stats.percentiles))
+    message = f"Stats for the last {time_period} ({stats.count} readings):\n"
+    message += f"Average {round(stats.mean)} mg/dl ({mg_dl_to_mmol_l(stats.mean)} mmol/l), " \
+               f"SD {round(stats.sd)} mg/dl, CV {stats.cv:.1f}%\n"
+    message += f"GMI {stats.gmi:.1f}%\n"
+    message += f"Time in range {TARGET_LOW}-{TARGET_HIGH}: {stats.in_range:.1f}%\n"
+    message += f"Below {VERY_LOW}: {stats.very_low:.1f}%, below {TARGET_LOW}: {stats.low:.1f}%\n"
+    message += f"Above {TARGET_HIGH}: {stats.high:.1f}%, above {VERY_HIGH}: {stats.very_high:.1f}%\n"
+    message += f"Lows: {stats.hypo_events}, highs: {stats.hyper_events}\n"
+    message += f"Percentiles (mg/dl): {percentiles}"
+    return message
+
+
+# Hour (UTC) at which the daily digest goes out
+DIGEST_SEND_HOUR = getattr(config, 'DIGEST_HOUR', DIGEST_HOUR)
+
+
+def digest_message(day: int, figures) -> str:
+    """The daily digest of one user's digest.DigestFigures for UTC day ``day``."""
+    share = 100.0 / figures.count
+    in_range = figures.count - figures.below - figures.above
+    message = f"Your summary for {day_label(day)} (UTC), {figures.count} readings:\n"
+    message += f"Average {round(figures.mean)} mg/dl ({mg_dl_to_mmol_l(figures.mean)} mmol/l), " \
+               f"lowest {round(figures.lowest)}, highest {round(figures.highest)}\n"
+    message += f"Time in range {TARGET_LOW}-{TARGET_HIGH}: {in_range * share:.0f}%, " \
+               f"below: {figures.below * share:.0f}%, above: {figures.above * share:.0f}%\n"
+    message += f"Estimated A1C for the last {A1C_DAYS} days: {a1c_calculation(figures.a1c_mean)}%"
+    return message
+
+
+def send_digest(chat_id, text):
+    """Digest sends queue behind interactive replies."""
+    return send_message(chat_id, text, priority=BULK)
+
+
+def digest_command_text(user_id: int, chat_id: int, enable=True) -> str:
+    """Start or stop the user's daily digest; returns the reply. Blocking."""
+    if enable:
+        subscribe(user_id, chat_id)
+        return f"You will get a summary of the previous day every day at {DIGEST_SEND_HOUR}:00 UTC. " \
+               f"Send /digest off to stop it."
+    if unsubscribe(user_id):
+        return "Daily digest stopped"
+    return "You are not getting the daily digest. Send /digest to start it."
+
+
+def handle_digest_command(user_id: int, chat_id: int, enable=True):
+    send_message(chat_id, digest_command_text(user_id, chat_id, enable))
+
+
+# Telegram user id -> their Nightscout site URL, or (URL, API token). /predict answers from the site's data,
+# which a ForecastJob syncs every NIGHTSCOUT_SYNC_INTERVAL seconds.
+NIGHTSCOUT_SITES = getattr(config, 'NIGHTSCOUT_SITES', {})
+forecasters = {user_id: SiteForecaster(*site) if isinstance(site, tuple) else SiteForecaster(site)
+               for user_id, site in NIGHTSCOUT_SITES.items()}
+# Readings older than this are flagged in the /predict reply
+STALE_READING_MINUTES = 15
+
+
+def predict_message(user_id: int, now=None) -> str:
+    """The /predict reply, read from the user's running forecast state: nothing is fetched or recomputed."""
+    site = forecasters.get(user_id)
+    if site is None:
+        return "Predictions need your Nightscout site. Ask the bot admin to add it."
+    now = time.time() if now is None else now
+    forecast = site.summary(PREDICT_HOURS, now)
+    if forecast is None:
+        return "No Nightscout readings yet, please try again in a few minutes"
+    message = f"Glucose now: {round(forecast.glucose)} mg/dl ({mg_dl_to_mmol_l(forecast.glucose)} mmol/l)"
+    if forecast.trend is not None:
+        message += f", {forecast.trend:+.0f} mg/dl per 5 min"
+    age = (now - forecast.reading_time) / 60
+    if age > STALE_READING_MINUTES:
+        message += f" (last reading {age:.0f} min ago)"
+    message += f"\nInsulin on board: {forecast.iob:.2f} U, ISF: {round(forecast.isf)} mg/dl/U\n"
+    for hours, glucose in enumerate(forecast.predictions, start=1):
+        message += f"In {hours} h: {round(glucose)} mg/dl ({mg_dl_to_mmol_l(glucose)} mmol/l)\n"
+    return message + "This is an estimate from insulin on board only, not medical advice."
+
+
+def handle_stats_command(chat_id):
+    send_message(chat_id, "Please choose a stats period", reply_markup=InlineKeyboardMarkup(stats_keyboard))
+
+
+def perf_message(user_id: int):
+    """The /perf latency digest, or None when the user is not an admin."""
+    if user_id not in ADMIN_IDS:
+        return None
+    return metrics.summary(MESSAGE_LIMIT)
+
+
+def handle_perf_command(user_id: int, chat_id: int):
+    message = perf_message(user_id)
+    if message is None:
+        handle_invalid_input(chat_id)
+    else:
+        send_message(chat_id, message)
+
+
+IMPORT_TEXT = "Send me your glucose history as a file: a Nightscout entries export (JSON) or a CSV export " \
+              "from Dexcom Clarity, LibreView or a similar tool. Readings you already have are skipped."
+# Largest file the Bot API lets a bot download (20 MB), unless a local Bot API server is used
+IMPORT_MAX_BYTES = getattr(config, 'IMPORT_MAX_BYTES', 20 * 1024 * 1024)
+# Seconds between edits of the import progress message
+IMPORT_PROGRESS_INTERVAL = 2.0
+# Imports run one at a time, off the handler threads
+import_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='import')
+
+
+def open_document(file_id):
+    """Start downloading a file sent to the bot; returns the streaming response (a context manager)."""
+    file_path = bot.get_file(file_id).file_path
+    url = (apihelper.FILE_URL or 'https://api.telegram.org/file/bot{0}/{1}').format(bot.token, file_path)
+    response = requests.get(url, stream=True, timeout=60)
+    response.raise_for_status()
+    return response
+
+
+def import_summary(result) -> str:
+    first, last = (datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d') for ts in (result.first_ts, result.last_ts))
+    message = f"Imported {result.inserted} new readings from {first} to {last}."
+    if result.rolled_up:
+        message += (f" {result.rolled_up} older readings were added to your compacted history as 15-minute "
+                    "and hourly averages.")
+    if result.dropped:
+        message += f" {result.dropped} readings fall in compacted periods that already have data and were not added."
+    stored = result.read - result.inserted - result.rolled_up - result.dropped
+    if stored:
+        message += f" {stored} were already stored."
+    if result.skipped:
+        message += f" {result.skipped} rows could not be read."
+    return message
+
+
+def import_progress(edit):
+    """A progress(read, inserted) callback for import_readings that calls edit(text) at most every
+    IMPORT_PROGRESS_INTERVAL seconds."""
+    last_edit = time.monotonic()
+
+    def progress(read, inserted):
+        nonlocal last_edit
+        if time.monotonic() - last_edit < IMPORT_PROGRESS_INTERVAL:
+            return
+        last_edit = time.monotonic()
+        edit(f"Importing… {read} readings read, {inserted} new")
+
+    return progress
+
+
+def import_document(user_id: int, file_id: str, progress=None) -> str:
+    """Stream a document into the user's readings; returns the message to show when it is done. Blocking."""
+    try:
+        with open_document(file_id) as response:
+            result = import_readings(user_id, response.iter_content(CHUNK_SIZE), progress)
+    except ImportFormatError as e:
+        return f"Could not import the file: {e}"
+    except Exception:
+        logger.exception(f'Import for user {user_id} failed')
+        return "The import failed, please try again later"
+    logger.info(f'User {user_id} imported {result.inserted} of {result.read} readings')
+    return import_summary(result)
+
+
+def run_import(user_id: int, chat_id: int, message_id: int, file_id: str):
+    """Import a document, editing the status message as the import goes."""
+    def edit(text):
+        try:
+            bot.edit_message_text(text, chat_id, message_id)
+        except apihelper.ApiTelegramException as e:
+            logger.debug(f'Skipped an import progress update: {e}')
+
+    bot.edit_message_text(import_document(user_id, file_id, import_progress(edit)), chat_id, message_id)
+
+
 # callback query handler
 @bot.callback_query_handler(func=lambda call: call.data in buttons)
+@metrics.timed_handler
 def process_callback_main(call):
     if call.data == "entry_glucose_level":
-        bot.send_message(call.message.chat.id, "Please enter your glucose level")
+        send_message(call.message.chat.id, "Please enter your glucose level")
     elif call.data == "request_history":
-        bot.send_message(call.message.chat.id, "Please choose a history option",
-                         reply_markup=InlineKeyboardMarkup(history_keyboard))
+        send_message(call.message.chat.id, "Please choose a history option",
+                     reply_markup=InlineKeyboardMarkup(history_keyboard))
 
 
 @bot.callback_query_handler(func=lambda call: call.data in history_options)
+@metrics.timed_handler
 def process_callback_history(call):
     send_history_data(call.from_user.id, call.message.chat.id, call.data)
 
 
+@bot.callback_query_handler(func=lambda call: call.data.startswith(HISTORY_PAGE_PREFIX))
+@metrics.timed_handler
+def process_callback_history_page(call):
+    edit_history_page(call.from_user.id, call.message.chat.id, call.message.message_id, call.data)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith(CHART_PREFIX))
+@metrics.timed_handler
+def process_callback_chart(call):
+    send_chart(call.from_user.id, call.message.chat.id, call.data[len(CHART_PREFIX):])
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith(STATS_PREFIX))
+@metrics.timed_handler
+def process_callback_stats(call):
+    send_message(call.message.chat.id, stats_message(call.from_user.id, call.data[len(STATS_PREFIX):]))
+
+
+@bot.message_handler(content_types=['document'])
+@metrics.timed_handler
+def handle_document(message):
+    document = message.document
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        send_message(message.chat.id, f"The file is too large to import, the limit is {IMPORT_MAX_BYTES >> 20} MB")
+        return
+    status = bot.send_message(message.chat.id, f"Importing {document.file_name or 'the file'}…")
+    import_executor.submit(run_import, message.from_user.id, message.chat.id, status.message_id, document.file_id)
+
+
 @bot.message_handler(content_types=['text'])
+@metrics.timed_handler
 def handle_message(message):
     user_input = message.text
     user_id = message.from_user.id
     chat_id = message.chat.id
 
     if user_input.isnumeric():
-        mg_dl, mmol_l = insert_glucose_level(user_id, user_input)
-        avg_mg_dl, avg_mmol_l = get_avg(user_id, time_period='60')
-        message = f'Your input has been saved, which is {mg_dl} mg/dl or {mmol_l} mmol/l. \n'
-        message += f'Your avg level is {avg_mg_dl} mg/dl or {avg_mmol_l} mmol/l for the last 60 days.'
-        bot.send_message(chat_id, message)
+        send_message(chat_id, glucose_message(user_id, user_input, message.date))
     elif user_input == "/start":
         handle_start_command(chat_id)
     elif user_input == "/help":
         handle_help_command(chat_id)
     elif user_input == "/a1c":
-        handle_last_a1c(chat_id, user_id)
+        handle_last_a1c(user_id, chat_id)
+    elif user_input == "/stats":
+        handle_stats_command(chat_id)
+    elif user_input == "/import":
+        send_message(chat_id, IMPORT_TEXT)
+    elif user_input == "/digest":
+        handle_digest_command(user_id, chat_id)
+    elif user_input == "/digest off":
+        handle_digest_command(user_id, chat_id, enable=False)
+    elif user_input == "/predict":
+        send_message(chat_id, predict_message(user_id))
+    elif user_input == "/perf":
+        handle_perf_command(user_id, chat_id)
     else:
         handle_invalid_input(chat_id)
 
 
 if __name__ == "__main__":
-    bot.polling()
+    init_db()
+    metrics.instrument_telegram()
+    if getattr(config, 'OUTBOX', True):
+        outbox = Outbox(bot, global_rate=getattr(config, 'OUTBOX_GLOBAL_RATE', GLOBAL_RATE),
+                        chat_rate=getattr(config, 'OUTBOX_CHAT_RATE', CHAT_RATE),
+                        senders=getattr(config, 'OUTBOX_SENDERS', SENDERS)).start()
+    if getattr(config, 'DIGEST', True):
+        # Without the outbox the digest paces its own sends
+        DigestJob(send_digest, digest_message, hour=DIGEST_SEND_HOUR,
+                  rate=None if outbox is not None else getattr(config, 'OUTBOX_GLOBAL_RATE', GLOBAL_RATE)).start()
+    # Compaction deletes raw readings for good, so it only runs when config.RETENTION is set; readings older
+    # than RETENTION_RAW_DAYS then become 15-minute averages, and those older than RETENTION_ROLLUP_DAYS hourly ones
+    if getattr(config, 'RETENTION', False):
+        RetentionJob(interval=getattr(config, 'RETENTION_INTERVAL', INTERVAL),
+                     raw_days=getattr(config, 'RETENTION_RAW_DAYS', RAW_DAYS),
+                     rollup_days=getattr(config, 'RETENTION_ROLLUP_DAYS', ROLLUP_DAYS)).start()
+    if forecasters:
+        ForecastJob(forecasters.values(), interval=getattr(config, 'NIGHTSCOUT_SYNC_INTERVAL', SYNC_INTERVAL)).start()
+    if getattr(config, 'METRICS_PORT', None):
+        metrics.start_http_server(config.METRICS_PORT, getattr(config, 'METRICS_HOST', '0.0.0.0'))
+    if getattr(config, 'MODE', 'polling') == 'webhook':
+        import webhook
+        webhook.serve(bot, config.WEBHOOK_URL,
+                      host=getattr(config, 'WEBHOOK_HOST', '0.0.0.0'),
+                      port=getattr(config, 'WEBHOOK_PORT', 8443),
+                      path=getattr(config, 'WEBHOOK_PATH', '/'),
+                      secret_token=getattr(config, 'WEBHOOK_SECRET', None),
+                      workers=getattr(config, 'WEBHOOK_WORKERS', 4),
+                      queue_size=getattr(config, 'WEBHOOK_QUEUE_SIZE', 1000))
+    elif getattr(config, 'MODE', 'polling') == 'dispatcher':
+        import dispatcher
+        dispatcher.serve(config.TOKEN, 'main:bot', workers=getattr(config, 'DISPATCHER_WORKERS', 4))
+    else:
+        bot.polling()
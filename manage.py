@@ -0,0 +1,76 @@
+# manage.py
+"""Maintenance commands for the bot database.
+
+Usage: python manage.py migrate [--batch-size N]
+       python manage.py check-stats [--fix]
+       python manage.py compact [--raw-days N] [--rollup-days N] [--batch-size N]
+"""
+import argparse
+import logging
+import sys
+
+import database
+import migrations
+import retention
+
+
+def cmd_migrate(args):
+    conn = database.get_connection()
+    before = migrations.get_version(conn)
+    applied = migrations.migrate(conn, batch_size=args.batch_size)
+    if applied:
+        print(f"Migrated schema from version {before} to {applied[-1]}")
+    else:
+        print(f"Schema is up to date (version {before})")
+
+
+def cmd_check_stats(args):
+    mismatches = database.check_daily_stats()
+    for user_id, day, stored, expected in mismatches:
+        print(f"user {user_id} day {day}: stored {stored}, expected {expected}")
+    print(f"{len(mismatches)} mismatched daily_stats buckets")
+    if mismatches and args.fix:
+        database.rebuild_daily_stats()
+        print("daily_stats rebuilt from user_inputs")
+    return 1 if mismatches and not args.fix else 0
+
+
+def cmd_compact(args):
+    result = retention.compact(raw_days=args.raw_days, rollup_days=args.rollup_days, batch_size=args.batch_size)
+    print(f"Compacted {result.readings} readings and {result.buckets} 15-minute buckets of {result.users} users")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', help='database file (default: database.DB_FILE)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate', help='apply pending schema migrations in place')
+    migrate_parser.add_argument('--batch-size', type=int, default=migrations.DEFAULT_BATCH_SIZE,
+                                help='rows moved per transaction')
+    migrate_parser.set_defaults(func=cmd_migrate)
+
+    check_parser = subparsers.add_parser('check-stats', help='diff daily_stats against a rebuild from user_inputs')
+    check_parser.add_argument('--fix', action='store_true', help='rebuild daily_stats when they differ')
+    check_parser.set_defaults(func=cmd_check_stats)
+
+    compact_parser = subparsers.add_parser('compact', help='move old readings into 15-minute and hourly rollups')
+    compact_parser.add_argument('--raw-days', type=int, default=retention.RAW_DAYS,
+                                help='days of raw readings to keep')
+    compact_parser.add_argument('--rollup-days', type=int, default=retention.ROLLUP_DAYS,
+                                help='days of 15-minute rollups to keep before they become hourly')
+    compact_parser.add_argument('--batch-size', type=int, default=retention.BATCH_SIZE,
+                                help='rows moved per transaction')
+    compact_parser.set_defaults(func=cmd_compact)
+
+    args = parser.parse_args(argv)
+    if args.db:
+        database.DB_FILE = args.db
+    status = args.func(args)
+    database.close_connections()
+    return status or 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(funcName)s - %(levelname)s - %(message)s')
+    sys.exit(main())
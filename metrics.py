@@ -0,0 +1,344 @@
+# metrics.py
+"""In-process latency and load metrics, exported in the Prometheus text format.
+
+Handlers, database.py queries and Telegram API calls are timed into fixed-bucket histograms.
+Each handler invocation also counts the database rows it read: the queries add to a per-request
+tally held in a context variable, and the handler wrapper observes it when the request ends.
+Queue depths are gauges sampled on scrape. Everything is kept in the process, behind one lock
+per histogram, so recording a sample costs under a microsecond.
+"""
+import contextvars
+import functools
+import inspect
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency buckets, seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the rows-per-request buckets
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+PREFIX = 't1d_'
+
+# [rows read] of the request being handled in this thread or task
+_request_rows = contextvars.ContextVar('request_rows', default=None)
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Histogram:
+    """Cumulative-bucket histogram of one labelled series."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def clear(self):
+        with self._lock:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.sum = 0.0
+            self.count = 0
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket it falls in (None without samples)."""
+        counts, _, count = self.snapshot()
+        if not count:
+            return None
+        rank, seen = q * count, 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Registry:
+    """Metric families by name, each a map of label tuples to a series."""
+
+    def __init__(self):
+        self.enabled = True
+        self._histograms = {}  # name -> (help, {labels: Histogram})
+        self._counters = {}  # name -> (help, {labels: [value]})
+        self._gauges = {}  # name -> (help, {labels: callable})
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help_text='', buckets=LATENCY_BUCKETS, **labels) -> Histogram:
+        key = tuple(sorted(labels.items()))
+        family = self._histograms.get(name)
+        series = family[1].get(key) if family else None
+        if series is None:
+            with self._lock:
+                family = self._histograms.setdefault(name, (help_text, {}))
+                series = family[1].setdefault(key, Histogram(buckets))
+        return series
+
+    def inc(self, name, amount=1, help_text='', **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._counters.setdefault(name, (help_text, {}))
+            family[1].setdefault(key, [0])[0] += amount
+
+    def gauge(self, name, read, help_text='', **labels):
+        """Register ``read()`` as the value of a gauge, sampled when metrics are rendered."""
+        with self._lock:
+            self._gauges.setdefault(name, (help_text, {}))[1][tuple(sorted(labels.items()))] = read
+
+    def remove_gauge(self, name, **labels):
+        with self._lock:
+            self._gauges.get(name, ('', {}))[1].pop(tuple(sorted(labels.items())), None)
+
+    def histograms(self):
+        with self._lock:
+            return [(name, labels, series) for name, (_, family) in self._histograms.items()
+                    for labels, series in family.items()]
+
+    def gauges(self):
+        with self._lock:
+            return [(name, labels, read) for name, (_, family) in self._gauges.items()
+                    for labels, read in family.items()]
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        with self._lock:
+            histograms = {name: (help_text, dict(family)) for name, (help_text, family) in self._histograms.items()}
+            counters = {name: (help_text, {k: v[0] for k, v in family.items()})
+                        for name, (help_text, family) in self._counters.items()}
+            gauges = {name: (help_text, dict(family)) for name, (help_text, family) in self._gauges.items()}
+        lines = []
+        for name, (help_text, family) in sorted(histograms.items()):
+            lines += [f'# HELP {PREFIX}{name} {help_text}', f'# TYPE {PREFIX}{name} histogram']
+            for labels, series in sorted(family.items()):
+                counts, total, count = series.snapshot()
+                cumulative = 0
+                for bound, n in zip(series.buckets + (float('inf'),), counts):
+                    cumulative += n
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{PREFIX}{name}_bucket{_format_labels(labels + (("le", le),))} {cumulative}')
+                lines.append(f'{PREFIX}{name}_sum{_format_labels(labels)} {total}')
+                lines.append(f'{PREFIX}{name}_count{_format_labels(labels)} {count}')
+        for name, (help_text, family) in sorted(counters.items()):
+            lines += [f'# HELP {PREFIX}{name} {help_text}', f'# TYPE {PREFIX}{name} counter']
+            lines += [f'{PREFIX}{name}{_format_labels(labels)} {value}' for labels, value in sorted(family.items())]
+        for name, (help_text, family) in sorted(gauges.items()):
+            lines += [f'# HELP {PREFIX}{name} {help_text}', f'# TYPE {PREFIX}{name} gauge']
+            for labels, read in sorted(family.items(), key=lambda item: item[0]):
+                try:
+                    value = read()
+                except Exception:
+                    logger.exception(f'Failed to read gauge {name}')
+                    continue
+                lines.append(f'{PREFIX}{name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """Zero every histogram and drop the counters; instrumented functions keep their series."""
+        for _, _, series in self.histograms():
+            series.clear()
+        with self._lock:
+            self._counters.clear()
+
+
+registry = Registry()
+
+
+def add_rows(count):
+    """Count database rows read by the request being handled, if any."""
+    rows = _request_rows.get()
+    if rows is not None:
+        rows[0] += count
+
+
+def timed_handler(func):
+    """Time a bot handler (sync or async) and record the database rows it read."""
+    name = func.__name__
+    latency = registry.histogram('handler_seconds', 'Update handler latency', handler=name)
+    rows_read = registry.histogram('request_rows_read', 'Database rows read per handled update', ROW_BUCKETS,
+                                   handler=name)
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return await func(*args, **kwargs)
+            rows, start = [0], time.perf_counter()
+            token = _request_rows.set(rows)
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                registry.inc('handler_errors_total', help_text='Handler exceptions', handler=name)
+                raise
+            finally:
+                _request_rows.reset(token)
+                latency.observe(time.perf_counter() - start)
+                rows_read.observe(rows[0])
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not registry.enabled:
+            return func(*args, **kwargs)
+        rows, start = [0], time.perf_counter()
+        token = _request_rows.set(rows)
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            registry.inc('handler_errors_total', help_text='Handler exceptions', handler=name)
+            raise
+        finally:
+            _request_rows.reset(token)
+            latency.observe(time.perf_counter() - start)
+            rows_read.observe(rows[0])
+    return wrapper
+
+
+def timed_query(func):
+    """Time a database.py query function. Generator functions are timed until they are exhausted
+    or closed, and only the rows actually consumed are counted."""
+    histogram = registry.histogram('db_query_seconds', 'database.py query latency', query=func.__name__)
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            if not registry.enabled:
+                yield from func(*args, **kwargs)
+                return
+            start, count = time.perf_counter(), 0
+            rows = func(*args, **kwargs)
+            try:
+                for row in rows:
+                    count += 1
+                    yield row
+            finally:
+                rows.close()
+                histogram.observe(time.perf_counter() - start)
+                add_rows(count)
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not registry.enabled:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return wrapper
+
+
+def instrument_telegram():
+    """Time every Bot API request of the sync and asyncio telebot clients, labelled by API method.
+
+    Both clients send all requests through one module-level function, which is wrapped once.
+    """
+    from telebot import apihelper, asyncio_helper
+
+    if getattr(apihelper._make_request, '_timed', False):
+        return
+
+    make_request = apihelper._make_request
+
+    @functools.wraps(make_request)
+    def timed_make_request(token, method_name, *args, **kwargs):
+        if not registry.enabled:
+            return make_request(token, method_name, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return make_request(token, method_name, *args, **kwargs)
+        finally:
+            registry.histogram('telegram_api_seconds', 'Telegram Bot API request latency',
+                               method=method_name).observe(time.perf_counter() - start)
+
+    process_request = asyncio_helper._process_request
+
+    @functools.wraps(process_request)
+    async def timed_process_request(token, url, *args, **kwargs):
+        if not registry.enabled:
+            return await process_request(token, url, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return await process_request(token, url, *args, **kwargs)
+        finally:
+            registry.histogram('telegram_api_seconds', 'Telegram Bot API request latency',
+                               method=url).observe(time.perf_counter() - start)
+
+    timed_make_request._timed = True
+    apihelper._make_request = timed_make_request
+    asyncio_helper._process_request = timed_process_request
+
+
+def executor_queue_depth(executor):
+    """Work items waiting in a concurrent.futures.ThreadPoolExecutor."""
+    return lambda: executor._work_queue.qsize()
+
+
+def summary(limit=4000) -> str:
+    """Plain-text digest for the /perf command: count, mean and p50/p95 bucket bounds per series."""
+    lines = []
+    for name, labels, series in sorted(registry.histograms(), key=lambda item: (item[0], item[1])):
+        _, total, count = series.snapshot()
+        if not count:
+            continue
+        label = ','.join(str(value) for _, value in labels)
+        if name == 'request_rows_read':
+            lines.append(f'{name} {label}: n={count} mean={total / count:.0f} p95<={series.quantile(0.95)}')
+        else:
+            lines.append(f'{name} {label}: n={count} mean={total / count * 1000:.1f}ms '
+                         f'p50<={series.quantile(0.5) * 1000:g}ms p95<={series.quantile(0.95) * 1000:g}ms')
+    for name, labels, read in registry.gauges():
+        try:
+            lines.append(f'{name} {",".join(str(v) for _, v in labels)}: {read()}')
+        except Exception:
+            continue
+    text = '\n'.join(lines) or 'No samples yet'
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def start_http_server(port, host='0.0.0.0'):
+    """Serve /metrics from a daemon thread; returns the server (shutdown() to stop it)."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info(f'Serving metrics on {host}:{server.server_address[1]}/metrics')
+    return server
@@ -0,0 +1,331 @@
+# migrations.py
+"""Versioned schema for the bot database.
+
+The schema version lives in SQLite's ``PRAGMA user_version``. Every migration step moves the
+database from version ``n - 1`` to ``n`` and must be safe to re-run if it was interrupted.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 10000
+
+# Readings are clustered on (user_id, ts), so a per-user time range is a single index range scan.
+# Column order keeps the legacy (timestamp, user_id, mg_dl, mmol_l) row shape.
+USER_INPUTS_DDL = '''CREATE TABLE IF NOT EXISTS {} (
+    ts INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    mg_dl REAL,
+    mmol_l REAL,
+    PRIMARY KEY (user_id, ts)
+) WITHOUT ROWID'''
+
+
+SECONDS_PER_DAY = 86400
+
+# Per-user daily buckets over user_inputs, kept in step with it by triggers so every write to the raw
+# table (single inserts, batches, deletes) updates the buckets in the same transaction.
+DAILY_STATS_DDL = '''CREATE TABLE IF NOT EXISTS daily_stats (
+    user_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    sum_mg_dl REAL NOT NULL,
+    sumsq_mg_dl REAL NOT NULL,
+    PRIMARY KEY (user_id, day)
+) WITHOUT ROWID'''
+
+DAILY_STATS_TRIGGERS = (
+    f'''CREATE TRIGGER IF NOT EXISTS user_inputs_daily_stats_insert AFTER INSERT ON user_inputs BEGIN
+        INSERT INTO daily_stats (user_id, day, n, sum_mg_dl, sumsq_mg_dl)
+        VALUES (NEW.user_id, NEW.ts / {SECONDS_PER_DAY}, 1, NEW.mg_dl, NEW.mg_dl * NEW.mg_dl)
+        ON CONFLICT (user_id, day) DO UPDATE SET n = n + 1, sum_mg_dl = sum_mg_dl + excluded.sum_mg_dl,
+                                                 sumsq_mg_dl = sumsq_mg_dl + excluded.sumsq_mg_dl;
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS user_inputs_daily_stats_delete AFTER DELETE ON user_inputs BEGIN
+        UPDATE daily_stats SET n = n - 1, sum_mg_dl = sum_mg_dl - OLD.mg_dl,
+                               sumsq_mg_dl = sumsq_mg_dl - OLD.mg_dl * OLD.mg_dl
+        WHERE user_id = OLD.user_id AND day = OLD.ts / {SECONDS_PER_DAY};
+        DELETE FROM daily_stats WHERE user_id = OLD.user_id AND day = OLD.ts / {SECONDS_PER_DAY} AND n <= 0;
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS user_inputs_daily_stats_update AFTER UPDATE OF ts, user_id, mg_dl ON user_inputs
+    BEGIN
+        UPDATE daily_stats SET n = n - 1, sum_mg_dl = sum_mg_dl - OLD.mg_dl,
+                               sumsq_mg_dl = sumsq_mg_dl - OLD.mg_dl * OLD.mg_dl
+        WHERE user_id = OLD.user_id AND day = OLD.ts / {SECONDS_PER_DAY};
+        DELETE FROM daily_stats WHERE user_id = OLD.user_id AND day = OLD.ts / {SECONDS_PER_DAY} AND n <= 0;
+        INSERT INTO daily_stats (user_id, day, n, sum_mg_dl, sumsq_mg_dl)
+        VALUES (NEW.user_id, NEW.ts / {SECONDS_PER_DAY}, 1, NEW.mg_dl, NEW.mg_dl * NEW.mg_dl)
+        ON CONFLICT (user_id, day) DO UPDATE SET n = n + 1, sum_mg_dl = sum_mg_dl + excluded.sum_mg_dl,
+                                                 sumsq_mg_dl = sumsq_mg_dl + excluded.sumsq_mg_dl;
+    END''',
+)
+
+# Daily buckets computed from the raw readings, used for the backfill and by the consistency checker.
+DAILY_STATS_FROM_RAW = f'''SELECT user_id, ts / {SECONDS_PER_DAY} AS day, COUNT(*), SUM(mg_dl), SUM(mg_dl * mg_dl)
+    FROM user_inputs WHERE user_id BETWEEN ? AND ? GROUP BY user_id, day'''
+
+# Local copy of Nightscout data, with only the fields the analyzer reads, and per-source sync cursors.
+# ``source`` is the Nightscout base URL, so several sites can share one database.
+NIGHTSCOUT_DDL = (
+    '''CREATE TABLE IF NOT EXISTS ns_entries (
+        source TEXT NOT NULL,
+        date INTEGER NOT NULL,
+        sgv INTEGER NOT NULL,
+        date_string TEXT NOT NULL,
+        PRIMARY KEY (source, date)
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS ns_treatments (
+        source TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        id TEXT NOT NULL,
+        event_type TEXT,
+        insulin REAL,
+        carbs REAL,
+        PRIMARY KEY (source, created_at, id)
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS ns_sync_state (
+        source TEXT NOT NULL,
+        collection TEXT NOT NULL,
+        high_water NOT NULL,
+        PRIMARY KEY (source, collection)
+    ) WITHOUT ROWID''',
+)
+
+
+# A counter per source that moves whenever a cached row is changed behind what the sync had already
+# stored: an entry or treatment inserted at or below the collection's high-water mark, or any update or
+# delete. Rows a sync appends above the mark leave it alone, so readers holding state built from the
+# cache (forecast.SiteForecaster) can tell with one lookup whether that state still matches it.
+NIGHTSCOUT_CHANGES_DDL = '''CREATE TABLE IF NOT EXISTS ns_changes (
+    source TEXT PRIMARY KEY,
+    changes INTEGER NOT NULL
+) WITHOUT ROWID'''
+
+_BUMP_CHANGES = '''INSERT INTO ns_changes (source, changes) VALUES ({}.source, 1)
+        ON CONFLICT (source) DO UPDATE SET changes = changes + 1;'''
+
+NIGHTSCOUT_CHANGES_TRIGGERS = tuple(
+    trigger
+    for table, collection, key in (('ns_entries', 'entries', 'NEW.date'),
+                                   ('ns_treatments', 'treatments', 'NEW.created_at'))
+    for trigger in (
+        f'''CREATE TRIGGER IF NOT EXISTS {table}_changes_insert AFTER INSERT ON {table}
+        WHEN {key} <= (SELECT high_water FROM ns_sync_state WHERE source = NEW.source AND collection = '{collection}')
+        BEGIN
+            {_BUMP_CHANGES.format('NEW')}
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS {table}_changes_update AFTER UPDATE ON {table} BEGIN
+            {_BUMP_CHANGES.format('NEW')}
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS {table}_changes_delete AFTER DELETE ON {table} BEGIN
+            {_BUMP_CHANGES.format('OLD')}
+        END''',
+    )
+)
+
+
+# Tiered retention: readings older than a user's ``raw_before`` are compacted into 15-minute rollups, and
+# rollups older than ``rollup_before`` into hourly ones (retention.py). Bucket rows carry the moments of
+# the readings they replace, so daily_stats can be rebuilt from every tier. Buckets start on multiples of
+# their length in epoch seconds and so never straddle a UTC day.
+ROLLUP_DDL = '''CREATE TABLE IF NOT EXISTS {} (
+    user_id INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    sum_mg_dl REAL NOT NULL,
+    sumsq_mg_dl REAL NOT NULL,
+    min_mg_dl REAL NOT NULL,
+    max_mg_dl REAL NOT NULL,
+    PRIMARY KEY (user_id, ts)
+) WITHOUT ROWID'''
+
+ROLLUP_TABLES = {'rollup_15m': 900, 'rollup_1h': 3600}
+
+RETENTION_STATE_DDL = '''CREATE TABLE IF NOT EXISTS retention_state (
+    user_id INTEGER PRIMARY KEY,
+    raw_before INTEGER NOT NULL,
+    rollup_before INTEGER NOT NULL
+) WITHOUT ROWID'''
+
+RETENTION_TRIGGERS = (
+    # Readings older than the compacted horizon would be counted twice once compacted again, so they are
+    # dropped; the rollups already hold that period. Imports add them to the rollups with retention.roll_in.
+    '''CREATE TRIGGER IF NOT EXISTS user_inputs_retention_guard BEFORE INSERT ON user_inputs
+    WHEN NEW.ts < (SELECT raw_before FROM retention_state WHERE user_id = NEW.user_id) BEGIN
+        SELECT RAISE(IGNORE);
+    END''',
+    # Compaction deletes readings below the horizon it has just moved up; daily_stats keeps counting them.
+    f'''CREATE TRIGGER IF NOT EXISTS user_inputs_daily_stats_delete AFTER DELETE ON user_inputs
+    WHEN OLD.ts >= IFNULL((SELECT raw_before FROM retention_state WHERE user_id = OLD.user_id), OLD.ts) BEGIN
+        UPDATE daily_stats SET n = n - 1, sum_mg_dl = sum_mg_dl - OLD.mg_dl,
+                               sumsq_mg_dl = sumsq_mg_dl - OLD.mg_dl * OLD.mg_dl
+        WHERE user_id = OLD.user_id AND day = OLD.ts / {SECONDS_PER_DAY};
+        DELETE FROM daily_stats WHERE user_id = OLD.user_id AND day = OLD.ts / {SECONDS_PER_DAY} AND n <= 0;
+    END''',
+)
+
+# Daily buckets computed from every storage tier, used by the consistency checker and rebuild.
+DAILY_STATS_FROM_TIERS = f'''SELECT user_id, day, SUM(n), SUM(sum_mg_dl), SUM(sumsq_mg_dl) FROM (
+        SELECT user_id, ts / {SECONDS_PER_DAY} AS day, COUNT(*) AS n, SUM(mg_dl) AS sum_mg_dl,
+               SUM(mg_dl * mg_dl) AS sumsq_mg_dl
+        FROM user_inputs WHERE user_id BETWEEN ?1 AND ?2 GROUP BY user_id, day
+        UNION ALL
+        SELECT user_id, ts / {SECONDS_PER_DAY}, n, sum_mg_dl, sumsq_mg_dl
+        FROM rollup_15m WHERE user_id BETWEEN ?1 AND ?2
+        UNION ALL
+        SELECT user_id, ts / {SECONDS_PER_DAY}, n, sum_mg_dl, sumsq_mg_dl
+        FROM rollup_1h WHERE user_id BETWEEN ?1 AND ?2
+    ) GROUP BY user_id, day'''
+
+
+# Users who asked for the daily digest, and one row per digest day recording how far its sends have got,
+# so an interrupted run resumes after the last user whose message went out.
+DIGEST_DDL = (
+    '''CREATE TABLE IF NOT EXISTS digest_subscriptions (
+        user_id INTEGER PRIMARY KEY,
+        chat_id INTEGER NOT NULL
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS digest_runs (
+        day INTEGER PRIMARY KEY,
+        last_user_id INTEGER NOT NULL,
+        sent INTEGER NOT NULL,
+        failed INTEGER NOT NULL,
+        finished_at INTEGER
+    ) WITHOUT ROWID''',
+)
+
+
+def get_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def _set_version(conn, version):
+    conn.execute(f'PRAGMA user_version = {int(version)}')
+    conn.commit()
+
+
+def _table_exists(conn, table_name):
+    c = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
+    return c.fetchone() is not None
+
+
+def _columns(conn, table_name):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table_name})')]
+
+
+def _v1_legacy_table(conn, batch_size):
+    """Version 1: the original text-timestamp table, without keys or indexes."""
+    if not _table_exists(conn, 'user_inputs'):
+        conn.execute('CREATE TABLE user_inputs (timestamp TIMESTAMP, user_id INTEGER, mg_dl REAL, mmol_l REAL)')
+        conn.commit()
+
+
+def _v2_epoch_timestamps(conn, batch_size):
+    """Version 2: integer epoch timestamps, clustered on (user_id, ts).
+
+    Legacy rows are moved into the new table in batches of ``batch_size``; each batch is copied and
+    deleted from ``user_inputs_v1`` in one transaction, so an interrupted run resumes where it stopped.
+    Legacy text timestamps were written by SQLite's ``datetime('now')`` and are read as UTC.
+    """
+    if 'timestamp' in _columns(conn, 'user_inputs'):
+        with conn:
+            conn.execute('ALTER TABLE user_inputs RENAME TO user_inputs_v1')
+            conn.execute(USER_INPUTS_DDL.format('user_inputs'))
+    if not _table_exists(conn, 'user_inputs_v1'):
+        return
+
+    moved = skipped = 0
+    while True:
+        with conn:
+            last = conn.execute('SELECT MAX(rowid) FROM (SELECT rowid FROM user_inputs_v1 ORDER BY rowid LIMIT ?)',
+                                (batch_size,)).fetchone()[0]
+            if last is None:
+                break
+            c = conn.execute("INSERT OR IGNORE INTO user_inputs (ts, user_id, mg_dl, mmol_l) "
+                             "SELECT CAST(strftime('%s', timestamp) AS INTEGER), user_id, mg_dl, mmol_l "
+                             "FROM user_inputs_v1 WHERE rowid <= ?", (last,))
+            inserted = c.rowcount
+            c = conn.execute('DELETE FROM user_inputs_v1 WHERE rowid <= ?', (last,))
+            moved += inserted
+            skipped += c.rowcount - inserted
+        logger.info(f'Migrated {moved} rows to user_inputs')
+    if skipped:
+        logger.warning(f'Skipped {skipped} duplicate or unparseable legacy rows')
+    conn.execute('DROP TABLE user_inputs_v1')
+    conn.commit()
+
+
+def _v3_daily_stats(conn, batch_size):
+    """Version 3: per-user daily aggregate buckets maintained by triggers on user_inputs.
+
+    Existing readings are backfilled one range of users at a time, ``batch_size`` users per transaction.
+    """
+    with conn:
+        conn.execute(DAILY_STATS_DDL)
+        for trigger in DAILY_STATS_TRIGGERS:
+            conn.execute(trigger)
+        conn.execute('DELETE FROM daily_stats')
+    user_ids = [row[0] for row in conn.execute('SELECT DISTINCT user_id FROM user_inputs ORDER BY user_id')]
+    for i in range(0, len(user_ids), batch_size):
+        batch = user_ids[i:i + batch_size]
+        with conn:
+            conn.execute(f'INSERT INTO daily_stats (user_id, day, n, sum_mg_dl, sumsq_mg_dl) {DAILY_STATS_FROM_RAW}',
+                         (batch[0], batch[-1]))
+
+
+def _v4_nightscout_cache(conn, batch_size):
+    """Version 4: local cache tables for incremental Nightscout sync."""
+    with conn:
+        for ddl in NIGHTSCOUT_DDL:
+            conn.execute(ddl)
+
+
+def _v5_retention_tiers(conn, batch_size):
+    """Version 5: 15-minute and hourly rollup tables for tiered retention of old readings."""
+    with conn:
+        for table in ROLLUP_TABLES:
+            conn.execute(ROLLUP_DDL.format(table))
+        conn.execute(RETENTION_STATE_DDL)
+        conn.execute('DROP TRIGGER IF EXISTS user_inputs_daily_stats_delete')
+        for trigger in RETENTION_TRIGGERS:
+            conn.execute(trigger)
+
+
+def _v6_digest(conn, batch_size):
+    """Version 6: daily digest subscriptions and run progress."""
+    with conn:
+        for ddl in DIGEST_DDL:
+            conn.execute(ddl)
+
+
+def _v7_nightscout_changes(conn, batch_size):
+    """Version 7: per-source change counter of the Nightscout cache, maintained by triggers."""
+    with conn:
+        conn.execute(NIGHTSCOUT_CHANGES_DDL)
+        for trigger in NIGHTSCOUT_CHANGES_TRIGGERS:
+            conn.execute(trigger)
+
+
+MIGRATIONS = [
+    (1, _v1_legacy_table),
+    (2, _v2_epoch_timestamps),
+    (3, _v3_daily_stats),
+    (4, _v4_nightscout_cache),
+    (5, _v5_retention_tiers),
+    (6, _v6_digest),
+    (7, _v7_nightscout_changes),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(conn, batch_size=DEFAULT_BATCH_SIZE):
+    """Bring the database behind ``conn`` up to SCHEMA_VERSION. Returns the list of applied versions."""
+    applied = []
+    for version, step in MIGRATIONS:
+        if get_version(conn) >= version:
+            continue
+        logger.info(f'Applying schema migration {step.__doc__.splitlines()[0]}')
+        step(conn, batch_size)
+        _set_version(conn, version)
+        applied.append(version)
+    return applied
@@ -0,0 +1,203 @@
+# nightscout_sync.py
+"""Incremental sync of a Nightscout site's entries and treatments into the bot database.
+
+Each collection is paged newest first with a date cursor (``count`` rows per request) down to the
+high-water mark stored by the previous run, so after the first run only new data is downloaded.
+Response bodies are streamed and decoded one JSON object at a time, and every page is written in
+one transaction. The high-water mark moves only once a run has reached it, so an interrupted run
+simply fetches the same range again; entries already stored are ignored, and treatments fetched
+again are updated in place.
+"""
+import json
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import database
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_TIMEOUT = 30
+CHUNK_SIZE = 64 * 1024
+
+# collection -> the date field its pages and high-water mark are keyed on
+CURSORS = {
+    'entries': 'date',
+    'treatments': 'created_at',
+}
+
+
+def iter_json_array(chunks):
+    """Yield the elements of a JSON array arriving as text chunks, without holding the whole body.
+
+    Only complete elements are decoded, so memory is bounded by the largest single element.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos, started, done = '', 0, False, False
+    chunks = iter(chunks)
+    while True:
+        while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ',' or
+                                     (buffer[pos] == '[' and not started)):
+            started = started or buffer[pos] == '['
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == ']':
+            return
+        if pos < len(buffer):
+            if not started:
+                raise ValueError('Expected a JSON array')
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if done:
+                    raise
+            else:
+                if end < len(buffer) or done:
+                    yield value
+                    pos = end
+                    continue
+        if done:
+            raise ValueError('Unterminated JSON array')
+        chunk = next(chunks, None)
+        if chunk is None:
+            done = True
+        else:
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+
+def make_session(token=None, pool_size=4, retries=3):
+    """A requests session with pooled keep-alive connections and retries on transient errors."""
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=('GET',))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if token:
+        session.headers['Authorization'] = f'Bearer {token}'
+    return session
+
+
+class NightscoutSync:
+    """Keeps the ns_entries/ns_treatments tables of one Nightscout site up to date."""
+
+    def __init__(self, url, token=None, page_size=DEFAULT_PAGE_SIZE, session=None, timeout=DEFAULT_TIMEOUT):
+        self.url = url.rstrip('/')
+        self.page_size = page_size
+        self.timeout = timeout
+        self.session = session or make_session(token)
+        self.requests = 0
+        self.fetched = {'entries': 0, 'treatments': 0}
+        database.init_db()
+
+    def _conn(self):
+        return database.get_connection()
+
+    def high_water(self, collection):
+        row = self._conn().execute('SELECT high_water FROM ns_sync_state WHERE source=? AND collection=?',
+                                   (self.url, collection)).fetchone()
+        return row[0] if row else None
+
+    def _iter_page(self, collection, newer_than, older_than, inclusive):
+        field = CURSORS[collection]
+        params = {'count': self.page_size}
+        if newer_than is not None:
+            params[f'find[{field}][$gt]'] = newer_than
+        if older_than is not None:
+            params[f'find[{field}][{"$lte" if inclusive else "$lt"}]'] = older_than
+        self.requests += 1
+        with self.session.get(f'{self.url}/api/v1/{collection}.json', params=params, timeout=self.timeout,
+                              stream=True) as response:
+            response.raise_for_status()
+            response.encoding = response.encoding or 'utf-8'
+            yield from iter_json_array(response.iter_content(CHUNK_SIZE, decode_unicode=True))
+
+    def _store(self, collection, rows):
+        conn = self._conn()
+        with conn:
+            if collection == 'entries':
+                conn.executemany('INSERT OR IGNORE INTO ns_entries (source, date, sgv, date_string) '
+                                 'VALUES (?, ?, ?, ?)', rows)
+            else:
+                # A treatment fetched again may have been edited on the site since; one that was not is left
+                # as it is, so ns_changes only moves for real edits
+                conn.executemany('INSERT INTO ns_treatments (source, created_at, id, event_type, insulin, carbs) '
+                                 'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (source, created_at, id) DO UPDATE SET '
+                                 'event_type = excluded.event_type, insulin = excluded.insulin, carbs = excluded.carbs '
+                                 'WHERE event_type IS NOT excluded.event_type OR insulin IS NOT excluded.insulin '
+                                 'OR carbs IS NOT excluded.carbs', rows)
+
+    def _row(self, collection, doc):
+        if collection == 'entries':
+            if doc.get('sgv') is None or doc.get('date') is None:
+                return None
+            return self.url, int(doc['date']), int(doc['sgv']), doc.get('dateString', '')
+        if not doc.get('created_at'):
+            return None
+        return (self.url, doc['created_at'], str(doc.get('_id') or doc.get('eventType')), doc.get('eventType'),
+                doc.get('insulin'), doc.get('carbs'))
+
+    def sync_collection(self, collection):
+        """Fetch everything newer than the collection's high-water mark; returns the documents downloaded."""
+        field = CURSORS[collection]
+        high_water = self.high_water(collection)
+        cursor, inclusive, newest, fetched = None, False, None, 0
+        while True:
+            rows, oldest, count = [], None, 0
+            for doc in self._iter_page(collection, high_water, cursor, inclusive):
+                count += 1
+                value = doc.get(field)
+                if value is not None:
+                    newest = value if newest is None or value > newest else newest
+                    oldest = value if oldest is None or value < oldest else oldest
+                row = self._row(collection, doc)
+                if row is not None:
+                    rows.append(row)
+            self._store(collection, rows)
+            fetched += count
+            if count < self.page_size or oldest is None:
+                break
+            # Ask for the boundary value again so documents sharing it are not skipped, unless a whole
+            # page shares it, which would never move the cursor
+            inclusive = oldest != cursor
+            cursor = oldest
+        if newest is not None:
+            conn = self._conn()
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO ns_sync_state (source, collection, high_water) VALUES (?, ?, ?)',
+                             (self.url, collection, newest))
+        self.fetched[collection] += fetched
+        logger.info(f'Synced {fetched} {collection} from {self.url}')
+        return fetched
+
+    def sync(self):
+        """Bring both collections up to date; returns {collection: documents downloaded}."""
+        return {collection: self.sync_collection(collection) for collection in CURSORS}
+
+    def rows(self, start_time=None, end_time=None):
+        """(entries, treatments) cursors over the local cache, oldest first.
+
+        Entries are (date, sgv, date_string) rows and treatments (created_at, event_type, insulin, carbs)
+        rows. ``start_time``/``end_time`` are ISO strings as produced by get_start_end_time.
+        """
+        conn = self._conn()
+        lo = database.to_epoch(start_time.replace('Z', '+00:00')) * 1000 if start_time else -2 ** 63
+        hi = database.to_epoch(end_time.replace('Z', '+00:00')) * 1000 if end_time else 2 ** 63 - 1
+        entries = conn.execute('SELECT date, sgv, date_string FROM ns_entries WHERE source=? AND date BETWEEN ? AND ? '
+                               'ORDER BY date', (self.url, lo, hi))
+        treatments = conn.execute('SELECT created_at, event_type, insulin, carbs FROM ns_treatments WHERE source=? '
+                                  'ORDER BY created_at', (self.url,))
+        return entries, treatments
+
+    def load(self, start_time=None, end_time=None):
+        """Return (entries, treatments) from the local cache, shaped like the API documents, oldest first.
+
+        Every row becomes a dict; analyzers read rows() into columns instead.
+        """
+        entries, treatments = self.rows(start_time, end_time)
+        return ([{'sgv': sgv, 'date': date, 'dateString': date_string} for date, sgv, date_string in entries],
+                [{'created_at': created_at, 'eventType': event_type, 'insulin': insulin, 'carbs': carbs}
+                 for created_at, event_type, insulin, carbs in treatments])
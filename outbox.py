@@ -0,0 +1,276 @@
+# outbox.py
+"""Outbound message queue between the handlers and the Telegram API.
+
+Handlers put messages on the queue and return; sender threads deliver them within Telegram's flood
+limits, kept as token buckets: one for the whole bot and one per chat. The next message sent is the
+most urgent one (lowest priority value, then oldest) among the chats whose bucket has a token, so
+interactive replies overtake queued bulk messages. A chat has at most one request in flight, which
+keeps its messages in order. Consecutive plain texts queued for the same chat go out as one message
+while they fit. A 429 reply blocks the chat for its ``retry_after`` and puts the message back at the
+head of the chat's queue.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from telebot.apihelper import ApiTelegramException
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Priorities, most urgent first
+INTERACTIVE = 0
+BULK = 10
+
+# Telegram allows about 30 messages per second overall and about one per second in a chat
+GLOBAL_RATE = 25
+GLOBAL_BURST = 5
+CHAT_RATE = 1.0
+CHAT_BURST = 3
+SENDERS = 4
+TEXT_LIMIT = 4096
+MERGE_SEPARATOR = '\n\n'
+# How often chats with nothing queued and a full bucket are forgotten, seconds
+PRUNE_INTERVAL = 60
+
+
+class TokenBucket:
+    """``rate`` tokens per second, holding at most ``burst``; one token per message."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now) -> float:
+        """Seconds until a token can be taken."""
+        self._refill(now)
+        refill = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(refill, self.blocked_until - now)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block_until(self, until):
+        self.blocked_until = max(self.blocked_until, until)
+
+    def full(self, now) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst and self.blocked_until <= now
+
+
+class _Message:
+    __slots__ = ('key', 'text', 'kwargs', 'futures', 'queued_at')
+
+    def __init__(self, key, text, kwargs, future, queued_at):
+        self.key = key  # (priority, sequence number)
+        self.text = text
+        self.kwargs = kwargs
+        self.futures = [future]
+        self.queued_at = queued_at
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+    def mergeable(self):
+        return not self.kwargs
+
+
+class _Chat:
+    __slots__ = ('bucket', 'pending', 'busy', 'entry', 'sleeping')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.pending = []  # heap of _Message
+        self.busy = False
+        self.entry = None  # the key this chat is queued under in Outbox._ready
+        self.sleeping = False
+
+
+class Outbox:
+    """Queue for ``bot.send_message`` calls, delivered by ``senders`` threads within the rate limits."""
+
+    def __init__(self, bot, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST, chat_rate=CHAT_RATE,
+                 chat_burst=CHAT_BURST, senders=SENDERS):
+        now = time.monotonic()
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.pending = 0
+        self.sent = 0
+        self.merged = 0
+        self.retried = 0
+        self._global = TokenBucket(global_rate, global_burst, now)
+        self._chats = {}
+        self._ready = []  # heap of (priority, sequence number, chat_id), the head message of a chat
+        self._sleeping = []  # heap of (wake time, chat_id) for chats waiting on their bucket
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._next_prune = now + PRUNE_INTERVAL
+        self._threads = [threading.Thread(target=self._work, name=f'outbox-sender-{i}', daemon=True)
+                         for i in range(senders)]
+        self._wait_seconds = metrics.registry.histogram('outbox_wait_seconds',
+                                                        'Time from queueing a message to sending it')
+
+    def start(self):
+        metrics.registry.gauge('queue_depth', lambda: self.pending, 'Items waiting in a queue', queue='outbox')
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def send_message(self, chat_id, text, priority=INTERACTIVE, **kwargs) -> Future:
+        """Queue a message; the future resolves to the sent Message (shared by messages merged into it)."""
+        future = Future()
+        with self._cond:
+            now = time.monotonic()
+            message = _Message((priority, next(self._sequence)), text, kwargs, future, now)
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _Chat(TokenBucket(self.chat_rate, self.chat_burst, now))
+            heapq.heappush(chat.pending, message)
+            self.pending += 1
+            if chat.entry is not None and message.key < chat.entry:
+                # A more urgent head: queue the chat again under it, the old entry goes stale
+                self._push_ready(chat_id, chat, message.key)
+            elif chat.entry is None and not chat.busy and not chat.sleeping:
+                self._schedule(chat_id, chat, now)
+            self._cond.notify()
+        return future
+
+    def _push_ready(self, chat_id, chat, key):
+        chat.entry = key
+        heapq.heappush(self._ready, (*key, chat_id))
+
+    def _schedule(self, chat_id, chat, now):
+        """Queue a chat with pending messages as ready, or asleep until its bucket allows a send."""
+        delay = chat.bucket.wait_time(now)
+        if delay > 0:
+            chat.sleeping = True
+            heapq.heappush(self._sleeping, (now + delay, chat_id))
+        else:
+            self._push_ready(chat_id, chat, chat.pending[0].key)
+
+    def _take(self):
+        """Wait for the next message that may be sent; returns (chat_id, chat, message), None once stopped."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._sleeping and self._sleeping[0][0] <= now:
+                    _, chat_id = heapq.heappop(self._sleeping)
+                    chat = self._chats[chat_id]
+                    chat.sleeping = False
+                    self._schedule(chat_id, chat, now)
+                timeout = self._sleeping[0][0] - now if self._sleeping else None
+                if self._ready:
+                    delay = self._global.wait_time(now)
+                    if delay <= 0:
+                        priority, sequence, chat_id = heapq.heappop(self._ready)
+                        chat = self._chats.get(chat_id)
+                        if chat is None or chat.entry != (priority, sequence):
+                            continue
+                        chat.entry = None
+                        chat.busy = True
+                        self._global.take(now)
+                        chat.bucket.take(now)
+                        return chat_id, chat, self._pop_batch(chat)
+                    timeout = delay if timeout is None else min(timeout, delay)
+                elif self._stopping and not self.pending:
+                    return None
+                if now >= self._next_prune:
+                    self._prune(now)
+                self._cond.wait(timeout)
+
+    def _pop_batch(self, chat):
+        """Pop the chat's next message, with the plain texts queued right after it merged in."""
+        message = heapq.heappop(chat.pending)
+        self.pending -= 1
+        while (message.mergeable() and chat.pending and chat.pending[0].mergeable()
+               and len(message.text) + len(MERGE_SEPARATOR) + len(chat.pending[0].text) <= TEXT_LIMIT):
+            following = heapq.heappop(chat.pending)
+            self.pending -= 1
+            self.merged += 1
+            message.text += MERGE_SEPARATOR + following.text
+            message.futures += following.futures
+        return message
+
+    def _prune(self, now):
+        self._next_prune = now + PRUNE_INTERVAL
+        for chat_id in [chat_id for chat_id, chat in self._chats.items()
+                        if not chat.pending and not chat.busy and chat.bucket.full(now)]:
+            del self._chats[chat_id]
+
+    def _work(self):
+        while True:
+            taken = self._take()
+            if taken is None:
+                return
+            chat_id, chat, message = taken
+            self._wait_seconds.observe(time.monotonic() - message.queued_at)
+            result, error = None, None
+            try:
+                result = self.bot.send_message(chat_id, message.text, **message.kwargs)
+            except ApiTelegramException as e:
+                if e.error_code != 429:
+                    error = e
+                else:
+                    retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                    logger.warning(f'Flood limit in chat {chat_id}, retrying in {retry_after}s')
+                    metrics.registry.inc('outbox_retry_after_total', help_text='Messages put back after a 429')
+                    with self._cond:
+                        self.retried += 1
+                        chat.bucket.block_until(time.monotonic() + retry_after)
+                        heapq.heappush(chat.pending, message)
+                        self.pending += 1
+                    message = None
+            except Exception as e:
+                error = e
+            if error is not None:
+                logger.error(f'Failed to send a message to chat {chat_id}: {error}')
+            if message is not None:
+                for future in message.futures:
+                    if error is None:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(error)
+            with self._cond:
+                chat.busy = False
+                if message is not None and error is None:
+                    self.sent += 1
+                if chat.pending:
+                    self._schedule(chat_id, chat, time.monotonic())
+                self._cond.notify_all()
+
+    def wait_idle(self, timeout=None) -> bool:
+        """Block until everything queued has been sent or has failed; False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self.pending or any(chat.busy for chat in self._chats.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def stop(self, timeout=10):
+        """Send what is queued, then stop the sender threads."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        metrics.registry.remove_gauge('queue_depth', queue='outbox')
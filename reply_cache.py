@@ -0,0 +1,174 @@
+# reply_cache.py
+"""In-process cache of rendered replies and computed figures, keyed by user and request.
+
+Users tap the same history and /a1c buttons over and over; a repeat is answered from memory without
+touching SQLite. Every write of a user's readings drops that user's entries (database write
+listeners), and entries expire after ``max_age`` seconds because relative periods ("1 day") move with
+the clock. The cache is an LRU bounded by the estimated size of what it holds.
+
+The cache belongs to one process: the dispatcher shards users by id, so a user's writes and reads meet
+in the same worker.
+"""
+import functools
+import inspect
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_MAX_AGE = 600
+# Bytes counted per entry for its key and bookkeeping, on top of the value's estimated size
+ENTRY_OVERHEAD = 256
+
+_MISSING = object()
+
+
+def estimate_size(value, depth=4) -> int:
+    """Rough deep size of a value in bytes: containers and object attributes are followed ``depth`` levels."""
+    size = sys.getsizeof(value)
+    if depth == 0 or isinstance(value, (str, bytes, int, float)):
+        return size
+    if isinstance(value, dict):
+        return size + sum(estimate_size(k, depth - 1) + estimate_size(v, depth - 1) for k, v in value.items())
+    if isinstance(value, (tuple, list)):
+        return size + sum(estimate_size(item, depth - 1) for item in value)
+    if hasattr(value, '__dict__'):
+        return size + estimate_size(vars(value), depth - 1)
+    return size
+
+
+class ReplyCache:
+    """Thread-safe LRU map of (user_id, key) to values, bounded to ``max_bytes`` of estimated size.
+
+    Entries older than ``max_age`` seconds count as misses. get_or_compute() does not store a value
+    computed while the user's entries were invalidated, so a reply read before a write never outlives it.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE, name='replies'):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.name = name
+        # Off: get_or_compute always computes, e.g. for benchmarks timing the uncached path
+        self.enabled = True
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # (user_id, key) -> (value, size, stored at)
+        self._keys = {}  # user_id -> set of keys
+        self._loads = {}  # user_id -> [computations in flight, invalidated since they started]
+        self._lock = threading.Lock()
+
+    def get(self, user_id, key, default=None):
+        with self._lock:
+            entry = self._entries.get((user_id, key))
+            if entry is None or time.monotonic() - entry[2] > self.max_age:
+                self.misses += 1
+                return default
+            self._entries.move_to_end((user_id, key))
+            self.hits += 1
+            return entry[0]
+
+    def put(self, user_id, key, value):
+        size = estimate_size(value) + ENTRY_OVERHEAD
+        with self._lock:
+            self._store(user_id, key, value, size)
+
+    def _store(self, user_id, key, value, size):
+        self._remove((user_id, key))
+        if size > self.max_bytes:
+            return
+        self._entries[(user_id, key)] = (value, size, time.monotonic())
+        self._keys.setdefault(user_id, set()).add(key)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, entry_key):
+        entry = self._entries.pop(entry_key, None)
+        if entry is None:
+            return
+        self.bytes -= entry[1]
+        user_id, key = entry_key
+        keys = self._keys[user_id]
+        keys.discard(key)
+        if not keys:
+            del self._keys[user_id]
+
+    def get_or_compute(self, user_id, key, compute):
+        """The cached value, or ``compute()``'s result, stored unless the user was invalidated meanwhile."""
+        if not self.enabled:
+            return compute()
+        value = self.get(user_id, key, _MISSING)
+        if value is not _MISSING:
+            metrics.registry.inc('cache_requests_total', help_text='Cache lookups', cache=self.name, result='hit')
+            return value
+        metrics.registry.inc('cache_requests_total', help_text='Cache lookups', cache=self.name, result='miss')
+        with self._lock:
+            self._loads.setdefault(user_id, [0, False])[0] += 1
+        stored = False
+        try:
+            value = compute()
+            stored = True
+            return value
+        finally:
+            size = estimate_size(value) + ENTRY_OVERHEAD if stored else 0
+            with self._lock:
+                load = self._loads[user_id]
+                load[0] -= 1
+                if stored and not load[1]:
+                    self._store(user_id, key, value, size)
+                if not load[0]:
+                    del self._loads[user_id]
+
+    def invalidate(self, user_id):
+        """Drop every entry of the user, and any value being computed for them."""
+        with self._lock:
+            for key in list(self._keys.get(user_id, ())):
+                self._remove((user_id, key))
+            if user_id in self._loads:
+                self._loads[user_id][1] = True
+            self.invalidations += 1
+
+    def cached(self, kind):
+        """Decorator caching ``func(user_id, ...)`` under (user_id, (kind, its other arguments))."""
+        def decorator(func):
+            signature = inspect.signature(func)
+
+            @functools.wraps(func)
+            def wrapper(user_id, *args, **kwargs):
+                bound = signature.bind(user_id, *args, **kwargs)
+                bound.apply_defaults()
+                key = (kind, *tuple(bound.arguments.values())[1:])
+                return self.get_or_compute(user_id, key, lambda: func(user_id, *args, **kwargs))
+            return wrapper
+        return decorator
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def counters(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'invalidations': self.invalidations,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def register_metrics(self):
+        """Expose the size and hit rate as gauges (also listed by /perf)."""
+        metrics.registry.gauge('cache_entries', lambda: len(self), 'Entries in a cache', cache=self.name)
+        metrics.registry.gauge('cache_bytes', lambda: self.bytes, 'Estimated size of a cache', cache=self.name)
+        metrics.registry.gauge('cache_hit_rate', lambda: round(self.counters()['hit_rate'], 3),
+                               'Share of cache lookups that were hits', cache=self.name)
+        return self
@@ -0,0 +1,212 @@
+# retention.py
+"""Tiered retention of glucose readings.
+
+Compaction is opt-in (config.RETENTION, off by default) because it deletes raw readings for good.
+Raw readings are kept for ``raw_days``. Older ones are compacted into 15-minute rollup buckets
+(count, sum, sum of squares, min and max of mg/dL), and 15-minute buckets older than ``rollup_days``
+into hourly ones, so a user's storage grows with the hourly tier (8760 rows a year) instead of with
+every reading. Reads pick the tier holding each part of a range themselves (database._iter_tiers).
+
+Compaction is incremental: every step moves at most about ``batch_size`` rows of one user in one
+short transaction, then sleeps ``pause`` seconds so bot writes are never held up for long. A step
+moves the user's horizon in retention_state together with the rows, so readings inserted later for a
+compacted period are ignored rather than counted twice, and daily_stats keeps counting the readings it
+deletes. Imports of such periods go through roll_in instead, which fills the buckets that have no data
+yet. An interrupted run loses nothing; the next one continues where it stopped.
+"""
+import logging
+import sqlite3
+import threading
+import time
+from typing import NamedTuple
+
+import database
+import metrics
+from migrations import SECONDS_PER_DAY
+
+logger = logging.getLogger(__name__)
+
+RAW_DAYS = 90
+ROLLUP_DAYS = 730
+BATCH_SIZE = 5000
+# Seconds to sleep after each compaction transaction
+PAUSE = 0.01
+# Seconds between compaction runs of RetentionJob
+INTERVAL = 3600
+
+QUARTER_HOUR = 900
+HOUR = 3600
+
+_ROLLUP_UPSERT = '''INSERT INTO {target} (user_id, ts, n, sum_mg_dl, sumsq_mg_dl, min_mg_dl, max_mg_dl)
+    {select}
+    ON CONFLICT (user_id, ts) DO UPDATE SET n = n + excluded.n, sum_mg_dl = sum_mg_dl + excluded.sum_mg_dl,
+        sumsq_mg_dl = sumsq_mg_dl + excluded.sumsq_mg_dl, min_mg_dl = MIN(min_mg_dl, excluded.min_mg_dl),
+        max_mg_dl = MAX(max_mg_dl, excluded.max_mg_dl)'''
+
+READINGS_TO_15M = _ROLLUP_UPSERT.format(target='rollup_15m', select=(
+    f'SELECT user_id, ts / {QUARTER_HOUR} * {QUARTER_HOUR} AS bucket, COUNT(*), SUM(mg_dl), SUM(mg_dl * mg_dl), '
+    'MIN(mg_dl), MAX(mg_dl) FROM user_inputs WHERE user_id = ? AND ts < ? GROUP BY bucket'))
+
+ROLLUP_15M_TO_1H = _ROLLUP_UPSERT.format(target='rollup_1h', select=(
+    f'SELECT user_id, ts / {HOUR} * {HOUR} AS bucket, SUM(n), SUM(sum_mg_dl), SUM(sumsq_mg_dl), MIN(min_mg_dl), '
+    'MAX(max_mg_dl) FROM rollup_15m WHERE user_id = ? AND ts < ? GROUP BY bucket'))
+
+
+class CompactResult(NamedTuple):
+    users: int  # users with something compacted
+    readings: int  # raw readings moved into 15-minute buckets
+    buckets: int  # 15-minute buckets moved into hourly ones
+
+
+def cutoffs(now=None, raw_days=RAW_DAYS, rollup_days=ROLLUP_DAYS):
+    """(raw cutoff, rollup cutoff): epoch seconds on hour boundaries below which each tier is compacted."""
+    now = int(time.time()) if now is None else database.to_epoch(now)
+    return tuple((now - days * SECONDS_PER_DAY) // HOUR * HOUR for days in (raw_days, rollup_days))
+
+
+def _batch_end(conn, table, user_id, cutoff, batch_size, step):
+    """End (exclusive, on a ``step`` boundary) of the next batch of a user's rows below ``cutoff``; None if none."""
+    row = conn.execute(f'SELECT ts FROM {table} WHERE user_id=? AND ts < ? ORDER BY ts LIMIT 1 OFFSET ?',
+                       (user_id, cutoff, batch_size - 1)).fetchone()
+    if row is not None:
+        return min(cutoff, (row[0] // step + 1) * step)
+    if conn.execute(f'SELECT 1 FROM {table} WHERE user_id=? AND ts < ? LIMIT 1', (user_id, cutoff)).fetchone():
+        return cutoff
+    return None
+
+
+def compact_user(user_id, raw_cutoff, rollup_cutoff, batch_size=BATCH_SIZE, pause=PAUSE, stop=None):
+    """Compact one user's readings below ``raw_cutoff`` and 15-minute buckets below ``rollup_cutoff``.
+
+    Returns (readings, buckets) moved. ``stop`` is an optional threading.Event checked between batches.
+    """
+    conn = database.get_connection()
+    readings = buckets = 0
+    while stop is None or not stop.is_set():
+        end = _batch_end(conn, 'user_inputs', user_id, raw_cutoff, batch_size, QUARTER_HOUR)
+        if end is None:
+            break
+        with conn:
+            conn.execute(READINGS_TO_15M, (user_id, end))
+            # The horizon moves before the delete, so the daily_stats trigger leaves these readings counted
+            conn.execute('INSERT INTO retention_state (user_id, raw_before, rollup_before) VALUES (?, ?, 0) '
+                         'ON CONFLICT (user_id) DO UPDATE SET raw_before = MAX(raw_before, excluded.raw_before)',
+                         (user_id, end))
+            readings += conn.execute('DELETE FROM user_inputs WHERE user_id=? AND ts < ?', (user_id, end)).rowcount
+        time.sleep(pause)
+    while stop is None or not stop.is_set():
+        end = _batch_end(conn, 'rollup_15m', user_id, rollup_cutoff, batch_size, HOUR)
+        if end is None:
+            break
+        with conn:
+            conn.execute(ROLLUP_15M_TO_1H, (user_id, end))
+            conn.execute('UPDATE retention_state SET rollup_before = MAX(rollup_before, ?) WHERE user_id=?',
+                         (end, user_id))
+            buckets += conn.execute('DELETE FROM rollup_15m WHERE user_id=? AND ts < ?', (user_id, end)).rowcount
+        time.sleep(pause)
+    if readings or buckets:
+        # Old history pages now come from coarser buckets
+        database.notify_write((user_id,))
+    return readings, buckets
+
+
+def horizon(user_id):
+    """(raw_before, rollup_before) of a user: readings below the first live in the rollups; (0, 0) if none."""
+    row = database.get_connection().execute('SELECT raw_before, rollup_before FROM retention_state WHERE user_id=?',
+                                            (user_id,)).fetchone()
+    return tuple(row) if row is not None else (0, 0)
+
+
+def roll_in(user_id, rows):
+    """Add one user's readings of an already compacted period to the rollups; returns (rolled_up, dropped).
+
+    ``rows`` are (ts, user_id, mg_dl, mmol_l) readings older than the user's raw horizon, e.g. from an
+    import. They are aggregated into the buckets of the tier holding their period. A bucket that already
+    has data is left as it is and its readings are dropped: they may well be the readings it was compacted
+    from, so importing the same file twice adds nothing.
+    """
+    conn = database.get_connection()
+    rolled_up = dropped = 0
+    with conn:
+        raw_before, rollup_before = horizon(user_id)
+        buckets = {}
+        for ts, _, mg_dl, _ in rows:
+            if ts >= raw_before:
+                raise ValueError(f'Reading at {ts} is not older than the raw horizon {raw_before}')
+            table = 'rollup_1h' if ts < rollup_before else 'rollup_15m'
+            step = HOUR if ts < rollup_before else QUARTER_HOUR
+            bucket = buckets.setdefault((table, ts // step * step), {})
+            # Readings of the same moment count once, as in user_inputs
+            bucket.setdefault(ts, mg_dl)
+        for (table, ts), readings in buckets.items():
+            values = list(readings.values())
+            n, total, squares = len(values), sum(values), sum(value * value for value in values)
+            if not conn.execute(f'INSERT OR IGNORE INTO {table} (user_id, ts, n, sum_mg_dl, sumsq_mg_dl, min_mg_dl, '
+                                'max_mg_dl) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (user_id, ts, n, total, squares, min(values), max(values))).rowcount:
+                dropped += n
+                continue
+            conn.execute('INSERT INTO daily_stats (user_id, day, n, sum_mg_dl, sumsq_mg_dl) VALUES (?, ?, ?, ?, ?) '
+                         'ON CONFLICT (user_id, day) DO UPDATE SET n = n + excluded.n, '
+                         'sum_mg_dl = sum_mg_dl + excluded.sum_mg_dl, sumsq_mg_dl = sumsq_mg_dl + excluded.sumsq_mg_dl',
+                         (user_id, ts // SECONDS_PER_DAY, n, total, squares))
+            rolled_up += n
+    # Duplicate moments within the rows are neither rolled up nor dropped: like user_inputs, they were already stored
+    if rolled_up:
+        database.notify_write((user_id,))
+    return rolled_up, dropped
+
+
+def _next_user(conn, after):
+    """Smallest user id above ``after`` with raw readings or 15-minute buckets, or None."""
+    return conn.execute('SELECT MIN(user_id) FROM (SELECT MIN(user_id) AS user_id FROM user_inputs WHERE user_id > ?1 '
+                        'UNION ALL SELECT MIN(user_id) FROM rollup_15m WHERE user_id > ?1)', (after,)).fetchone()[0]
+
+
+def compact(now=None, raw_days=RAW_DAYS, rollup_days=ROLLUP_DAYS, batch_size=BATCH_SIZE, pause=PAUSE,
+            stop=None) -> CompactResult:
+    """Run one compaction pass over every user; see compact_user."""
+    database.init_db()
+    raw_cutoff, rollup_cutoff = cutoffs(now, raw_days, rollup_days)
+    conn = database.get_connection()
+    users = readings = buckets = 0
+    user_id = -2 ** 63
+    while stop is None or not stop.is_set():
+        user_id = _next_user(conn, user_id)
+        if user_id is None:
+            break
+        moved = compact_user(user_id, raw_cutoff, rollup_cutoff, batch_size, pause, stop)
+        if any(moved):
+            users += 1
+            readings += moved[0]
+            buckets += moved[1]
+    metrics.registry.inc('retention_rows_total', readings, 'Rows compacted into a coarser tier', tier='rollup_15m')
+    metrics.registry.inc('retention_rows_total', buckets, 'Rows compacted into a coarser tier', tier='rollup_1h')
+    logger.info(f'Compacted {readings} readings and {buckets} 15-minute buckets of {users} users')
+    return CompactResult(users, readings, buckets)
+
+
+class RetentionJob:
+    """Runs compact() every ``interval`` seconds on a daemon thread until stop()."""
+
+    def __init__(self, interval=INTERVAL, **options):
+        self.interval = interval
+        self.options = options
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='RetentionJob', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                compact(stop=self._stop, **self.options)
+            except sqlite3.Error:
+                logger.exception('Retention compaction failed')
+            self._stop.wait(self.interval)
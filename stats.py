@@ -0,0 +1,138 @@
+# stats.py
+"""Glycemic statistics over a window of one user's readings.
+
+Readings are loaded straight from the database cursor into compact NumPy arrays (int64 epoch
+seconds, float32 mg/dL), and every figure is computed with whole-array operations, so 90 days of
+5-minute CGM data take a few milliseconds.
+"""
+import time
+from typing import NamedTuple
+
+import numpy as np
+
+from database import iter_history_data, select_daily_means, to_epoch
+from migrations import SECONDS_PER_DAY
+
+# Consensus target range and the level 1/level 2 thresholds, mg/dL
+TARGET_LOW = 70
+TARGET_HIGH = 180
+VERY_LOW = 54
+VERY_HIGH = 250
+
+PERCENTILES = (5, 25, 50, 75, 95)
+# Upper bound on a glucose value for the hourly sort key, mg/dL
+HOUR_KEY_SPAN = 4096.0
+
+
+class GlucoseStats(NamedTuple):
+    count: int
+    mean: float
+    sd: float
+    cv: float  # %
+    gmi: float  # %
+    # Share of readings per range, %
+    very_low: float
+    low: float
+    in_range: float
+    high: float
+    very_high: float
+    percentiles: np.ndarray  # one value per PERCENTILES entry
+    hourly: np.ndarray  # AGP profile: 24 hours x PERCENTILES, NaN for hours without readings
+    hypo_events: int
+    hyper_events: int
+
+
+def load_readings(user_id: int, date_from=None, date_to=None, max_days=None):
+    """Return (ts, mg_dl) arrays of one user's readings in the window, oldest first.
+
+    With ``max_days``, a window holding more days of data than that is loaded as daily means instead,
+    one point per UTC day from daily_stats, which costs the same however long the history is.
+    """
+    rows = None
+    if max_days is not None and (date_from is None or date_to is None or
+                                 to_epoch(date_to) - to_epoch(date_from) > max_days * SECONDS_PER_DAY):
+        daily = select_daily_means(user_id, date_from, date_to)
+        if len(daily) > max_days:
+            rows = daily
+    if rows is None:
+        rows = iter_history_data(user_id, date_from, date_to)
+    data = np.fromiter(((row[0], row[2]) for row in rows), dtype=[('ts', np.int64), ('mg_dl', np.float32)])
+    data = data[::-1]
+    return data['ts'], data['mg_dl']
+
+
+def count_events(mask: np.ndarray) -> int:
+    """Number of runs of consecutive True values, i.e. separate excursions."""
+    return int(np.count_nonzero(mask[1:] & ~mask[:-1]) + (mask[0] if len(mask) else 0))
+
+
+def _group_percentiles(ordered, starts, counts, percentiles=PERCENTILES) -> np.ndarray:
+    """Percentiles of consecutive sorted groups of ``ordered``, with np.percentile's linear interpolation.
+
+    Returns one row per group, NaN for empty groups.
+    """
+    result = np.full((len(counts), len(percentiles)), np.nan)
+    has = counts > 0
+    last = np.maximum(counts - 1, 0)
+    end = len(ordered) - 1
+    for j, q in enumerate(percentiles):
+        pos = q / 100 * last
+        lo = np.floor(pos).astype(np.int64)
+        frac = pos - lo
+        value = ordered[np.minimum(starts + lo, end)] * (1 - frac) + \
+            ordered[np.minimum(starts + np.minimum(lo + 1, last), end)] * frac
+        result[has, j] = value[has]
+    return result
+
+
+def hourly_percentiles(hours: np.ndarray, values: np.ndarray, percentiles=PERCENTILES) -> np.ndarray:
+    """Percentiles of ``values`` per hour of day (24 x len(percentiles)), all hours in one sort.
+
+    Readings are sorted by the composite key ``hour * HOUR_KEY_SPAN + value`` (exact in float64 for values in
+    [0, HOUR_KEY_SPAN)) instead of an argsort/lexsort, which would be several times slower.
+    """
+    counts = np.bincount(hours, minlength=24)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    offsets = np.arange(24, dtype=np.float64) * HOUR_KEY_SPAN
+    ordered = np.sort(hours * HOUR_KEY_SPAN + values.astype(np.float64)) - np.repeat(offsets, counts)
+    return _group_percentiles(ordered, starts, counts, percentiles)
+
+
+def compute_stats(ts: np.ndarray, mg_dl: np.ndarray, utc_offset=None):
+    """Compute GlucoseStats for readings ordered by time; None when there are none.
+
+    ``utc_offset`` (seconds) places readings in the hours of the AGP profile; defaults to local time.
+    """
+    n = len(mg_dl)
+    if n == 0:
+        return None
+    if utc_offset is None:
+        utc_offset = time.localtime().tm_gmtoff
+    values = mg_dl.astype(np.float64)
+    mean = values.mean()
+    sd = values.std(ddof=1) if n > 1 else 0.0
+    below_low, above_high = values < TARGET_LOW, values > TARGET_HIGH
+    very_low, very_high = values < VERY_LOW, values > VERY_HIGH
+    share = 100.0 / n
+    hours = ((ts + utc_offset) // 3600 % 24).astype(np.int64)
+    return GlucoseStats(
+        count=n,
+        mean=float(mean),
+        sd=float(sd),
+        cv=float(sd / mean * 100) if mean else 0.0,
+        gmi=float(3.31 + 0.02392 * mean),
+        very_low=float(np.count_nonzero(very_low) * share),
+        low=float(np.count_nonzero(below_low & ~very_low) * share),
+        in_range=float((n - np.count_nonzero(below_low) - np.count_nonzero(above_high)) * share),
+        high=float(np.count_nonzero(above_high & ~very_high) * share),
+        very_high=float(np.count_nonzero(very_high) * share),
+        percentiles=_group_percentiles(np.sort(values), np.array([0]), np.array([n]))[0],
+        hourly=hourly_percentiles(hours, values),
+        hypo_events=count_events(below_low),
+        hyper_events=count_events(above_high),
+    )
+
+
+def user_stats(user_id: int, date_from=None, date_to=None):
+    """Load one user's readings for the window and compute their GlucoseStats (None without readings)."""
+    return compute_stats(*load_readings(user_id, date_from, date_to))
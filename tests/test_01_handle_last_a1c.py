@@ -9,7 +9,8 @@ def test_handle_last_a1c(mocker):
     chat_id = 12345
     glucose_levels = [100, 120, 90, 110, 130, 80, 140]
     timestamp = datetime.datetime.now() - datetime.timedelta(days=1)
-    expected_a1c = 5.29
+    # Every reading is inside the 60-day window, today's included: A1C = (mean mg/dL + 46.7) / 28.7
+    expected_a1c = round((sum(glucose_levels) / len(glucose_levels) + 46.7) / 28.7, 2)
 
     # Insert test data into the database
     for level in glucose_levels:
@@ -17,7 +18,7 @@ def test_handle_last_a1c(mocker):
         timestamp += datetime.timedelta(hours=1)
 
     # Mock the send_message function to check the message sent
-    mock_bot = mocker.patch('tg_t1d_assistant_bot.main.bot')
+    mock_bot = mocker.patch('main.bot')
 
     # Call the handle_last_week_a1c function
     handle_last_a1c(user_id, chat_id)
@@ -1,5 +1,14 @@
+import datetime
+import sqlite3
+import threading
+
 import pytest
-from database import create_connection, create_table, insert_data, select_all_data
+
+import database
+import main
+from database import check_daily_stats, create_connection, create_table, disable_write_behind, \
+    enable_write_behind, get_connection, insert_data, rebuild_daily_stats, select_all_data, select_history_data, \
+    select_window_stats, to_epoch
 
 
 def test_create_connection():
@@ -25,7 +34,7 @@ def test_insert_data():
     c = conn.cursor()
     c.execute("SELECT * FROM user_inputs")
     data = c.fetchall()
-    assert ('2022-01-01 10:00:00', 1, 100.0, 5.6) in data
+    assert (to_epoch('2022-01-01 10:00:00'), 1, 100.0, 5.6) in data
     conn.close()
 
 
@@ -35,8 +44,8 @@ def test_select_all_data():
     insert_data(1, 100, 5.6, '2022-01-01 10:00:00')
     insert_data(2, 110, 6.1, '2022-01-01 11:00:00')
     data = select_all_data()
-    assert ('2022-01-01 10:00:00', 1, 100, 5.6) in data
-    assert ('2022-01-01 11:00:00', 2, 110, 6.1) in data
+    assert (to_epoch('2022-01-01 10:00:00'), 1, 100, 5.6) in data
+    assert (to_epoch('2022-01-01 11:00:00'), 2, 110, 6.1) in data
     conn.close()
 
 
@@ -46,5 +55,135 @@ def test_delete_data():
     c.execute("DELETE FROM user_inputs WHERE user_id in (1,2)")
     conn.commit()
     data = select_all_data()
-    assert ('2022-01-01 10:00:00', 1, 100.0, 5.6) not in data
+    assert (to_epoch('2022-01-01 10:00:00'), 1, 100.0, 5.6) not in data
     conn.close()
+
+
+def test_select_history_data_uses_index_range_scan():
+    insert_data(3, 100, 5.6, '2022-01-01 10:00:00')
+    insert_data(3, 120, 6.7, '2022-01-02 10:00:00')
+    insert_data(3, 140, 7.8, '2022-01-03 10:00:00')
+    rows = select_history_data(3, '2022-01-01 12:00:00', '2022-01-03 10:00:00')
+    assert [row[2] for row in rows] == [140, 120]
+
+    plan = get_connection().execute("EXPLAIN QUERY PLAN SELECT * FROM user_inputs "
+                                    "WHERE user_id=? AND ts BETWEEN ? AND ? ORDER BY ts DESC", (3, 0, 1)).fetchall()
+    assert 'SEARCH user_inputs USING PRIMARY KEY (user_id=? AND ts>? AND ts<?)' in [row[3] for row in plan]
+    get_connection().execute("DELETE FROM user_inputs WHERE user_id=3")
+    get_connection().commit()
+
+
+def test_get_connection_is_reused_per_thread():
+    conn = get_connection()
+    assert get_connection() is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone() == ('wal',)
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(get_connection()))
+    thread.start()
+    thread.join()
+    assert other[0] is not conn
+
+
+def test_second_reading_in_the_same_second_is_reported(mocker):
+    mocker.patch('database.time', time=lambda: 1700000000.5)
+    assert insert_data(7, 100, 5.55) is True
+    assert insert_data(7, 120, 6.66) is False
+    assert main.glucose_message(7, '140').startswith('140.0 mg/dl or 7.77 mmol/l was not saved: ')
+    assert [row[2] for row in select_all_data(7)] == [100]
+    get_connection().execute("DELETE FROM user_inputs WHERE user_id=7")
+    get_connection().commit()
+
+
+def test_daily_stats_follow_inserts_and_deletes():
+    now = datetime.datetime.now()
+    for minutes, level in ((0, 100), (5, 150), (10, 200)):
+        insert_data(4, level, level / 18, now - datetime.timedelta(minutes=minutes))
+    assert select_window_stats(4, 1) == (3, 450.0, 100 ** 2 + 150 ** 2 + 200 ** 2)
+
+    conn = get_connection()
+    conn.execute("DELETE FROM user_inputs WHERE user_id=4 AND mg_dl=150")
+    conn.commit()
+    assert select_window_stats(4, 1) == (2, 300.0, 100 ** 2 + 200 ** 2)
+    assert check_daily_stats() == []
+
+    conn.execute("DELETE FROM user_inputs WHERE user_id=4")
+    conn.commit()
+    assert select_window_stats(4) == (0, 0.0, 0.0)
+
+
+def test_check_daily_stats_detects_and_rebuild_fixes_drift():
+    insert_data(5, 100, 5.6, '2022-01-01 10:00:00')
+    conn = get_connection()
+    conn.execute("UPDATE daily_stats SET n = n + 1 WHERE user_id=5")
+    conn.commit()
+    assert [row[0] for row in check_daily_stats()] == [5]
+
+    rebuild_daily_stats()
+    assert check_daily_stats() == []
+    conn.execute("DELETE FROM user_inputs WHERE user_id=5")
+    conn.commit()
+
+
+def test_write_behind_reads_see_own_writes():
+    writer = enable_write_behind(max_batch=100, max_delay=60)
+    try:
+        insert_data(6, 100, 5.6, '2022-01-01 10:00:00')
+        insert_data(6, 120, 6.7, '2022-01-01 10:05:00')
+        assert writer.has_pending(6)
+        rows = select_history_data(6, '2022-01-01 00:00:00', '2022-01-02 00:00:00')
+        assert [row[2] for row in rows] == [120, 100]
+        assert not writer.has_pending()
+
+        insert_data(6, 140, 7.8, '2022-01-01 10:10:00')
+    finally:
+        disable_write_behind()
+    assert writer.flushed_rows == 3
+    assert len(select_all_data(6)) == 3
+    get_connection().execute("DELETE FROM user_inputs WHERE user_id=6")
+    get_connection().commit()
+
+
+def test_write_behind_retries_failed_batches_then_drops_them(monkeypatch):
+    writer = enable_write_behind(max_batch=100, max_delay=60)
+    failures = [2]
+    real_get_connection = database.get_connection
+
+    class FailingConnection:
+        def __init__(self, conn):
+            self.conn = conn
+
+        def __enter__(self):
+            return self.conn.__enter__()
+
+        def __exit__(self, *exc):
+            return self.conn.__exit__(*exc)
+
+        def executemany(self, *args):
+            if failures[0]:
+                failures[0] -= 1
+                raise sqlite3.OperationalError('database is locked')
+            return self.conn.executemany(*args)
+
+    monkeypatch.setattr(database, 'get_connection', lambda: FailingConnection(real_get_connection()))
+    try:
+        insert_data(8, 100, 5.6, '2022-01-01 10:00:00')
+        for _ in range(2):
+            with pytest.raises(sqlite3.OperationalError):
+                writer.flush()
+            assert writer.has_pending(8) and writer.queue_depth() == 1
+        writer.flush()
+        assert not writer.has_pending(8) and writer.flushed_rows == 1
+
+        failures[0] = writer.max_retries + 1
+        insert_data(8, 120, 6.7, '2022-01-01 10:05:00')
+        for _ in range(writer.max_retries + 1):
+            with pytest.raises(sqlite3.OperationalError):
+                writer.flush()
+        assert not writer.has_pending(8) and writer.dropped_rows == 1 and writer.queue_depth() == 0
+    finally:
+        monkeypatch.undo()
+        disable_write_behind()
+    assert [row[2] for row in select_all_data(8)] == [100]
+    get_connection().execute("DELETE FROM user_inputs WHERE user_id=8")
+    get_connection().commit()
@@ -0,0 +1,56 @@
+import sqlite3
+
+import pytest
+from migrations import SCHEMA_VERSION, get_version, migrate
+
+
+@pytest.fixture
+def legacy_conn(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'legacy.db')
+    conn.execute('CREATE TABLE user_inputs (timestamp TIMESTAMP, user_id INTEGER, mg_dl REAL, mmol_l REAL)')
+    conn.executemany('INSERT INTO user_inputs VALUES (?, ?, ?, ?)', [
+        ('2023-05-01 08:00:00', 1, 100.0, 5.55),
+        ('2023-05-01 09:30:15.123456', 1, 180.0, 10.0),
+        ('2023-05-01 09:30:15', 1, 181.0, 10.05),  # same second as the row above
+        ('2023-05-02 10:00:00', 2, 90.0, 5.0),
+        ('not a date', 2, 95.0, 5.3),
+    ])
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def test_migrate_fresh_database(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'fresh.db')
+    assert migrate(conn) == list(range(1, SCHEMA_VERSION + 1))
+    assert get_version(conn) == SCHEMA_VERSION
+    assert migrate(conn) == []
+    conn.close()
+
+
+def test_migrate_legacy_database_in_batches(legacy_conn):
+    migrate(legacy_conn, batch_size=2)
+
+    assert get_version(legacy_conn) == SCHEMA_VERSION
+    rows = legacy_conn.execute('SELECT ts, user_id, mg_dl, mmol_l FROM user_inputs ORDER BY user_id, ts').fetchall()
+    assert rows == [
+        (1682928000, 1, 100.0, 5.55),
+        (1682933415, 1, 180.0, 10.0),
+        (1683021600, 2, 90.0, 5.0),
+    ]
+    tables = [row[0] for row in legacy_conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    assert 'user_inputs_v1' not in tables
+
+
+def test_migrate_resumes_interrupted_run(legacy_conn):
+    # Simulate a run that renamed the table and moved the first batch before it was killed
+    legacy_conn.execute('PRAGMA user_version = 1')
+    legacy_conn.execute('ALTER TABLE user_inputs RENAME TO user_inputs_v1')
+    legacy_conn.execute('CREATE TABLE user_inputs (ts INTEGER NOT NULL, user_id INTEGER NOT NULL, mg_dl REAL, '
+                        'mmol_l REAL, PRIMARY KEY (user_id, ts)) WITHOUT ROWID')
+    legacy_conn.execute('INSERT INTO user_inputs VALUES (1682928000, 1, 100.0, 5.55)')
+    legacy_conn.execute('DELETE FROM user_inputs_v1 WHERE rowid = 1')
+    legacy_conn.commit()
+
+    assert migrate(legacy_conn)[0] == 2
+    assert legacy_conn.execute('SELECT COUNT(*) FROM user_inputs').fetchone()[0] == 3
@@ -0,0 +1,25 @@
+import asyncio
+
+from async_main import _user_locks, run_blocking, user_lock
+
+
+def test_user_lock_keeps_per_user_order_and_runs_users_concurrently():
+    events = []
+
+    async def handler(user_id, n, delay):
+        async with user_lock(user_id):
+            events.append(('start', user_id, n))
+            await run_blocking(lambda: None)
+            await asyncio.sleep(delay)
+            events.append(('end', user_id, n))
+
+    async def scenario():
+        await asyncio.gather(handler(1, 1, 0.05), handler(1, 2, 0), handler(2, 1, 0))
+
+    asyncio.run(scenario())
+
+    user_1 = [event for event in events if event[1] == 1]
+    assert user_1 == [('start', 1, 1), ('end', 1, 1), ('start', 1, 2), ('end', 1, 2)]
+    # user 2 is not held up behind user 1's slow handler
+    assert events.index(('end', 2, 1)) < events.index(('end', 1, 1))
+    assert _user_locks == {}
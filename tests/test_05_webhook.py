@@ -0,0 +1,71 @@
+import http.client
+import json
+import threading
+
+import pytest
+from webhook import SECRET_HEADER, WebhookServer, update_user_id
+
+
+class RecordingBot:
+    def __init__(self):
+        self.updates = []
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def process_new_updates(self, updates):
+        self.entered.set()
+        self.release.wait(5)
+        self.updates.extend(update.update_id for update in updates)
+
+
+def message_update(update_id, user_id, text='120'):
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': 0, 'text': text,
+                        'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'},
+                        'chat': {'id': user_id, 'type': 'private'}}}
+
+
+@pytest.fixture
+def server():
+    bot = RecordingBot()
+    server = WebhookServer(bot, '127.0.0.1', 0, '/hook', secret_token='s3cret', workers=1, queue_size=2)
+    server.start_workers()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    bot.release.set()
+    server.shutdown()
+
+
+def post(server, payload, secret='s3cret', path='/hook'):
+    conn = http.client.HTTPConnection(*server.server_address)
+    headers = {SECRET_HEADER: secret} if secret else {}
+    conn.request('POST', path, json.dumps(payload), headers)
+    status = conn.getresponse().status
+    conn.close()
+    return status
+
+
+def test_webhook_validates_secret_and_path(server):
+    assert post(server, message_update(1, 7), secret='wrong') == 403
+    assert post(server, message_update(1, 7), secret=None) == 403
+    assert post(server, message_update(1, 7), path='/other') == 404
+    assert post(server, {'no': 'update_id'}) == 400
+    assert server.received == 0
+
+
+def test_webhook_acks_before_handling_and_applies_backpressure(server):
+    # The handler is blocked, so the worker holds one update and the queue fills up after two more
+    assert post(server, message_update(1, 7)) == 200
+    assert server.bot.entered.wait(5)
+    assert [post(server, message_update(i, 7)) for i in range(2, 5)] == [200, 200, 429]
+    assert server.rejected == 1
+    assert server.bot.updates == []
+
+    server.bot.release.set()
+    server.shutdown()
+    assert server.bot.updates == [1, 2, 3]
+
+
+def test_update_user_id():
+    assert update_user_id(message_update(1, 42)) == 42
+    assert update_user_id({'update_id': 1, 'poll': {'id': 'x'}}) is None
@@ -0,0 +1,54 @@
+import time
+
+import pytest
+from database import get_connection
+from main import HISTORY_PAGE_PREFIX, MESSAGE_LIMIT, format_history_row, history_page, parse_history_page
+
+USER_ID = 7
+
+
+@pytest.fixture
+def history():
+    now = int(time.time())
+    rows = [(now - 300 * i, USER_ID, 100.0 + i % 80, 5.5) for i in range(1000)]
+    conn = get_connection()
+    with conn:
+        conn.executemany('INSERT INTO user_inputs (ts, user_id, mg_dl, mmol_l) VALUES (?, ?, ?, ?)', rows)
+    yield rows
+    with conn:
+        conn.execute('DELETE FROM user_inputs WHERE user_id=?', (USER_ID,))
+
+
+def buttons(markup):
+    names = {'o': 'older', 'n': 'newer'}
+    return {names[button.callback_data[3]]: button.callback_data for button in markup.keyboard[0]
+            if button.callback_data.startswith(HISTORY_PAGE_PREFIX)} if markup else {}
+
+
+def test_history_pages_cover_all_rows_within_message_limit(history):
+    text, markup = history_page(USER_ID, 'all')
+    assert 'newer' not in buttons(markup)
+    pages = [text]
+    while 'older' in buttons(markup):
+        time_period, before, after = parse_history_page(buttons(markup)['older'])
+        text, markup = history_page(USER_ID, time_period, before=before, after=after)
+        assert 'newer' in buttons(markup)
+        pages.append(text)
+
+    assert len(pages) > 1
+    assert all(len(page) <= MESSAGE_LIMIT for page in pages)
+    shown = [line + '\n' for page in pages for line in page.splitlines()[1:]]
+    assert shown == [format_history_row(row) for row in history]
+
+
+def test_history_newer_page_walks_back(history):
+    first, markup = history_page(USER_ID, 'week')
+    second, markup = history_page(USER_ID, *parse_history_page(buttons(markup)['older']))
+    back, markup = history_page(USER_ID, *parse_history_page(buttons(markup)['newer']))
+    assert back == first
+    assert set(buttons(markup)) == {'older'}
+
+
+def test_history_page_empty_and_invalid():
+    assert history_page(USER_ID, '1 day') == ('No entries for the 1 day', None)
+    assert history_page(USER_ID, 'fortnight') == ('Invalid time period', None)
@@ -0,0 +1,55 @@
+import time
+
+import numpy as np
+import pytest
+from database import get_connection
+from main import stats_message
+from stats import PERCENTILES, compute_stats, count_events, hourly_percentiles, load_readings
+
+USER_ID = 8
+
+
+def test_compute_stats_ranges_and_events():
+    mg_dl = np.array([50, 60, 100, 150, 200, 260, 120, 65, 100, 190], dtype=np.float32)
+    ts = np.arange(len(mg_dl), dtype=np.int64) * 300
+    stats = compute_stats(ts, mg_dl, utc_offset=0)
+
+    assert stats.count == 10
+    assert stats.mean == pytest.approx(129.5)
+    assert stats.sd == pytest.approx(np.std(mg_dl.astype(float), ddof=1))
+    assert stats.gmi == pytest.approx(3.31 + 0.02392 * 129.5)
+    assert (stats.very_low, stats.low, stats.in_range, stats.high, stats.very_high) == (10, 20, 40, 20, 10)
+    assert (stats.hypo_events, stats.hyper_events) == (2, 2)
+    assert stats.percentiles == pytest.approx(np.percentile(mg_dl.astype(float), PERCENTILES))
+    assert compute_stats(ts[:0], mg_dl[:0]) is None
+
+
+def test_hourly_percentiles_match_numpy():
+    rng = np.random.default_rng(1)
+    hours = rng.integers(0, 23, 5000)  # hour 23 stays empty
+    values = np.clip(rng.normal(140, 40, 5000), 40, 400)
+    profile = hourly_percentiles(hours, values)
+    for hour in range(23):
+        assert profile[hour] == pytest.approx(np.percentile(values[hours == hour], PERCENTILES))
+    assert np.isnan(profile[23]).all()
+
+
+def test_count_events():
+    assert count_events(np.array([], dtype=bool)) == 0
+    assert count_events(np.array([True, True, False, True])) == 2
+
+
+def test_stats_message_loads_window():
+    now = int(time.time())
+    conn = get_connection()
+    with conn:
+        conn.executemany('INSERT INTO user_inputs (ts, user_id, mg_dl, mmol_l) VALUES (?, ?, ?, ?)',
+                         [(now - 300 * i, USER_ID, 100.0 + i, 5.5) for i in range(100)])
+    try:
+        ts, mg_dl = load_readings(USER_ID)
+        assert len(ts) == 100 and ts[0] < ts[-1] and mg_dl.dtype == np.float32
+        assert stats_message(USER_ID, '1 day').startswith('Stats for the last 1 day (100 readings):')
+    finally:
+        with conn:
+            conn.execute('DELETE FROM user_inputs WHERE user_id=?', (USER_ID,))
+    assert stats_message(USER_ID, 'week') == 'No entries for the week'
@@ -0,0 +1,95 @@
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import numpy as np
+
+import main
+import metrics
+from charts import ChartCache, chart_cache, render_chart
+from database import get_connection, insert_data
+from main import send_chart
+
+USER_ID = 9
+RENDER_USER_ID = 908
+
+
+def rendered(png):
+    future = Future()
+    future.set_result(png)
+    return future
+
+
+def test_chart_cache_lru_eviction_and_counters():
+    cache = ChartCache(max_entries=2)
+    cache.put('a', 'file-a')
+    cache.put('b', 'file-b')
+    assert cache.get('a') == 'file-a'
+    cache.put('c', 'file-c')  # evicts b, the least recently used
+    assert cache.get('b') is None
+    assert cache.counters() == {'entries': 2, 'hits': 1, 'misses': 1, 'evictions': 1, 'hit_rate': 0.5}
+
+    cache.max_age = -1
+    assert cache.get('a') is None
+
+
+def test_chart_cache_gauges_are_exported():
+    text = metrics.registry.render()
+    assert f't1d_cache_entries{{cache="charts"}} {len(chart_cache)}' in text
+    assert 't1d_cache_hit_rate{cache="charts"}' in text
+    assert 'cache_hit_rate charts: ' in metrics.summary(limit=10 ** 6)
+
+
+def test_render_chart_returns_png():
+    ts = np.arange(0, 86400, 300, dtype=np.int64) + 1700000000
+    png = render_chart(ts, np.full(len(ts), 120, dtype=np.float32), 'test')
+    assert png.startswith(b'\x89PNG')
+
+
+def test_send_chart_reuses_file_id_until_new_reading(mocker):
+    mock_bot = mocker.patch('main.bot')
+    mock_bot.send_photo.return_value = SimpleNamespace(photo=[SimpleNamespace(file_id='small'),
+                                                              SimpleNamespace(file_id='large')])
+    render = mocker.patch('main.submit_render', side_effect=lambda *payload: rendered(b'png'))
+    mocker.patch.object(main.chart_senders, 'submit', side_effect=lambda fn, *args: fn(*args))
+    now = int(time.time())
+    try:
+        insert_data(USER_ID, 100, 5.6, now - 600)
+        send_chart(USER_ID, 1, 'week')
+        send_chart(USER_ID, 1, 'week')
+        assert render.call_count == 1
+        assert mock_bot.send_photo.call_args_list[1].args == (1, 'large')
+
+        insert_data(USER_ID, 120, 6.7, now - 300)
+        send_chart(USER_ID, 1, 'week')
+        assert render.call_count == 2
+    finally:
+        conn = get_connection()
+        with conn:
+            conn.execute('DELETE FROM user_inputs WHERE user_id=?', (USER_ID,))
+    send_chart(USER_ID, 1, 'week')
+    mock_bot.send_message.assert_called_with(1, 'No entries for the week')
+
+
+def test_send_chart_returns_before_the_render_is_done(mocker):
+    mock_bot = mocker.patch('main.bot')
+    mock_bot.send_photo.return_value = SimpleNamespace(photo=[SimpleNamespace(file_id='chart')])
+    pending = Future()
+    mocker.patch('main.submit_render', return_value=pending)
+    mocker.patch.object(main.chart_senders, 'submit', side_effect=lambda fn, *args: fn(*args))
+    insert_data(RENDER_USER_ID, 100, 5.6, int(time.time()) - 600)
+    try:
+        assert send_chart(RENDER_USER_ID, 2, 'week') is pending
+        mock_bot.send_photo.assert_not_called()
+        pending.set_result(b'png')
+        mock_bot.send_photo.assert_called_once_with(2, b'png')
+
+        failed = Future()
+        mocker.patch('main.submit_render', return_value=failed)
+        send_chart(RENDER_USER_ID, 2, 'month')
+        failed.set_exception(RuntimeError('render crashed'))
+        mock_bot.send_message.assert_called_with(2, 'The chart could not be drawn, please try again later')
+    finally:
+        conn = get_connection()
+        with conn:
+            conn.execute('DELETE FROM user_inputs WHERE user_id=?', (RENDER_USER_ID,))
@@ -0,0 +1,212 @@
+import csv
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from hypothesis import given, settings, strategies as st
+from benchmarks.nightscout_data import START, make_entries, make_treatments, ns_date
+from drafts.isf import EntryColumns, ModelRegistry, NightscoutAnalyzer, TreatmentColumns, epoch_us, exponential_curve
+
+ENTRIES = make_entries(4 * 288)
+ENTRY_TIMES = [(NightscoutAnalyzer('http://localhost')._parse_date(e['dateString']), e['sgv']) for e in ENTRIES]
+
+
+def scan_isf(analyzer, treatment, times=None):
+    # Reference: linear scans over the entries, as _compute_isf did before the time index
+    start_time = analyzer._parse_date(treatment['created_at'])
+    end_time = start_time + timedelta(hours=4)
+    times = times or [(analyzer._parse_date(e['dateString']), e['sgv']) for e in analyzer.entries]
+    start = next((g for t, g in times if t == start_time), None) or next((g for t, g in times if t > start_time), None)
+    end = next((g for t, g in times if t == end_time), None) or \
+        next((g for t, g in reversed(times) if t < end_time), None)
+    return (start - end) / treatment['insulin'] if start and end and treatment['insulin'] else None
+
+
+@pytest.fixture
+def analyzer():
+    analyzer = NightscoutAnalyzer('http://localhost')
+    # Every third reading is missing, so lookups hit both the exact and the nearest-entry branches
+    analyzer.entries = [e for i, e in enumerate(make_entries(600)) if i % 3]
+    analyzer.treatments = make_treatments(2, corrections_per_day=12)
+    return analyzer
+
+
+def test_columns_round_trip_and_types():
+    entries = make_entries(5)
+    columns = EntryColumns.from_documents(entries[3:] + entries[:3] + [{'type': 'mbg', 'date': 0}])
+    assert (columns.time.dtype, columns.date.dtype, columns.sgv.dtype) == (np.int64, np.int64, np.float32)
+    assert list(columns) == [{k: e[k] for k in ('sgv', 'date', 'dateString')} for e in entries]
+    assert columns.time.tolist() == [e['date'] * 1000 for e in entries]
+
+    treatments = make_treatments(1) + [{'eventType': 'Note', 'created_at': ns_date(START)}]
+    columns = TreatmentColumns.from_rows(json.loads(json.dumps(treatments), object_hook=TreatmentColumns.row))
+    assert sorted(columns.event_types) == ['Correction Bolus', 'Meal Bolus', 'Note']
+    assert columns.event.dtype == np.int16 and np.isnan(columns.insulin[-1])
+    assert list(columns) == [{'created_at': t['created_at'], 'eventType': t['eventType'], 'insulin': t.get('insulin')}
+                             for t in treatments]
+    columns.extend([{'eventType': 'Temp Basal', 'created_at': ns_date(START), 'insulin': 0}])
+    assert columns.is_event('Temp Basal').tolist() == [False] * len(treatments) + [True]
+    assert len(columns.boluses()[0]) == len(treatments) - 1
+
+    odd = [{'eventType': 'Correction Bolus', 'created_at': ns_date(START), 'insulin': value}
+           for value in ('1.5', 'two', '', None, {'units': 1}, [2])]
+    assert TreatmentColumns.from_documents(odd).insulin[0] == 1.5
+    assert np.isnan(TreatmentColumns.from_documents(odd).insulin[1:]).all()
+
+
+def test_compute_isf_index_matches_scan(analyzer):
+    corrections = [t for t in analyzer.treatments if t['eventType'] == 'Correction Bolus']
+    assert [analyzer._compute_isf(t) for t in corrections] == [scan_isf(analyzer, t) for t in corrections]
+
+
+def test_entry_index_follows_appended_and_replaced_entries(analyzer):
+    treatment = {'eventType': 'Correction Bolus', 'created_at': ns_date(START + timedelta(days=2, hours=1)),
+                 'insulin': 2}
+    assert analyzer._compute_isf(treatment) is not None
+    analyzer.entries.extend(make_entries(900)[600:])
+    assert analyzer._compute_isf(treatment) == scan_isf(analyzer, treatment)
+
+    analyzer.entries = analyzer.entries[:10]
+    assert analyzer._compute_isf(treatment) is None
+
+
+def scan_is_near_meal(analyzer, treatment):
+    # Reference: _is_near_meal before the sweep, a scan of every treatment
+    treatment_time = analyzer._parse_date(treatment['created_at'])
+    return any(t.get('eventType') == 'Meal Bolus' and
+               abs((analyzer._parse_date(t['created_at']) - treatment_time).total_seconds()) < analyzer.meal_window
+               for t in analyzer.treatments)
+
+
+treatment_streams = st.lists(st.tuples(
+    st.integers(0, 3 * 24 * 60),  # minutes from the start of the entries
+    st.sampled_from([0, 1, 999999]),  # microseconds, to probe the edges of the window
+    st.sampled_from(['Meal Bolus', 'Correction Bolus', 'Temp Basal']),
+    st.sampled_from([None, 0, 0.5, 2]),
+), max_size=60)
+
+
+@settings(max_examples=200, deadline=None)
+@given(stream=treatment_streams, window_minutes=st.sampled_from([30, 240, 241]))
+def test_meal_sweep_matches_scan(stream, window_minutes):
+    analyzer = NightscoutAnalyzer('http://localhost', meal_window=window_minutes * 60)
+    analyzer.entries = ENTRIES
+    analyzer.treatments = [{'eventType': event, 'insulin': insulin,
+                            'created_at': ns_date(START + timedelta(minutes=minutes, microseconds=micro))}
+                           for minutes, micro, event, insulin in stream]
+    corrections = [t for t in analyzer.treatments if t['eventType'] == 'Correction Bolus']
+    expected = [scan_is_near_meal(analyzer, t) for t in corrections]
+    assert analyzer._near_meal_flags(np.array([epoch_us(t['created_at']) for t in corrections])).tolist() == expected
+    assert [analyzer._is_near_meal(t) for t in corrections] == expected
+
+    periods = [scan_isf(analyzer, t, ENTRY_TIMES) for t, near in zip(corrections, expected) if not near]
+    periods = [x for x in periods if x is not None]
+    assert analyzer.analyze_data() == (sum(periods) / len(periods) if periods else None)
+
+
+def scan_iob(analyzer, target, dia_hours):
+    # Reference: total_IOB_for_period before the vectorized engine
+    total = 0
+    for t in analyzer.treatments:
+        given_at = datetime.fromisoformat(t['created_at'].replace('Z', '+00:00'))
+        if t.get('insulin') and target - timedelta(hours=dia_hours) <= given_at <= target:
+            total += t['insulin'] * (1 - (target - given_at).total_seconds() / 3600 / dia_hours)
+    return total
+
+
+def test_iob_series_matches_per_target_sum(analyzer):
+    targets = [START + timedelta(minutes=m) for m in range(-60, 3 * 24 * 60, 7)]
+    series = analyzer.iob_series(np.array([t.timestamp() for t in targets]))
+    assert series == pytest.approx([scan_iob(analyzer, t, 4.5) for t in targets], abs=1e-9)
+    assert analyzer.total_IOB_for_period(targets[100].replace(tzinfo=None), 3) == \
+        pytest.approx(scan_iob(analyzer, targets[100], 3), abs=1e-9)
+
+    # The pairwise path for custom curves agrees with the prefix sums of the linear one
+    analyzer.iob_curve = lambda elapsed, dia: 1 - elapsed / dia
+    assert analyzer.iob_series(np.array([t.timestamp() for t in targets])) == pytest.approx(series, abs=1e-9)
+
+
+def test_iob_series_with_exponential_curve(analyzer):
+    curve = exponential_curve(peak_minutes=75)
+    assert curve(np.array([0.0, 6.0]), 6.0) == pytest.approx([1.0, 0.0], abs=1e-9)
+
+    analyzer.iob_curve, analyzer.dia_hours = curve, 6
+    bolus = analyzer.treatments[0]
+    given_at = analyzer._parse_date(bolus['created_at']).timestamp()
+    analyzer.treatments = [bolus]
+    series = analyzer.iob_series(np.array([given_at - 60, given_at, given_at + 3 * 3600, given_at + 7 * 3600]))
+    assert series[0] == 0 and series[3] == 0
+    assert series[1] == pytest.approx(bolus['insulin'])
+    assert 0 < series[2] < bolus['insulin']
+
+
+def test_forecast_fits_once_per_data_version(analyzer, tmp_path):
+    analyzer.models = ModelRegistry(tmp_path)
+    forecast = analyzer.combined_glucose_forecast(hours_ahead=3)
+    assert len(forecast) == 3
+    assert analyzer.combined_glucose_prediction(hours_ahead=2) == pytest.approx(forecast[1])
+    assert analyzer.models.fits == 1
+
+    # Another analyzer on the same data loads the pickled model instead of training
+    other = NightscoutAnalyzer('http://localhost', models=ModelRegistry(tmp_path))
+    other.entries, other.treatments = analyzer.entries, analyzer.treatments
+    assert other.combined_glucose_forecast(hours_ahead=3) == pytest.approx(forecast)
+    assert (other.models.fits, other.models.disk_hits) == (0, 1)
+
+    analyzer.entries.extend(make_entries(601)[600:])
+    analyzer.combined_glucose_forecast(hours_ahead=3)
+    assert analyzer.models.fits == 2
+
+
+def test_data_version_covers_the_analyzer_parameters(analyzer):
+    def version(**options):
+        other = NightscoutAnalyzer('http://localhost', **options)
+        other.entries, other.treatments = analyzer.entries, analyzer.treatments
+        return other.data_version()
+
+    assert version() == analyzer.data_version()
+    assert version(iob_curve=exponential_curve(55)) == version(iob_curve=exponential_curve(55))
+    versions = {version(), version(dia_hours=3), version(meal_window=3600), version(iob_curve=exponential_curve(55)),
+                version(iob_curve=exponential_curve(75)), version(iob_curve=lambda elapsed, dia: 1 - elapsed / dia)}
+    assert len(versions) == 6
+
+
+def test_backtest_parallel_matches_serial_and_keeps_entries(analyzer, tmp_path):
+    entries = list(analyzer.entries)
+    serial = analyzer.backtest('predict_glucose', test_size=0.1, horizons=2, workers=1)
+    parallel = analyzer.backtest('predict_glucose', test_size=0.1, horizons=2, workers=3,
+                                 output=tmp_path / 'steps.csv')
+    assert parallel == serial
+    assert list(analyzer.entries) == entries
+    assert serial[1]['n'] > 0 and serial[1]['rmse'] >= serial[1]['mae']
+    lines = (tmp_path / 'steps.csv').read_text().splitlines()
+    assert lines[0] == 'step,date,horizon,predicted,actual'
+    assert len(lines) == 1 + 2 * (len(entries) - int(0.9 * len(entries)))
+
+
+def test_backtest_retrain_cadence(analyzer, mocker):
+    fit = mocker.spy(NightscoutAnalyzer, '_fit_model')
+    analyzer.entries = analyzer.entries[:120]
+    summary = analyzer.backtest('combined_glucose_forecast', test_size=0.1, horizons=1, retrain_every=5, workers=1)
+    assert fit.call_count == 3  # 12 steps in blocks of 5
+    assert summary[1]['n'] > 0
+
+
+def test_backtest_predicts_as_of_each_step(analyzer, tmp_path):
+    # The data is from 2024, so forecasts made with the wall clock would see no insulin on board
+    analyzer.backtest('predict_glucose', test_size=0.2, horizons=2, workers=1, output=tmp_path / 'steps.csv')
+    with open(tmp_path / 'steps.csv') as f:
+        rows = list(csv.DictReader(f))
+    entries, treatments = analyzer.entries, list(analyzer.treatments)
+    check = NightscoutAnalyzer('http://localhost')
+    with_insulin = 0
+    for row in rows[::5]:
+        step, horizon = int(row['step']), int(row['horizon'])
+        step_time = int(entries.time[step - 1])
+        check.entries = entries[:step]
+        check.treatments = [t for t in treatments if epoch_us(t['created_at']) <= step_time]
+        expected = check.predict_glucose(horizon, now=step_time / 10 ** 6)
+        assert float(row['predicted']) == pytest.approx(expected)
+        with_insulin += expected != pytest.approx(float(entries.sgv[step - 1]))
+    assert with_insulin > 5
@@ -0,0 +1,71 @@
+import json
+
+import numpy as np
+import pytest
+from benchmarks.fake_nightscout import FakeNightscout
+from benchmarks.nightscout_data import make_entries, make_treatments
+from database import get_connection
+from drafts.isf import NightscoutAnalyzer
+from nightscout_sync import NightscoutSync, iter_json_array
+
+
+@pytest.fixture
+def site():
+    treatments = make_treatments(3)
+    # Two documents on one timestamp, so a page boundary can fall between them
+    treatments.append(dict(treatments[5], _id='twin', eventType='Carb Correction', insulin=None))
+    site = FakeNightscout(make_entries(800), treatments).start()
+    yield site
+    site.stop()
+    conn = get_connection()
+    with conn:
+        for table in ('ns_entries', 'ns_treatments', 'ns_sync_state'):
+            conn.execute(f'DELETE FROM {table} WHERE source=?', (site.url,))
+
+
+def test_iter_json_array_decodes_across_chunks():
+    documents = [{'a': i, 's': 'x,]}' * i} for i in range(50)]
+    text = json.dumps(documents, indent=1)
+    assert list(iter_json_array(text[i:i + 7] for i in range(0, len(text), 7))) == documents
+    assert list(iter_json_array(['[', ']'])) == []
+    with pytest.raises(ValueError):
+        list(iter_json_array(['[{"a": 1}, {"b"']))
+
+
+def test_sync_pages_then_fetches_only_new_data(site):
+    sync = NightscoutSync(site.url, page_size=100)
+    assert sync.sync()['entries'] >= 800
+    entries, treatments = sync.load()
+    assert [e['date'] for e in entries] == sorted(e['date'] for e in site.collections['entries'])
+    assert len(treatments) == len(site.collections['treatments'])
+
+    site.requests.clear()
+    site.served = 0
+    assert sync.sync() == {'entries': 0, 'treatments': 0}
+    assert len(site.requests) == 2
+
+    site.add('entries', make_entries(850)[800:])
+    assert sync.sync()['entries'] == 50
+    assert site.served == 50
+    assert len(sync.load()[0]) == 850
+
+
+@pytest.mark.parametrize('page_size', [2, 5, 6])
+def test_sync_keeps_documents_sharing_a_page_boundary(site, page_size):
+    sync = NightscoutSync(site.url, page_size=page_size)
+    sync.sync_collection('treatments')
+    assert len(sync.load()[1]) == len(site.collections['treatments'])
+
+
+def test_analyzer_reads_synced_cache(site):
+    analyzer = NightscoutAnalyzer(site.url)
+    assert analyzer.fetch_data(sync=NightscoutSync(site.url, page_size=500))
+    assert len(analyzer.entries) == 800
+    assert analyzer.analyze_data() is not None
+
+    # Columns read from the cache rows match those built from the documents
+    documents = NightscoutAnalyzer(site.url)
+    documents.entries, documents.treatments = NightscoutSync(site.url).load()
+    for field in ('time', 'date', 'sgv'):
+        assert np.array_equal(getattr(analyzer.entries, field), getattr(documents.entries, field))
+    assert list(analyzer.treatments) == list(documents.treatments)
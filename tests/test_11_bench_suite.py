@@ -0,0 +1,25 @@
+import copy
+
+import database
+import main
+from benchmarks.suite import CASES, compare, run
+from benchmarks.synthetic import make_readings
+
+
+def test_synthetic_readings_are_deterministic():
+    rows = list(make_readings(2, 1, end=1700000123))
+    assert rows == list(make_readings(2, 1, end=1700000123))
+    assert len(rows) == 2 * 288 and {row[1] for row in rows} == {1, 2}
+    assert rows[0][0] == 1700000100 and all(40 <= row[2] <= 400 for row in rows)
+
+
+def test_suite_runs_offline_and_flags_regressions():
+    db_file, bot = database.DB_FILE, main.bot
+    current = run([(2, 3)], repeat=1, progress=lambda message: None)
+    assert (database.DB_FILE, main.bot) == (db_file, bot)
+    assert set(current['results']) == {f'{name}[2x3]' for name, _, _ in CASES} | {'bulk_load[2x3]'}
+
+    assert compare(current, current) == []
+    slower = copy.deepcopy(current)
+    slower['results']['bulk_load[2x3]']['min'] *= 2
+    assert [key for key, *_ in compare(slower, current, threshold=0.5)] == ['bulk_load[2x3]']
@@ -0,0 +1,91 @@
+import asyncio
+import time
+import urllib.request
+from types import SimpleNamespace
+
+import pytest
+from telebot import apihelper, asyncio_helper
+
+import main
+import metrics
+from database import get_connection
+
+USER_ID = 10
+
+
+@pytest.fixture
+def registry():
+    metrics.registry.reset()
+    yield metrics.registry
+    metrics.registry.reset()
+
+
+def series(name, **labels):
+    return metrics.registry.histogram(name, **labels).snapshot()
+
+
+def test_histogram_buckets_and_exposition(registry):
+    histogram = registry.histogram('demo_seconds', 'Demo', op='x')
+    for value in (0.0001, 0.003, 0.003, 20):
+        histogram.observe(value)
+    registry.inc('demo_total', 2, 'Demo counter', op='x')
+    registry.gauge('demo_depth', lambda: 7, 'Demo gauge')
+    assert histogram.quantile(0.5) == 0.005 and histogram.quantile(1) == float('inf')
+
+    text = registry.render()
+    assert '# TYPE t1d_demo_seconds histogram' in text
+    assert 't1d_demo_seconds_bucket{op="x",le="0.0005"} 1' in text
+    assert 't1d_demo_seconds_bucket{op="x",le="0.005"} 3' in text
+    assert 't1d_demo_seconds_bucket{op="x",le="+Inf"} 4' in text
+    assert 't1d_demo_seconds_count{op="x"} 4' in text
+    assert 't1d_demo_total{op="x"} 2' in text and 't1d_demo_depth 7' in text
+    registry.remove_gauge('demo_depth')
+
+
+def test_handler_latency_and_rows_read(registry, mocker):
+    mocker.patch('main.bot')
+    now = int(time.time())
+    conn = get_connection()
+    with conn:
+        conn.executemany('INSERT INTO user_inputs (ts, user_id, mg_dl, mmol_l) VALUES (?, ?, ?, ?)',
+                         [(now - 300 * i, USER_ID, 100.0, 5.5) for i in range(30)])
+    try:
+        call = SimpleNamespace(data='1 day', from_user=SimpleNamespace(id=USER_ID),
+                               message=SimpleNamespace(chat=SimpleNamespace(id=1)))
+        main.process_callback_history(call)
+    finally:
+        with conn:
+            conn.execute('DELETE FROM user_inputs WHERE user_id=?', (USER_ID,))
+
+    assert series('handler_seconds', handler='process_callback_history')[2] == 1
+    counts, rows, count = series('request_rows_read', buckets=metrics.ROW_BUCKETS, handler='process_callback_history')
+    assert (rows, count) == (30, 1)
+    assert series('db_query_seconds', query='iter_history_data')[2] == 1
+
+
+def test_telegram_calls_are_timed(registry, monkeypatch):
+    async def process_request(token, url, method='get', params=None, files=None, **kwargs):
+        return {'ok': True}
+
+    monkeypatch.setattr(apihelper, '_make_request', lambda token, method_name, **kwargs: {'ok': True})
+    monkeypatch.setattr(asyncio_helper, '_process_request', process_request)
+    metrics.instrument_telegram()
+    apihelper._make_request('token', 'sendMessage', method='post')
+    asyncio.run(asyncio_helper._process_request('token', 'editMessageText'))
+    assert series('telegram_api_seconds', method='sendMessage')[2] == 1
+    assert series('telegram_api_seconds', method='editMessageText')[2] == 1
+
+
+def test_metrics_endpoint_and_perf_command(registry, monkeypatch):
+    registry.histogram('handler_seconds', handler='handle_message').observe(0.002)
+    server = metrics.start_http_server(0, '127.0.0.1')
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+            assert response.headers['Content-Type'].startswith('text/plain')
+            assert 't1d_handler_seconds_count{handler="handle_message"} 1' in response.read().decode()
+    finally:
+        server.shutdown()
+
+    monkeypatch.setattr(main, 'ADMIN_IDS', frozenset({42}))
+    assert main.perf_message(7) is None
+    assert 'handler_seconds handle_message: n=1' in main.perf_message(42)
@@ -0,0 +1,153 @@
+import os
+from collections import defaultdict
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import dispatcher
+import main
+from database import get_connection, select_all_data
+from dispatcher import Dispatcher
+
+BOT_SPEC = 'tests.test_13_dispatcher:bot'
+
+
+class LogBot:
+    """Worker-side bot: appends "pid user_id update_id" per update to $DISPATCH_LOG; "crash" kills the worker."""
+
+    threaded = False
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            if update.message.text == 'crash':
+                os._exit(3)
+            with open(os.environ['DISPATCH_LOG'], 'a') as f:
+                f.write(f'{os.getpid()} {update.message.from_user.id} {update.update_id}\n')
+
+
+bot = LogBot()
+
+
+def message_update(update_id, user_id, text='120'):
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': 0, 'text': text,
+                        'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'},
+                        'chat': {'id': user_id, 'type': 'private'}}}
+
+
+@pytest.fixture
+def log(tmp_path, monkeypatch):
+    path = tmp_path / 'dispatch.log'
+    path.touch()
+    monkeypatch.setenv('DISPATCH_LOG', str(path))
+
+    def read():
+        return [tuple(int(x) for x in line.split()) for line in path.read_text().splitlines()]
+    return read
+
+
+def test_updates_are_sharded_by_user_and_kept_in_order(log):
+    dispatcher = Dispatcher(BOT_SPEC, workers=2).start()
+    try:
+        for update_id in range(1, 41):
+            dispatcher.dispatch(message_update(update_id, 1 + update_id % 8))
+        assert dispatcher.wait_idle(30)
+        stats = dispatcher.stats()
+    finally:
+        dispatcher.stop()
+
+    rows = log()
+    assert sorted(update_id for _, _, update_id in rows) == list(range(1, 41))
+    by_user, pids = defaultdict(list), defaultdict(set)
+    for pid, user_id, update_id in rows:
+        by_user[user_id].append(update_id)
+        pids[user_id].add(pid)
+    assert all(ids == sorted(ids) for ids in by_user.values())
+    assert all(len(user_pids) == 1 for user_pids in pids.values())
+    assert sum(figures['processed'] for figures in stats.values()) == 40
+    assert all(figures['shards'] == 4 for figures in stats.values())
+
+
+def test_crashed_worker_is_replaced_and_poison_update_dropped(log):
+    dispatcher = Dispatcher(BOT_SPEC, workers=2, max_attempts=2).start()
+    try:
+        for update_id, text in enumerate(['120', 'crash', '130', '140'], start=1):
+            dispatcher.dispatch(message_update(update_id, 1, text))
+        dispatcher.dispatch(message_update(5, 2))
+        assert dispatcher.wait_idle(60)
+        assert (dispatcher.crashes, dispatcher.dropped) == (2, 1)
+        # The slot has a live replacement, which takes new updates for the shard
+        dispatcher.dispatch(message_update(6, 1))
+        assert dispatcher.wait_idle(30)
+    finally:
+        dispatcher.stop()
+
+    # Update 1 had been reported before the crash, so only the updates queued behind the poison are redelivered
+    assert [update_id for _, user_id, update_id in log() if user_id == 1] == [1, 3, 4, 6]
+
+
+def test_shards_of_crashed_worker_move_to_survivor_without_respawn(log):
+    dispatcher = Dispatcher(BOT_SPEC, workers=2, respawn=False, max_attempts=1).start()
+    try:
+        crashing = dispatcher.assignment[dispatcher.shard_of(message_update(0, 1))]
+        dispatcher.dispatch(message_update(1, 1, 'crash'))
+        assert dispatcher.wait_idle(30)
+        assert set(dispatcher.assignment.values()) == {1 - crashing}
+        dispatcher.dispatch(message_update(2, 1))
+        assert dispatcher.wait_idle(30)
+        assert list(dispatcher.stats()) == [1 - crashing]
+    finally:
+        dispatcher.stop()
+    assert [update_id for _, _, update_id in log()] == [2]
+
+
+def test_serve_keeps_polling_after_api_and_network_errors(monkeypatch):
+    from telebot import apihelper
+
+    class FakeDispatcher:
+        def __init__(self, *args, **kwargs):
+            self.updates, self.stopped = [], False
+            instances.append(self)
+
+        def start(self):
+            return self
+
+        def dispatch(self, update):
+            self.updates.append(update['update_id'])
+
+        def stop(self):
+            self.stopped = True
+
+    instances, sleeps = [], []
+    monkeypatch.setattr(dispatcher, 'Dispatcher', FakeDispatcher)
+    monkeypatch.setattr(apihelper, 'delete_webhook', lambda token: True)
+    monkeypatch.setattr(dispatcher.time, 'sleep', sleeps.append)
+    polls = iter([requests.ConnectionError('reset'), apihelper.ApiException('getUpdates failed', 'getUpdates', None),
+                  [message_update(5, 1)], requests.Timeout('read timeout'), KeyboardInterrupt()])
+
+    def get_updates(token, offset=None, **kwargs):
+        result = next(polls)
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    monkeypatch.setattr(apihelper, 'get_updates', get_updates)
+    dispatcher.serve('token', workers=1)
+    assert instances[0].updates == [5] and instances[0].stopped
+    # Doubles while failures follow each other, and starts over after a successful poll
+    assert sleeps == [dispatcher.RETRY_DELAY, 2 * dispatcher.RETRY_DELAY, dispatcher.RETRY_DELAY]
+
+
+def test_redelivered_glucose_message_is_stored_once(mocker):
+    send = mocker.patch('main.send_message')
+    message = SimpleNamespace(text='123', date=1700000000, from_user=SimpleNamespace(id=1301),
+                              chat=SimpleNamespace(id=1301))
+    try:
+        main.handle_message(message)
+        main.handle_message(message)
+        assert [row[2] for row in select_all_data(1301)] == [123.0]
+        assert 'was not saved' in send.call_args.args[1]
+    finally:
+        get_connection().execute('DELETE FROM user_inputs WHERE user_id=1301')
+        get_connection().commit()
@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import defaultdict
+
+import pytest
+import telebot
+from telebot import apihelper, asyncio_helper
+
+import main
+from benchmarks.fake_telegram import FakeTelegram, use_fake_api
+from outbox import BULK, MERGE_SEPARATOR, Outbox, TokenBucket
+
+
+class GatedBot:
+    """Records sends; the first one blocks until ``gate`` is set, so a backlog can build up behind it."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.gate = threading.Event()
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        if len(self.sent) == 1:
+            self.gate.wait(5)
+        time.sleep(self.delay)
+        return len(self.sent)
+
+
+@pytest.fixture
+def fake_api():
+    urls = apihelper.API_URL, asyncio_helper.API_URL
+    apis = []
+
+    def start(**limits):
+        api = FakeTelegram(**limits).start()
+        apis.append(api)
+        use_fake_api(api.port)
+        return api
+    yield start
+    for api in apis:
+        api.stop()
+    apihelper.API_URL, asyncio_helper.API_URL = urls
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2, burst=2, now=0.0)
+    bucket.take(0.0)
+    bucket.take(0.0)
+    assert bucket.wait_time(0.0) == pytest.approx(0.5)
+    assert bucket.wait_time(0.5) == 0
+    bucket.block_until(3.0)
+    assert bucket.wait_time(1.0) == pytest.approx(2.0)
+    assert not bucket.full(2.0) and bucket.full(3.0)
+
+
+def test_priority_order_and_merging():
+    bot = GatedBot()
+    outbox = Outbox(bot, global_rate=1000, chat_rate=1000, senders=1).start()
+    try:
+        first = outbox.send_message(1, 'a')
+        while not bot.sent:
+            time.sleep(0.001)
+        outbox.send_message(2, 'digest', priority=BULK)
+        outbox.send_message(3, 'reply')
+        merged = [outbox.send_message(1, 'b'), outbox.send_message(1, 'c')]
+        outbox.send_message(1, 'menu', reply_markup='keyboard')
+        bot.gate.set()
+        assert outbox.wait_idle(5)
+    finally:
+        outbox.stop()
+    assert bot.sent == [(1, 'a'), (3, 'reply'), (1, 'b' + MERGE_SEPARATOR + 'c'), (1, 'menu'), (2, 'digest')]
+    assert first.result() == 1
+    assert merged[0].result() == merged[1].result() == 3
+    assert (outbox.sent, outbox.merged, outbox.pending) == (5, 1, 0)
+
+
+def test_handlers_do_not_wait_for_sends(monkeypatch):
+    bot = GatedBot(delay=0.2)
+    bot.gate.set()
+    outbox = Outbox(bot, global_rate=1000, chat_rate=1000, senders=1).start()
+    monkeypatch.setattr(main, 'outbox', outbox)
+    try:
+        start = time.perf_counter()
+        for chat_id in range(1, 6):
+            main.handle_start_command(chat_id)
+        assert time.perf_counter() - start < 0.1
+        assert outbox.wait_idle(5)
+    finally:
+        outbox.stop()
+    assert [chat_id for chat_id, _ in bot.sent] == [1, 2, 3, 4, 5]
+
+
+def send_numbered(outbox, chats, per_chat):
+    futures = [outbox.send_message(chat_id, f'{chat_id}:{i}', disable_notification=True)
+               for i in range(per_chat) for chat_id in chats]
+    assert outbox.wait_idle(30)
+    assert all(future.exception() is None for future in futures)
+
+
+def received_by_chat(api):
+    received = defaultdict(list)
+    for chat_id, text, _ in api.sent:
+        received[chat_id].append(int(text.split(':')[1]))
+    return received
+
+
+def test_stays_within_fake_api_limits(fake_api):
+    api = fake_api(chat_limit=3, global_limit=10, window=1.0)
+    outbox = Outbox(telebot.TeleBot('1:test'), global_rate=6, global_burst=2, chat_rate=1.5, chat_burst=1).start()
+    try:
+        send_numbered(outbox, range(1, 5), per_chat=3)
+    finally:
+        outbox.stop()
+    assert api.rejected == []
+    assert received_by_chat(api) == {chat_id: [0, 1, 2] for chat_id in range(1, 5)}
+
+
+def test_retries_after_flood_limit_in_order(fake_api):
+    api = fake_api(chat_limit=3, window=0.5, retry_after=0.2)
+    outbox = Outbox(telebot.TeleBot('1:test'), global_rate=1000, chat_rate=1000, chat_burst=10).start()
+    try:
+        send_numbered(outbox, [1, 2], per_chat=6)
+    finally:
+        outbox.stop()
+    assert api.rejected and outbox.retried == len(api.rejected)
+    assert received_by_chat(api) == {1: list(range(6)), 2: list(range(6))}
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import async_main
+import main
+from database import check_daily_stats, get_connection, to_epoch
+from importer import ImportFormatError, import_readings, iso_time_parser, normalize_glucose
+
+USER_ID = 15
+
+DEXCOM_CSV = """Index,Timestamp (YYYY-MM-DDThh:mm:ss),Event Type,Event Subtype,Patient Info,Glucose Value (mg/dL),\
+Glucose Rate of Change (mg/dL/min)
+1,,FirstName,,Jane,,
+2,,Device,,G6,,
+3,2024-03-01T08:00:00,EGV,,,120,0.5
+4,2024-03-01T08:05:00,EGV,,,Low,
+5,2024-03-01T08:10:00,EGV,,,131,1.0
+6,2024-03-01T08:15:00,EGV,,,145,
+"""
+
+# LibreView in a day-month locale: the first days cannot tell the date format apart
+LIBRE_CSV = """Glucose Data,Generated on,03-02-2024 10:00 UTC,Generated by,Jane
+Device,Serial Number,Device Timestamp,Record Type,Historic Glucose mmol/L,Scan Glucose mmol/L,Ketone mmol/L
+FreeStyle LibreLink,ABC,01-02-2024 08:00,0,5.5,,
+FreeStyle LibreLink,ABC,01-02-2024 08:05,1,,6.1,
+FreeStyle LibreLink,ABC,01-02-2024 08:20,6,,,0.2
+FreeStyle LibreLink,ABC,13-02-2024 09:00,0,7.2,,
+"""
+
+
+def chunks(text, size=7):
+    data = text.encode()
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+def stored():
+    return get_connection().execute('SELECT ts, mg_dl, mmol_l FROM user_inputs WHERE user_id=? ORDER BY ts',
+                                    (USER_ID,)).fetchall()
+
+
+@pytest.fixture(autouse=True)
+def clean():
+    yield
+    conn = get_connection()
+    with conn:
+        conn.execute('DELETE FROM user_inputs WHERE user_id=?', (USER_ID,))
+
+
+def test_normalize_glucose():
+    assert normalize_glucose(120) == (120.0, 6.66)
+    assert normalize_glucose(7) == (126.1, 7.0)
+    assert normalize_glucose(5.5, 'mmol/L') == (99.1, 5.5)
+    assert normalize_glucose(30, 'mg/dL') == (30.0, 1.66)
+
+
+def test_nightscout_array_is_deduplicated():
+    entries = [{'sgv': 100 + i, 'date': 1700000000000 + i * 300000, 'type': 'sgv'} for i in range(10)]
+    entries.append({'type': 'cal', 'date': 1700000000000, 'slope': 1})
+    progress = []
+
+    first = import_readings(USER_ID, chunks(json.dumps(entries)), lambda *args: progress.append(args), batch_size=4)
+    again = import_readings(USER_ID, chunks(json.dumps(entries[:5]), size=3))
+
+    assert first == (10, 10, 1, 1700000000, 1700000000 + 9 * 300, 0, 0)
+    assert progress == [(4, 4), (8, 8)]
+    assert (again.read, again.inserted) == (5, 0)
+    assert stored()[0] == (1700000000, 100.0, 5.55)
+    assert check_daily_stats() == []
+
+
+def test_nightscout_lines():
+    lines = [json.dumps({'sgv': 150, 'date': {'$numberLong': str(1700000000000 + i * 300000)}}) for i in range(3)]
+    result = import_readings(USER_ID, chunks('\n'.join(lines) + '\n'))
+    assert (result.read, result.inserted) == (3, 3)
+
+
+def test_dexcom_csv():
+    result = import_readings(USER_ID, chunks('\ufeff' + DEXCOM_CSV))
+    assert (result.read, result.inserted, result.skipped) == (3, 3, 1)
+    assert [row[:2] for row in stored()] == [(to_epoch('2024-03-01T08:00:00'), 120.0),
+                                             (to_epoch('2024-03-01T08:10:00'), 131.0),
+                                             (to_epoch('2024-03-01T08:15:00'), 145.0)]
+
+
+def test_libre_csv_day_month_and_mmol():
+    result = import_readings(USER_ID, chunks(LIBRE_CSV))
+    assert (result.read, result.inserted, result.skipped) == (3, 3, 0)
+    assert stored() == [(int(datetime(2024, 2, 1, 8, 0).timestamp()), 99.1, 5.5),
+                        (int(datetime(2024, 2, 1, 8, 5).timestamp()), 109.9, 6.1),
+                        (int(datetime(2024, 2, 13, 9, 0).timestamp()), 129.7, 7.2)]
+
+
+def test_iso_times_across_a_repeated_hour(monkeypatch):
+    monkeypatch.setenv('TZ', 'Europe/Berlin')
+    time.tzset()
+    try:
+        # 02:00-03:00 happens twice on 2024-10-27 in Berlin
+        texts = [f'2024-10-27T{hour:02}:{minute:02}:30' for hour in (1, 2, 3) for minute in (0, 59)]
+        parse, other = iso_time_parser(), iso_time_parser()
+        assert [parse(text) for text in texts] == [to_epoch(text) for text in texts]
+        # Each parser remembers its own hour
+        assert other('2024-10-27T03:00:30') == to_epoch('2024-10-27T03:00:30')
+        assert parse('2024-10-27T01:59:30') == to_epoch('2024-10-27T01:59:30')
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+@pytest.mark.parametrize('text', ['', 'name,value\nx,1\n', '{"sgv": 100}\n', b'\xff\xfe\x00'])
+def test_unreadable_files(text):
+    data = [text] if isinstance(text, bytes) else chunks(text)
+    with pytest.raises(ImportFormatError):
+        import_readings(USER_ID, data)
+
+
+def test_document_import_edits_the_status_message(mocker):
+    bot = mocker.patch('main.bot')
+    bot.send_message.return_value = SimpleNamespace(message_id=42)
+    response = mocker.MagicMock()
+    response.__enter__.return_value.iter_content.return_value = chunks(DEXCOM_CSV)
+    mocker.patch('main.open_document', return_value=response)
+    mocker.patch.object(main.import_executor, 'submit', side_effect=lambda fn, *args: fn(*args))
+
+    message = SimpleNamespace(document=SimpleNamespace(file_id='f', file_name='clarity.csv', file_size=1000),
+                              from_user=SimpleNamespace(id=USER_ID), chat=SimpleNamespace(id=5))
+    main.handle_document(message)
+
+    bot.send_message.assert_called_once_with(5, 'Importing clarity.csv…')
+    text = bot.edit_message_text.call_args.args[0]
+    assert text == 'Imported 3 new readings from 2024-03-01 to 2024-03-01. 1 rows could not be read.'
+    assert bot.edit_message_text.call_args.args[1:] == (5, 42)
+
+
+def test_async_document_import(mocker):
+    bot = mocker.patch('async_main.bot', new=mocker.AsyncMock())
+    bot.send_message.return_value = SimpleNamespace(message_id=43)
+    response = mocker.MagicMock()
+    response.__enter__.return_value.iter_content.return_value = chunks(DEXCOM_CSV)
+    mocker.patch('main.open_document', return_value=response)
+    message = SimpleNamespace(document=SimpleNamespace(file_id='f', file_name='clarity.csv', file_size=1000),
+                              from_user=SimpleNamespace(id=USER_ID), chat=SimpleNamespace(id=6))
+
+    async def scenario():
+        await async_main.handle_document(message)
+        await asyncio.gather(*async_main._imports)
+
+    asyncio.run(scenario())
+    bot.send_message.assert_awaited_once_with(6, 'Importing clarity.csv…')
+    bot.edit_message_text.assert_awaited_with('Imported 3 new readings from 2024-03-01 to 2024-03-01. '
+                                              '1 rows could not be read.', 6, 43)
+    assert len(stored()) == 3 and not async_main._imports
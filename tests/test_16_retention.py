@@ -0,0 +1,138 @@
+import datetime
+import threading
+
+import pytest
+
+import database
+import main
+from database import check_daily_stats, get_connection, insert_data, insert_readings, iter_history_data, \
+    select_history_data, select_window_stats
+from importer import import_readings
+from retention import RetentionJob, compact, compact_user, cutoffs
+from stats import load_readings
+
+USER_ID = 16
+# 2023-01-01 00:00 UTC; readings every 5 minutes for three hours
+BASE = 1672531200
+LEVELS = [100 + 10 * (i % 7) for i in range(36)]
+
+
+@pytest.fixture(autouse=True)
+def readings():
+    insert_readings([(BASE + i * 300, USER_ID, level, round(level / 18.0182, 2)) for i, level in enumerate(LEVELS)])
+    yield
+    conn = get_connection()
+    with conn:
+        conn.execute('DELETE FROM retention_state WHERE user_id=?', (USER_ID,))
+        for table in ('user_inputs', 'rollup_15m', 'rollup_1h'):
+            conn.execute(f'DELETE FROM {table} WHERE user_id=?', (USER_ID,))
+        conn.execute('DELETE FROM daily_stats WHERE user_id=?', (USER_ID,))
+
+
+def tier(table):
+    return get_connection().execute(f'SELECT ts, n, min_mg_dl, max_mg_dl, sum_mg_dl FROM {table} WHERE user_id=? '
+                                    'ORDER BY ts', (USER_ID,)).fetchall()
+
+
+def test_compaction_moves_readings_into_rollups():
+    before = select_window_stats(USER_ID)
+    assert compact_user(USER_ID, BASE + 7200, BASE + 3600, batch_size=5, pause=0) == (24, 4)
+
+    raw = get_connection().execute('SELECT ts FROM user_inputs WHERE user_id=?', (USER_ID,)).fetchall()
+    assert min(raw)[0] == BASE + 7200 and len(raw) == 12
+    assert tier('rollup_15m') == [(BASE + 3600 + q * 900, 3, min(LEVELS[12 + 3 * q:15 + 3 * q]),
+                                   max(LEVELS[12 + 3 * q:15 + 3 * q]), sum(LEVELS[12 + 3 * q:15 + 3 * q]))
+                                  for q in range(4)]
+    assert tier('rollup_1h') == [(BASE, 12, min(LEVELS[:12]), max(LEVELS[:12]), sum(LEVELS[:12]))]
+    assert select_window_stats(USER_ID) == pytest.approx(before)
+    assert check_daily_stats() == []
+    assert compact_user(USER_ID, BASE + 7200, BASE + 3600, pause=0) == (0, 0)
+
+
+def test_late_readings_for_compacted_periods_are_ignored():
+    compact_user(USER_ID, BASE + 3600, BASE, pause=0)
+    before = select_window_stats(USER_ID)
+
+    insert_data(USER_ID, 300, 16.65, BASE + 60)
+    assert insert_readings([(BASE + 120, USER_ID, 300, 16.65), (BASE + 3601, USER_ID, 300, 16.65)]) == 1
+    assert select_window_stats(USER_ID)[0] == before[0] + 1
+    assert tier('rollup_15m')[0][1] == 3
+
+
+def test_imports_of_compacted_periods_fill_empty_buckets():
+    compact_user(USER_ID, BASE + 7200, BASE + 3600, pause=0)
+    before = select_window_stats(USER_ID)
+    daily = get_connection().execute('SELECT n FROM daily_stats WHERE user_id=?', (USER_ID,)).fetchone()[0]
+    # Yesterday has no data; the first hour of the history and 01:00 are compacted into hourly and 15-minute buckets
+    rows = [(BASE - 3600 + i * 300, 200.0, 11.1) for i in range(4)] + [(BASE + 300, 200.0, 11.1)] + \
+           [(BASE + 3600 + 60, 200.0, 11.1), (BASE + 7200 + 60, 200.0, 11.1)]
+    text = 'Timestamp,Glucose Value (mg/dL)\n' + ''.join(
+        f'{datetime.datetime.fromtimestamp(ts):%Y-%m-%dT%H:%M:%S},{mg_dl}\n' for ts, mg_dl, _ in rows)
+    result = import_readings(USER_ID, [text.encode()])
+    assert (result.read, result.inserted, result.rolled_up, result.dropped) == (7, 1, 4, 2)
+    assert tier('rollup_1h')[0] == (BASE - 3600, 4, 200.0, 200.0, 800.0)
+    assert select_window_stats(USER_ID)[0] == before[0] + 5
+    assert get_connection().execute('SELECT n FROM daily_stats WHERE user_id=? AND day=?',
+                                    (USER_ID, (BASE - 3600) // 86400)).fetchone()[0] == 4
+    assert get_connection().execute('SELECT n FROM daily_stats WHERE user_id=? AND day=?',
+                                    (USER_ID, BASE // 86400)).fetchone()[0] == daily + 1
+    assert "4 older readings were added" in main.import_summary(result)
+    assert "2 readings fall in compacted periods" in main.import_summary(result)
+    assert "already stored" not in main.import_summary(result)
+
+    again = import_readings(USER_ID, [text.encode()])
+    assert (again.inserted, again.rolled_up, again.dropped) == (0, 0, 6)
+    assert select_window_stats(USER_ID)[0] == before[0] + 5
+
+
+def test_reads_continue_into_coarser_tiers():
+    compact_user(USER_ID, BASE + 7200, BASE + 3600, pause=0)
+
+    rows = list(iter_history_data(USER_ID))
+    assert [row[0] for row in rows] == [BASE + i * 300 for i in range(35, 23, -1)] + \
+           [BASE + 3600 + q * 900 for q in range(3, -1, -1)] + [BASE]
+    assert rows[12][2:] == (round(sum(LEVELS[21:24]) / 3, 1), round(sum(LEVELS[21:24]) / 3 / 18.0182, 2))
+    assert [row[0] for row in iter_history_data(USER_ID, after=BASE, date_to=BASE + 5400)] == \
+           [BASE + 3600, BASE + 4500, BASE + 5400]
+    assert [row[0] for row in select_history_data(USER_ID, BASE + 7200, BASE + 7800)] == [BASE + 7800, BASE + 7500,
+                                                                                        BASE + 7200]
+
+
+def test_history_pages_walk_across_tiers():
+    compact_user(USER_ID, BASE + 7200, BASE + 3600, pause=0)
+    seen, before = [], None
+    while True:
+        text, markup = main.history_page(USER_ID, 'all', before=before)
+        seen.extend(line for line in text.splitlines()[1:])
+        older = [button for button in markup.keyboard[0] if button.callback_data.startswith('hp:o:')]
+        if not older:
+            break
+        before = main.parse_history_page(older[0].callback_data)[1]
+    assert len(seen) == 17
+
+
+def test_long_windows_load_daily_means():
+    compact_user(USER_ID, BASE + 7200, BASE + 3600, pause=0)
+    ts, mg_dl = load_readings(USER_ID, max_days=0)
+    assert ts.tolist() == [BASE] and mg_dl.tolist() == [pytest.approx(sum(LEVELS) / len(LEVELS), abs=0.05)]
+    assert len(load_readings(USER_ID, max_days=1)[0]) == 17
+    assert len(load_readings(USER_ID, BASE, BASE + 86400, max_days=0)[0]) == 1
+
+
+def test_compact_and_job_on_a_fresh_database(tmp_path, monkeypatch):
+    database.close_connections()
+    monkeypatch.setattr(database, 'DB_FILE', str(tmp_path / 'retention.db'))
+    try:
+        database.init_db()
+        now = BASE + 200 * 86400
+        insert_readings([(BASE + i * 300, user_id, 120.0, 6.66) for i in range(24) for user_id in (1, 2)])
+        insert_readings([(now - 60, 3, 120.0, 6.66)])
+        assert compact(now, raw_days=100, rollup_days=150, pause=0) == (2, 48, 16)
+        assert compact(now, raw_days=100, rollup_days=150, pause=0) == (0, 0, 0)
+        assert cutoffs(now, 100, 150) == (BASE + 100 * 86400, BASE + 50 * 86400)
+
+        job = RetentionJob(interval=60, pause=0).start()
+        job.stop(5)
+        assert not any(thread.name == 'RetentionJob' for thread in threading.enumerate())
+    finally:
+        database.close_connections()
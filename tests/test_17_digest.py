@@ -0,0 +1,156 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+from telebot import asyncio_helper
+from telebot.apihelper import ApiTelegramException
+
+import async_main
+import main
+from database import get_connection, insert_readings
+from digest import DigestJob, digest_figures, due_day, run_digest, subscribe, unsubscribe
+
+USER_IDS = (1701, 1702, 1703, 1704)
+# UTC day 19700: 2023-12-09
+DAY = 19700
+START = DAY * 86400
+
+
+@pytest.fixture(autouse=True)
+def subscribers():
+    # 1701-1703 have readings on the day, 1704 only on the day before
+    rows = [(START + i * 3600, user_id, level, round(level / 18.0182, 2))
+            for user_id, levels in ((1701, (60, 100, 150, 200)), (1702, (120, 140)), (1703, (90,)))
+            for i, level in enumerate(levels)]
+    rows += [(START - 3600, 1701, 300.0, 16.65), (START - 3600, 1704, 100.0, 5.55)]
+    insert_readings(rows)
+    for user_id in USER_IDS:
+        subscribe(user_id, user_id + 10000)
+    yield
+    conn = get_connection()
+    with conn:
+        conn.execute('DELETE FROM digest_runs WHERE day=?', (DAY,))
+        for user_id in USER_IDS:
+            unsubscribe(user_id)
+            conn.execute('DELETE FROM user_inputs WHERE user_id=?', (user_id,))
+
+
+class Sender:
+    """Records sends and resolves each one as a Future, failing for chats in ``fail``."""
+
+    def __init__(self, fail=None, stop=None):
+        self.fail = fail or {}
+        self.stop = stop
+        self.sent = []
+
+    def __call__(self, chat_id, text):
+        future = Future()
+        if chat_id in self.fail:
+            future.set_exception(self.fail[chat_id])
+        else:
+            self.sent.append((chat_id, text))
+            future.set_result(len(self.sent))
+        if self.stop is not None:
+            self.stop.set()
+        return future
+
+
+def test_figures_for_all_subscribers_in_one_query():
+    figures = {row.user_id: row for row in digest_figures(DAY) if row.user_id in USER_IDS}
+    assert sorted(figures) == [1701, 1702, 1703]
+    first = figures[1701]
+    assert (first.chat_id, first.count, first.mean, first.below, first.above, first.lowest, first.highest) == \
+           (11701, 4, 127.5, 1, 1, 60, 200)
+    # The A1C mean also covers the reading of the day before
+    assert first.a1c_mean == pytest.approx((60 + 100 + 150 + 200 + 300) / 5)
+    assert [row.user_id for row in digest_figures(DAY, after=1701) if row.user_id in USER_IDS] == [1702, 1703]
+
+
+def test_digest_message():
+    figures = next(row for row in digest_figures(DAY) if row.user_id == 1701)
+    assert main.digest_message(DAY, figures) == (
+        "Your summary for 2023-12-09 (UTC), 4 readings:\n"
+        "Average 128 mg/dl (7.08 mmol/l), lowest 60, highest 200\n"
+        "Time in range 70-180: 50%, below: 25%, above: 25%\n"
+        "Estimated A1C for the last 60 days: 7.27%")
+
+
+def test_run_resumes_after_the_last_committed_batch():
+    stop = threading.Event()
+    first = Sender(stop=stop)
+    assert run_digest(DAY, first, main.digest_message, batch_size=2, stop=stop) == (2, 0, False)
+    second = Sender()
+    assert run_digest(DAY, second, main.digest_message, batch_size=2) == (3, 0, True)
+
+    mine = [chat_id for chat_id, _ in first.sent + second.sent if chat_id - 10000 in USER_IDS]
+    assert mine == [11701, 11702, 11703]
+    assert run_digest(DAY, Sender(), main.digest_message) == (3, 0, True)
+
+
+def test_failed_sends_are_counted_and_blocked_users_unsubscribed():
+    blocked = ApiTelegramException('sendMessage', None, {'error_code': 403, 'description': 'Forbidden: blocked'})
+    sender = Sender(fail={11702: blocked, 11703: RuntimeError('timeout')})
+    result = run_digest(DAY, sender, main.digest_message, rate=1000)
+    assert result.failed >= 2 and result.finished
+    remaining = {row[0] for row in get_connection().execute('SELECT user_id FROM digest_subscriptions')}
+    assert 1702 not in remaining and {1701, 1703} <= remaining
+
+
+def test_due_day():
+    assert due_day(START + 86400 + 8 * 3600, hour=7) == DAY
+    assert due_day(START + 86400 + 6 * 3600, hour=7) == DAY - 1
+
+
+def test_digest_job_sends_the_due_day(mocker):
+    mocker.patch('digest.due_day', return_value=DAY)
+    sender = Sender()
+    job = DigestJob(sender, main.digest_message).start()
+    try:
+        while get_connection().execute('SELECT finished_at FROM digest_runs WHERE day=?', (DAY,)).fetchone() in \
+                (None, (None,)):
+            threading.Event().wait(0.01)
+    finally:
+        job.stop(5)
+    assert {11701, 11702, 11703} <= {chat_id for chat_id, _ in sender.sent}
+
+
+def test_digest_command(mocker):
+    send = mocker.patch('main.send_message')
+    message = SimpleNamespace(text='/digest off', from_user=SimpleNamespace(id=1704), chat=SimpleNamespace(id=5))
+    main.handle_message(message)
+    main.handle_message(message)
+    assert [call.args[1] for call in send.call_args_list] == [
+        "Daily digest stopped", "You are not getting the daily digest. Send /digest to start it."]
+
+    message.text = '/digest'
+    main.handle_message(message)
+    assert get_connection().execute('SELECT chat_id FROM digest_subscriptions WHERE user_id=1704').fetchone() == (5,)
+
+
+def test_async_runtime_digest(mocker):
+    sent = []
+
+    async def send_message(chat_id, text):
+        if chat_id == 11702:
+            raise asyncio_helper.ApiTelegramException('sendMessage', None,
+                                                      {'error_code': 403, 'description': 'Forbidden: blocked'})
+        sent.append(chat_id)
+        return SimpleNamespace(message_id=len(sent))
+
+    bot = mocker.patch('async_main.bot', new=mocker.AsyncMock())
+    bot.send_message.side_effect = send_message
+
+    async def scenario():
+        message = SimpleNamespace(text='/digest off', from_user=SimpleNamespace(id=1704), chat=SimpleNamespace(id=5))
+        await async_main.handle_message(message)
+        # The digest job sends from its own thread through the event loop
+        send = async_main.threadsafe_send(asyncio.get_running_loop())
+        return await asyncio.get_running_loop().run_in_executor(None, run_digest, DAY, send, main.digest_message)
+
+    result = asyncio.run(scenario())
+    assert result.finished and result.failed >= 1
+    assert {11701, 11703} <= set(sent)
+    remaining = {row[0] for row in get_connection().execute('SELECT user_id FROM digest_subscriptions')}
+    assert not remaining & {1702, 1704}
@@ -0,0 +1,108 @@
+import threading
+import time
+
+import pytest
+
+import main
+from database import get_connection, insert_data, insert_readings
+from reply_cache import ENTRY_OVERHEAD, ReplyCache
+
+USER_ID = 18
+OTHER_USER_ID = 1801
+
+
+@pytest.fixture(autouse=True)
+def cleanup():
+    yield
+    conn = get_connection()
+    with conn:
+        for user_id in (USER_ID, OTHER_USER_ID):
+            conn.execute('DELETE FROM user_inputs WHERE user_id=?', (user_id,))
+            main.reply_cache.invalidate(user_id)
+
+
+def statements(fn):
+    """Run ``fn`` and return (its result, the SQL statements it ran on this thread's connection)."""
+    conn, seen = get_connection(), []
+    conn.set_trace_callback(seen.append)
+    try:
+        return fn(), seen
+    finally:
+        conn.set_trace_callback(None)
+
+
+def test_lru_eviction_by_size_and_counters():
+    cache = ReplyCache(max_bytes=3 * (ENTRY_OVERHEAD + 100))
+    for key in 'abc':
+        cache.put(1, key, 'x' * 40)
+    assert cache.get(1, 'a') is not None
+    cache.put(2, 'd', 'x' * 40)  # evicts (1, 'b'), the least recently used
+    assert cache.get(1, 'b') is None
+    assert cache.counters() == {'entries': 3, 'bytes': cache.bytes, 'hits': 1, 'misses': 1, 'evictions': 1,
+                                'invalidations': 0, 'hit_rate': 0.5}
+    assert cache.bytes <= cache.max_bytes
+
+    cache.put(3, 'big', 'x' * cache.max_bytes)  # larger than the whole cache: not kept
+    assert cache.get(3, 'big') is None and len(cache) == 3
+
+    cache.max_age = -1
+    assert cache.get(1, 'a') is None
+
+
+def test_invalidate_drops_only_that_user():
+    cache = ReplyCache()
+    cache.put(1, 'a', 'one')
+    cache.put(1, 'b', 'two')
+    cache.put(2, 'a', 'three')
+    cache.invalidate(1)
+    assert (cache.get(1, 'a'), cache.get(1, 'b'), cache.get(2, 'a')) == (None, None, 'three')
+    assert cache.bytes == cache._entries[(2, 'a')][1]
+
+
+def test_value_computed_across_an_invalidation_is_not_stored():
+    cache = ReplyCache()
+    started, release = threading.Event(), threading.Event()
+
+    def compute():
+        started.set()
+        release.wait(5)
+        return 'stale'
+
+    thread = threading.Thread(target=cache.get_or_compute, args=(1, 'a', compute))
+    thread.start()
+    started.wait(5)
+    cache.invalidate(1)
+    release.set()
+    thread.join(5)
+    assert cache.get(1, 'a') is None
+    assert cache.get_or_compute(1, 'a', lambda: 'fresh') == 'fresh'
+    assert cache.get(1, 'a') == 'fresh'
+
+
+def test_repeated_history_tap_does_not_touch_sqlite():
+    now = int(time.time())
+    insert_readings([(now - i * 600, USER_ID, 100.0 + i, round((100 + i) / 18.0182, 2)) for i in range(5)])
+    first, queries = statements(lambda: main.history_page(USER_ID, 'week'))
+    assert queries
+    again, queries = statements(lambda: main.history_page(USER_ID, time_period='week'))
+    assert again is first and queries == []
+    _, queries = statements(lambda: main.a1c_message(USER_ID, '60'))
+    assert queries
+    _, queries = statements(lambda: main.a1c_message(USER_ID, '60'))
+    assert queries == []
+
+
+def test_new_reading_invalidates_that_users_replies():
+    now = int(time.time())
+    insert_data(USER_ID, 100, 5.55, now - 600)
+    insert_data(OTHER_USER_ID, 200, 11.1, now - 600)
+    assert main.get_avg(USER_ID, '60') == (100, 5.55)
+    other_page = main.history_page(OTHER_USER_ID, 'week')
+
+    insert_data(USER_ID, 200, 11.1, now - 300)
+    assert main.get_avg(USER_ID, '60')[0] == 150
+    assert "200.0 mg/dl" in main.history_page(USER_ID, 'week')[0]
+    assert main.history_page(OTHER_USER_ID, 'week') is other_page
+
+    insert_readings([(now - 120, OTHER_USER_ID, 50.0, 2.78)])
+    assert "50.0 mg/dl" in main.history_page(OTHER_USER_ID, 'week')[0]
@@ -0,0 +1,176 @@
+import math
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from benchmarks.fake_nightscout import FakeNightscout
+from benchmarks.nightscout_data import make_entries, make_treatments
+from database import get_connection
+from drafts.isf import US_PER_SECOND, EntryColumns, NightscoutAnalyzer, TreatmentColumns, exponential_curve, \
+    format_ns_date
+from forecast import ISF_SECONDS, SiteForecaster, StreamingForecaster
+
+USER_ID = 19
+
+
+def recorded_documents(days=3):
+    """Readings with gaps and a few zero readings, plus frequent corrections, merged in time order."""
+    entries = [dict(e, sgv=0) if i % 97 == 0 else e for i, e in enumerate(make_entries(days * 288)) if i % 3]
+    treatments = make_treatments(days, corrections_per_day=12)
+    documents = [(EntryColumns.row(e)[0], 0, e) for e in entries] + \
+                [(TreatmentColumns.row(t)[0], 1, t) for t in treatments]
+    return sorted(documents, key=lambda document: document[:2])
+
+
+@pytest.mark.parametrize('options', [{}, {'meal_window': 3600}, {'meal_window': 1800, 'dia_hours': 3,
+                                                                 'iob_curve': exponential_curve(55)}])
+def test_replay_matches_batch_recomputation(options):
+    documents = recorded_documents()
+    analyzer = NightscoutAnalyzer('http://localhost', **options)
+    forecaster = StreamingForecaster(**options)
+    compared = isf_compared = 0
+    for n, (when, kind, document) in enumerate(documents, start=1):
+        if kind == 0:
+            forecaster.add_entry(document)
+        else:
+            forecaster.add_treatment(document)
+        if n % 11:
+            continue
+        analyzer.entries = [d for _, k, d in documents[:n] if k == 0]
+        analyzer.treatments = [d for _, k, d in documents[:n] if k == 1]
+        now = when / US_PER_SECOND + 300
+        batch_isf, streamed_isf = analyzer.analyze_data(), forecaster.isf()
+        if batch_isf is None:
+            assert streamed_isf is None
+        else:
+            assert streamed_isf == pytest.approx(batch_isf, rel=1e-9)
+            isf_compared += 1
+        forecast = forecaster.forecast(3, now)
+        if forecast is None:
+            # The last reading is a zero one
+            assert analyzer.predict_glucose(1, now) is None
+            continue
+        for hours in (1, 2, 3):
+            batch = analyzer.predict_glucose(hours, now)
+            assert forecast[hours - 1] == pytest.approx(batch, rel=1e-9, abs=1e-9)
+            compared += 1
+    assert compared > 120 and isf_compared > 30 and not forecaster.stale
+
+
+def test_state_stays_bounded():
+    forecaster = StreamingForecaster()
+    for when, kind, document in recorded_documents(days=6):
+        (forecaster.add_entry if kind == 0 else forecaster.add_treatment)(document)
+    readings = len(forecaster._times) - forecaster._head
+    assert readings <= ISF_SECONDS // 300 + 2
+    assert len(forecaster._open) <= 12 and len(forecaster._boluses) <= 12
+    assert forecaster.trend() is not None
+
+
+def test_from_analyzer_and_out_of_order_documents():
+    analyzer = NightscoutAnalyzer('http://localhost')
+    analyzer.entries = make_entries(288)
+    analyzer.treatments = list(reversed(make_treatments(1)))
+    now = analyzer.entries.time[-1] / US_PER_SECOND
+    forecaster = StreamingForecaster.from_analyzer(analyzer)
+    assert forecaster.predict(2, now) == pytest.approx(analyzer.predict_glucose(2, now))
+
+    forecaster.add_entry(make_entries(10)[5])
+    assert forecaster.stale
+
+
+@pytest.fixture
+def site():
+    treatments = make_treatments(2, corrections_per_day=8)
+    site = FakeNightscout(make_entries(500), treatments[:-3]).start()
+    site.pending_treatments = treatments[-3:]
+    yield site
+    site.stop()
+    main.forecasters.pop(USER_ID, None)
+    conn = get_connection()
+    with conn:
+        for table in ('ns_entries', 'ns_treatments', 'ns_sync_state', 'ns_changes'):
+            conn.execute(f'DELETE FROM {table} WHERE source=?', (site.url,))
+
+
+def batch_forecast(url, now, hours=3):
+    analyzer = NightscoutAnalyzer(url)
+    analyzer.entries, analyzer.treatments = SiteForecaster(url).sync.load()
+    return [analyzer.predict_glucose(h, now) for h in range(1, hours + 1)]
+
+
+def test_site_forecaster_feeds_only_new_documents(site):
+    forecaster = SiteForecaster(site.url)
+    assert forecaster.summary() is None
+    assert forecaster.update() == (500, len(site.collections['treatments']))
+    state = forecaster.forecaster
+
+    site.add('entries', make_entries(560)[500:])
+    site.add('treatments', site.pending_treatments)
+    assert forecaster.update() == (60, 3)
+    assert forecaster.forecaster is state
+    now = state.last_time / US_PER_SECOND
+    assert forecaster.summary(now=now).predictions == pytest.approx(batch_forecast(site.url, now))
+
+    # After a document older than what was fed, the state is rebuilt from the cache
+    state.add_entry(make_entries(10)[5])
+    assert state.stale
+    assert forecaster.update(sync=False) == (560, len(site.collections['treatments']))
+    assert forecaster.forecaster is not state and not forecaster.forecaster.stale
+    assert forecaster.summary(now=now).predictions == pytest.approx(batch_forecast(site.url, now))
+
+
+def test_site_forecaster_replays_rows_added_or_changed_behind_its_cursors(site):
+    forecaster = SiteForecaster(site.url)
+    forecaster.update()
+    state = forecaster.forecaster
+    assert forecaster.update(sync=False) == (0, 0) and forecaster.forecaster is state
+    now = state.last_time / US_PER_SECOND
+    conn = get_connection()
+
+    # Treatments fetched again unchanged, as after an interrupted sync, are not a change
+    forecaster.sync._store('treatments', conn.execute('SELECT source, created_at, id, event_type, insulin, carbs '
+                                                      'FROM ns_treatments WHERE source=?', (site.url,)).fetchall())
+    assert forecaster.update(sync=False) == (0, 0) and forecaster.forecaster is state
+    treatments = len(site.collections['treatments'])
+
+    # A late correction, older than the last treatment fed
+    first = site.collections['treatments'][0]['created_at']
+    late = TreatmentColumns.row({'created_at': first})[0] + 3600 * US_PER_SECOND
+    with conn:
+        conn.execute("INSERT INTO ns_treatments (source, created_at, id, event_type, insulin) VALUES (?, ?, 'late', "
+                     "'Correction Bolus', 2.5)", (site.url, format_ns_date(late)))
+    assert forecaster.update(sync=False) == (500, treatments + 1)
+    assert forecaster.forecaster is not state
+    assert forecaster.summary(now=now).predictions == pytest.approx(batch_forecast(site.url, now))
+
+    # An edited bolus: same row, new insulin
+    state = forecaster.forecaster
+    with conn:
+        conn.execute("UPDATE ns_treatments SET insulin = insulin + 1 WHERE source=? AND event_type='Meal Bolus' AND "
+                     "created_at = (SELECT MAX(created_at) FROM ns_treatments WHERE source=? AND "
+                     "event_type='Meal Bolus')", (site.url, site.url))
+    assert forecaster.update(sync=False) == (500, treatments + 1)
+    assert forecaster.forecaster is not state
+    assert forecaster.summary(now=now).predictions == pytest.approx(batch_forecast(site.url, now))
+
+
+def test_predict_command(site, mocker):
+    send = mocker.patch('main.send_message')
+    message = SimpleNamespace(text='/predict', from_user=SimpleNamespace(id=USER_ID), chat=SimpleNamespace(id=7))
+    main.handle_message(message)
+    assert send.call_args.args == (7, "Predictions need your Nightscout site. Ask the bot admin to add it.")
+
+    main.forecasters[USER_ID] = SiteForecaster(site.url)
+    main.forecasters[USER_ID].update()
+    forecast = main.forecasters[USER_ID].summary()
+    now = forecast.reading_time + 600
+    text = main.predict_message(USER_ID, now=now)
+    lines = text.splitlines()
+    assert lines[0].startswith(f"Glucose now: {round(forecast.glucose)} mg/dl") and "mg/dl per 5 min" in lines[0]
+    assert lines[1].startswith("Insulin on board: ")
+    predicted = batch_forecast(site.url, now)
+    assert lines[2:5] == [f"In {h} h: {round(g)} mg/dl ({round(g / 18.0182, 2)} mmol/l)"
+                          for h, g in enumerate(predicted, start=1)]
+    assert not math.isnan(forecast.iob)
@@ -0,0 +1,131 @@
+# webhook.py
+"""Webhook serving mode: an embedded HTTP server that receives updates from Telegram.
+
+Each POST is checked against the secret token, parsed and put on a bounded queue, and answered
+right away; worker threads feed the queued updates to the bot's handlers. Updates are sharded
+over the workers by user id, so one user's updates are still handled in order. When a shard's
+queue is full the server answers 429 and Telegram retries the delivery later.
+"""
+import hmac
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot.types import Update
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def update_user_id(update: dict):
+    """The id of the user an update comes from, or None for update types without one."""
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get('from'), dict):
+            return value['from'].get('id')
+    return None
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, bot, host='0.0.0.0', port=8443, path='/', secret_token=None, workers=4, queue_size=1000):
+        super().__init__((host, port), WebhookHandler)
+        self.bot = bot
+        self.webhook_path = path
+        self.secret_token = secret_token
+        self.received = 0
+        self.rejected = 0
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.workers = [threading.Thread(target=self._work, args=(q,), name=f'webhook-worker-{i}', daemon=True)
+                        for i, q in enumerate(self.queues)]
+        metrics.registry.gauge('queue_depth', self.queue_depth, 'Items waiting in a queue', queue='webhook')
+
+    def queue_depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def enqueue(self, update: dict) -> bool:
+        """Queue an update on its user's shard; False when that shard is full."""
+        user_id = update_user_id(update)
+        shard = self.queues[hash(user_id) % len(self.queues)]
+        try:
+            shard.put_nowait(update)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.received += 1
+        return True
+
+    def start_workers(self):
+        for worker in self.workers:
+            worker.start()
+
+    def shutdown(self):
+        """Stop serve_forever(), then let the workers drain their queues."""
+        super().shutdown()
+        self.server_close()
+        metrics.registry.remove_gauge('queue_depth', queue='webhook')
+        for q in self.queues:
+            q.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def _work(self, q):
+        while True:
+            update = q.get()
+            if update is None:
+                return
+            try:
+                self.bot.process_new_updates([Update.de_json(update)])
+            except Exception:
+                logger.exception(f'Failed to process update {update.get("update_id")}')
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    server: WebhookServer
+
+    def do_POST(self):
+        if self.path != self.server.webhook_path:
+            return self._reply(404)
+        secret = self.server.secret_token
+        if secret and not hmac.compare_digest(self.headers.get(SECRET_HEADER, ''), secret):
+            return self._reply(403)
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            update = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self._reply(400)
+        if not isinstance(update, dict) or 'update_id' not in update:
+            return self._reply(400)
+        self._reply(200 if self.server.enqueue(update) else 429)
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(bot, url, host='0.0.0.0', port=8443, path='/', secret_token=None, workers=4, queue_size=1000):
+    """Register the webhook with Telegram and serve updates until interrupted."""
+    # Handlers run inline on the shard workers, which keeps each user's updates ordered
+    bot.threaded = False
+    server = WebhookServer(bot, host, port, path, secret_token, workers, queue_size)
+    server.start_workers()
+    bot.remove_webhook()
+    bot.set_webhook(url=url, secret_token=secret_token)
+    logger.info(f'Serving webhook {url} on {host}:{server.server_address[1]}{path}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bot.remove_webhook()
+        server.shutdown()